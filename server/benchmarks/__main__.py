@@ -0,0 +1,30 @@
+"""
+Runs every benchmark with its default parameters, each in its own process.
+
+Usage (from the server directory):
+    python -m benchmarks --output results.jsonl
+"""
+import argparse
+import subprocess
+import sys
+
+BENCHMARKS = ('bench_startup', 'bench_updates', 'bench_api')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help="Append the results as JSON lines to this file.")
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS, help="Run only these benchmarks.")
+    args = parser.parse_args()
+
+    failed = []
+    for name in args.only or BENCHMARKS:
+        command = [sys.executable, '-m', f'benchmarks.{name}'] + (['--output', args.output] if args.output else [])
+        if subprocess.run(command).returncode != 0:
+            failed.append(name)
+    if failed:
+        sys.exit(f"Failed benchmarks: {', '.join(failed)}")
+
+
+if __name__ == '__main__':
+    main()
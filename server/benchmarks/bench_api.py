@@ -0,0 +1,150 @@
+"""
+Deployment API load test: concurrent POST /repo requests against the FastAPI app (in
+process, through httpx's ASGI transport), each deploying a local bare remote with the
+fake Docker client. Measures the latency to accept a request (202), the end-to-end
+latency until the job finishes, and the deployment throughput. With --bulk, the
+repositories are sent as a single manifest to POST /deployments/bulk instead.
+
+Usage (from the server directory):
+    python -m benchmarks.bench_api --repos 50 --concurrency 10 --workers 4
+    python -m benchmarks.bench_api --repos 80 --workers 4 --bulk
+"""
+import argparse
+import asyncio
+import importlib
+import os
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from unittest import mock
+import docker
+import httpx
+from .common import add_latency_argument, emit, parse_latencies, percentiles, quiet_logs
+from .fakes import FakeDockerClient
+from .fixtures import create_remote
+
+
+def load_app(base_path: str, workers: int, fake_client: FakeDockerClient):
+    """Imports main with the fake Docker client and a throwaway repository path."""
+    os.environ.update({
+        'REPO_PATH': os.path.join(base_path, 'clones'),
+        'STATE_DB_PATH': os.path.join(base_path, 'state.db'),
+        'DEPLOY_WORKERS': str(workers),
+        'POLL_ENABLED': 'false',
+    })
+    with mock.patch.object(docker, 'from_env', return_value=fake_client):
+        main = importlib.import_module('main')
+    quiet_logs()
+    return main
+
+
+async def deploy(client: httpx.AsyncClient, url: str, semaphore: asyncio.Semaphore, poll_interval: float):
+    async with semaphore:
+        start = time.perf_counter()
+        response = await client.post('/repo', json={'url': url})
+        accepted = time.perf_counter() - start
+        response.raise_for_status()
+        job_id = response.json()['job_id']
+        while True:
+            job = (await client.get(f'/jobs/{job_id}')).json()
+            if job['status'] in ('succeeded', 'failed'):
+                return accepted, time.perf_counter() - start, job
+            await asyncio.sleep(poll_interval)
+
+
+async def run_load(app, urls, concurrency: int, poll_interval: float):
+    semaphore = asyncio.Semaphore(concurrency)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://dockerfly.bench') as client:
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*(deploy(client, url, semaphore, poll_interval) for url in urls))
+        return outcomes, time.perf_counter() - start
+
+
+async def run_bulk(app, urls, poll_interval: float):
+    """Sends every repository in one manifest and waits for the bulk deployment to finish."""
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://dockerfly.bench') as client:
+        start = time.perf_counter()
+        response = await client.post('/deployments/bulk', json={'apps': [{'url': url} for url in urls]})
+        accepted = time.perf_counter() - start
+        response.raise_for_status()
+        bulk_id = response.json()['bulk_id']
+        while True:
+            bulk = (await client.get(f'/deployments/bulk/{bulk_id}')).json()
+            if bulk['status'] != 'running':
+                break
+            await asyncio.sleep(poll_interval)
+        wall_seconds = time.perf_counter() - start
+        jobs = [(await client.get(f"/jobs/{app['job_id']}")).json() for app in bulk['apps'] if app['job_id']]
+        return accepted, wall_seconds, bulk, jobs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repos', type=int, default=50, help="Distinct repositories deployed.")
+    parser.add_argument('--duplicates', type=int, default=1, help="Requests sent for each repository.")
+    parser.add_argument('--concurrency', type=int, default=10, help="Requests in flight at the same time.")
+    parser.add_argument('--workers', type=int, default=4, help="DEPLOY_WORKERS of the server.")
+    parser.add_argument('--poll-interval', type=float, default=0.02, help="Seconds between job status checks.")
+    parser.add_argument('--bulk', action='store_true', help="Send the repositories as one manifest to POST /deployments/bulk.")
+    parser.add_argument('--output', help="Append the result as a JSON line to this file.")
+    add_latency_argument(parser)
+    args = parser.parse_args()
+
+    quiet_logs()
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    with tempfile.TemporaryDirectory() as base_path:
+        urls = [create_remote(base_path, f'bench-app-{i}', 5000 + i) for i in range(args.repos)]
+        fake_client = FakeDockerClient(parse_latencies(args.latency))
+        main_module = load_app(base_path, args.workers, fake_client)
+
+        if args.bulk:
+            accepted, wall_seconds, bulk, bulk_jobs = asyncio.run(run_bulk(main_module.app, urls, args.poll_interval))
+            main_module.server.job_queue.shutdown(wait=True)
+            emit('post_deployments_bulk', {
+                "repos": args.repos, "workers": args.workers, "latencies": fake_client.record.latencies,
+            }, {
+                "apps": len(bulk['apps']),
+                "counts": bulk['counts'],
+                "accept_latency_seconds": round(accepted, 4),
+                "wall_seconds": round(wall_seconds, 3),
+                "deployments_per_second": round(bulk['counts']['succeeded'] / wall_seconds, 2),
+                "queued_seconds": percentiles([job['timings']['queued_seconds'] for job in bulk_jobs if job['timings']['queued_seconds'] is not None]),
+                "clone_seconds": percentiles([app['clone']['duration_seconds'] for app in bulk['apps'] if app['clone']]),
+                "docker_calls": fake_client.record.summary(),
+            }, args.output)
+            return
+
+        requests = [url for url in urls for _ in range(args.duplicates)]
+        outcomes, wall_seconds = asyncio.run(run_load(main_module.app, requests, args.concurrency, args.poll_interval))
+        main_module.server.job_queue.shutdown(wait=True)
+
+    jobs = {job['job_id']: job for _, _, job in outcomes}
+    succeeded = [job for job in jobs.values() if job['status'] == 'succeeded']
+    phases = defaultdict(list)
+    for job in jobs.values():
+        for phase, seconds in job['timings']['phases'].items():
+            phases[phase].append(seconds)
+
+    emit('post_repo', {
+        "repos": args.repos, "duplicates": args.duplicates, "concurrency": args.concurrency,
+        "workers": args.workers, "latencies": fake_client.record.latencies,
+    }, {
+        "requests": len(requests),
+        "jobs": len(jobs),
+        "succeeded": len(succeeded),
+        "failed": len(jobs) - len(succeeded),
+        "wall_seconds": round(wall_seconds, 3),
+        "deployments_per_second": round(len(succeeded) / wall_seconds, 2),
+        "accept_latency_seconds": percentiles([accepted for accepted, _, _ in outcomes]),
+        "end_to_end_seconds": percentiles([total for _, total, _ in outcomes]),
+        "queued_seconds": percentiles([job['timings']['queued_seconds'] for job in jobs.values() if job['timings']['queued_seconds'] is not None]),
+        "phase_seconds": {phase: percentiles(samples) for phase, samples in sorted(phases.items())},
+        "docker_calls": fake_client.record.summary(),
+    }, args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Cold start benchmark: time to open the state store and reconcile the tracked apps
+against the containers reported by the daemon.
+
+Usage (from the server directory):
+    python -m benchmarks.bench_startup --apps 1000
+"""
+import argparse
+import os
+import tempfile
+import time
+from src import Server
+from src.server import APP_LABEL
+from src.state_store import StateStore
+from .common import emit, quiet_logs
+from .fakes import FakeDockerClient
+
+
+def populate(base_path: str, apps: int) -> FakeDockerClient:
+    store = StateStore(os.path.join(base_path, '.dockerfly', 'state.db'))
+    docker_client = FakeDockerClient(latencies={})
+    for i in range(apps):
+        container_name = f'app-{i}'
+        repo_path = os.path.join(base_path, container_name)
+        store.save_app(container_name, {
+            "repo_url": f"https://git.example.com/team/{container_name}.git",
+            "repo_path": repo_path,
+            "repo_name": container_name,
+            "app_name": container_name,
+            "branch": "main",
+            "last_commit": f"{i:040x}",
+            "container_id": f"{i:064x}",
+            "image_tag": f"dockerfly/{container_name}:latest",
+            "app_config": {"app_name": container_name, "port": 5000, "start_command": ["python", "main.py"]},
+        })
+        store.record_deployment(container_name, f"{i:040x}", f"dockerfly/{container_name}:latest", f"{i:064x}", {})
+        docker_client.api.container_summaries.append({
+            "Id": f"{i:064x}",
+            "State": "running",
+            "Image": f"dockerfly/{container_name}:latest",
+            "Labels": {APP_LABEL: container_name},
+        })
+    store.close()
+    return docker_client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--apps', type=int, default=1000)
+    parser.add_argument('--output', help="Append the result as a JSON line to this file.")
+    args = parser.parse_args()
+
+    quiet_logs()
+
+    with tempfile.TemporaryDirectory() as base_path:
+        docker_client = populate(base_path, args.apps)
+
+        start = time.perf_counter()
+        server = Server(path=base_path, docker_client=docker_client)
+        startup_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        server.reconcile_state()
+        reconcile_seconds = time.perf_counter() - start
+
+        result = {
+            "tracked_apps": len(server.deployed_apps),
+            "startup_seconds": round(startup_seconds, 4),
+            "reconcile_seconds": round(reconcile_seconds, 4),
+        }
+        server.job_queue.shutdown()
+        server.state_store.close()
+    emit('startup', {"apps": args.apps}, result, args.output)
+
+
+if __name__ == '__main__':
+    main()
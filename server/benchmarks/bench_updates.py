@@ -0,0 +1,113 @@
+"""
+Update polling benchmark: duration of a check_all_updates tick for a growing number of
+deployed apps, each with its own clone of a local bare remote. A share of the apps is
+behind its remote, so the tick also dispatches updates (recorded, not executed).
+
+Usage (from the server directory):
+    python -m benchmarks.bench_updates --apps 10 100 1000
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from git import Repo
+from src import Server
+from .common import add_latency_argument, emit, parse_latencies, percentiles, quiet_logs
+from .fakes import FakeDockerClient
+from .fixtures import clone_copy, create_remote, push_commit
+
+
+def setup_apps(base_path: str, apps: int, remotes: int, changed_ratio: float, server: Server):
+    """Registers the apps on the server, spread over the remotes; changed_ratio of them lag one commit behind."""
+    templates = []
+    for r in range(remotes):
+        name = f'remote-{r}'
+        create_remote(base_path, name, 5000 + r)
+        remote_path = os.path.join(base_path, 'remotes', f'{name}.git')
+        template_path = os.path.join(base_path, 'templates', name)
+        initial_commit = Repo.clone_from(remote_path, template_path).head.commit.hexsha
+        latest_commit = push_commit(base_path, name)
+        Repo(template_path).remotes.origin.pull()
+        templates.append((remote_path, template_path, initial_commit, latest_commit))
+
+    changed_every = round(1 / changed_ratio) if changed_ratio > 0 else 0
+    for i in range(apps):
+        remote_path, template_path, initial_commit, latest_commit = templates[i % remotes]
+        container_name = f'app-{i}'
+        repo_path = os.path.join(server.path, container_name)
+        clone_copy(template_path, repo_path)
+        behind = changed_every and i % changed_every == 0
+        server._register_app(container_name, {
+            "repo_url": remote_path,
+            "repo_path": repo_path,
+            "repo_name": container_name,
+            "app_name": container_name,
+            "branch": "main",
+            "last_commit": initial_commit if behind else latest_commit,
+            "app_config": {},
+        }, persist=False)
+
+
+async def run_ticks(server: Server, ticks: int):
+    durations = []
+    for _ in range(ticks):
+        start = time.perf_counter()
+        await server.check_all_updates()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def bench(apps: int, args) -> dict:
+    with tempfile.TemporaryDirectory() as base_path:
+        clones_path = os.path.join(base_path, 'clones')
+        server = Server(
+            path=clones_path,
+            main_config={'poll_concurrency': args.concurrency, 'poll_timeout_seconds': args.timeout},
+            docker_client=FakeDockerClient(parse_latencies(args.latency)),
+        )
+        dispatched = []
+        server.dispatch_update = dispatched.append
+
+        setup_start = time.perf_counter()
+        setup_apps(base_path, apps, min(apps, args.remotes), args.changed_ratio, server)
+        setup_seconds = time.perf_counter() - setup_start
+
+        durations = asyncio.run(run_ticks(server, args.ticks))
+        result = {
+            "apps": apps,
+            "setup_seconds": round(setup_seconds, 3),
+            "tick_seconds": percentiles(durations),
+            "apps_per_second": round(apps / (sum(durations) / len(durations)), 1),
+            "updates_dispatched_per_tick": len(dispatched) // args.ticks,
+            "timeouts": server.poll_stats['timeouts'],
+            "errors": server.poll_stats['errors'],
+        }
+        server.job_queue.shutdown()
+        server._poll_executor.shutdown()
+        server.state_store.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--apps', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--remotes', type=int, default=20, help="Distinct remotes the apps are spread over.")
+    parser.add_argument('--changed-ratio', type=float, default=0.1, help="Share of apps behind their remote.")
+    parser.add_argument('--ticks', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=16, help="POLL_CONCURRENCY of the server.")
+    parser.add_argument('--timeout', type=int, default=20, help="POLL_TIMEOUT_SECONDS of the server.")
+    parser.add_argument('--output', help="Append the result as a JSON line to this file.")
+    add_latency_argument(parser)
+    args = parser.parse_args()
+
+    quiet_logs()
+    results = [bench(apps, args) for apps in args.apps]
+    emit('update_check', {
+        "apps": args.apps, "remotes": args.remotes, "changed_ratio": args.changed_ratio,
+        "ticks": args.ticks, "poll_concurrency": args.concurrency,
+    }, results, args.output)
+
+
+if __name__ == '__main__':
+    main()
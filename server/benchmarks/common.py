@@ -0,0 +1,83 @@
+"""
+Helpers shared by the benchmarks: quiet logging, latency options and a common JSON
+result format, so results of different commits can be compared side by side.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+from loguru import logger as log
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def quiet_logs():
+    log.remove()
+    log.add(sys.stderr, level="WARNING")
+
+
+def add_latency_argument(parser: argparse.ArgumentParser):
+    parser.add_argument('--latency', action='append', default=[], metavar='CALL=SECONDS',
+                        help="Latency of a fake docker call, e.g. --latency api.build=0.5 (repeatable).")
+
+
+def parse_latencies(values: List[str]) -> Optional[Dict[str, float]]:
+    """Latencies given on the command line, on top of the defaults of the fake client."""
+    if not values:
+        return None
+    from .fakes import DEFAULT_LATENCIES
+    latencies = dict(DEFAULT_LATENCIES)
+    for value in values:
+        name, _, seconds = value.partition('=')
+        latencies[name] = float(seconds)
+    return latencies
+
+
+def git_commit() -> Optional[str]:
+    """Commit of the DockerFly checkout being benchmarked."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=SERVER_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentiles(samples: List[float]) -> Dict[str, Optional[float]]:
+    if not samples:
+        return {"count": 0, "mean": None, "p50": None, "p95": None, "p99": None, "max": None}
+    ordered = sorted(samples)
+
+    def pick(fraction: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(fraction * len(ordered)))], 4)
+
+    return {
+        "count": len(ordered),
+        "mean": round(statistics.fmean(ordered), 4),
+        "p50": pick(0.50),
+        "p95": pick(0.95),
+        "p99": pick(0.99),
+        "max": round(ordered[-1], 4),
+    }
+
+
+def emit(benchmark: str, params: Dict[str, Any], results: Any, output: Optional[str] = None) -> Dict[str, Any]:
+    """Prints a result (and appends it to output as a JSON line, if given)."""
+    record = {
+        "benchmark": benchmark,
+        "commit": git_commit(),
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "params": params,
+        "results": results,
+    }
+    print(json.dumps(record, indent=2))
+    if output:
+        with open(output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+    return record
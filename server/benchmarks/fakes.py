@@ -0,0 +1,290 @@
+"""
+Stand-in for the docker-py client, so the Server can be benchmarked offline
+without a Docker daemon. Every call is recorded and can be given a latency to
+simulate a real daemon (e.g. a build taking half a second).
+"""
+import hashlib
+import itertools
+import threading
+import time
+from types import SimpleNamespace
+from collections import defaultdict
+from typing import Any, Dict, Iterator, List, Optional
+from docker.errors import APIError, ImageNotFound, NotFound
+
+# Latencies (seconds) applied when none are given: a quick build and container start
+DEFAULT_LATENCIES = {
+    'api.build': 0.2,
+    'containers.run': 0.05,
+    'container.stop': 0.02,
+}
+
+
+class CallRecorder:
+    """Counts the calls made to the fake daemon and applies the configured latency to each."""
+
+    def __init__(self, latencies: Optional[Dict[str, float]] = None):
+        self.latencies = dict(DEFAULT_LATENCIES if latencies is None else latencies)
+        self._counts: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    def __call__(self, name: str):
+        with self._lock:
+            self._counts[name] += 1
+        delay = self.latencies.get(name, 0)
+        if delay:
+            time.sleep(delay)
+
+    def summary(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(sorted(self._counts.items()))
+
+
+def _fake_id(seed: str) -> str:
+    return 'sha256:' + hashlib.sha256(seed.encode()).hexdigest()
+
+
+class FakeImage:
+    def __init__(self, images: 'FakeImages', tag: str, labels: Optional[Dict[str, str]] = None, size: int = 150 * 1024 ** 2):
+        self._images = images
+        self.id = _fake_id(f'{tag}-{time.monotonic_ns()}')
+        self.short_id = self.id[:19]
+        self.tags = [tag]
+        self.labels = labels or {}
+        created = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime()) + f'.{time.time_ns() % 10 ** 9:09d}Z'
+        self.attrs = {'Id': self.id, 'Size': size, 'RepoTags': self.tags, 'Created': created, 'Config': {'Labels': self.labels}}
+
+    def tag(self, repository: str, tag: str = 'latest') -> bool:
+        self._images.tag(self, f'{repository}:{tag}')
+        return True
+
+
+class FakeImages:
+    def __init__(self, recorder: CallRecorder):
+        self._record = recorder
+        self.images: Dict[str, FakeImage] = {}
+        self._lock = threading.Lock()
+
+    def add(self, tag: str, labels: Optional[Dict[str, str]] = None) -> FakeImage:
+        image = FakeImage(self, tag, labels)
+        self.tag(image, tag)
+        with self._lock:
+            self.images[image.id] = image
+        return image
+
+    def tag(self, image: FakeImage, tag: str):
+        """Points a tag to an image; the image that had it loses it (and is left dangling if it was its only tag)."""
+        with self._lock:
+            previous = self.images.get(tag)
+            if previous is not None and previous is not image:
+                previous.tags.remove(tag)
+            if tag not in image.tags:
+                image.tags.append(tag)
+            self.images[tag] = image
+
+    def build(self, tag: str, labels: Optional[Dict[str, str]] = None, **kwargs):
+        self._record('images.build')
+        return self.add(tag, labels), iter(())
+
+    def pull(self, repository: str, tag: str = 'latest', **kwargs) -> FakeImage:
+        self._record('images.pull')
+        with self._lock:
+            image = self.images.get(f'{repository}:{tag}')
+        return image or self.add(f'{repository}:{tag}')
+
+    def get(self, name: str) -> FakeImage:
+        self._record('images.get')
+        with self._lock:
+            image = self.images.get(name)
+        if image is None:
+            raise ImageNotFound(f'No such image: {name}')
+        return image
+
+    def list(self, filters: Optional[Dict[str, Any]] = None) -> List[FakeImage]:
+        self._record('images.list')
+        label = (filters or {}).get('label')
+        with self._lock:
+            images = {image.id: image for image in self.images.values()}.values()
+        return [image for image in images if not label or label.split('=')[0] in image.labels]
+
+    def remove(self, name: str, **kwargs):
+        """Untags an image, and deletes it when it was its last tag (or it is removed by id)."""
+        self._record('images.remove')
+        with self._lock:
+            image = self.images.pop(name, None)
+            if image is None:
+                raise ImageNotFound(f'No such image: {name}')
+            if name in image.tags:
+                image.tags.remove(name)
+            if name == image.id or not image.tags:
+                self.images = {key: value for key, value in self.images.items() if value is not image}
+
+    def prune(self, filters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Deletes the dangling (untagged) images."""
+        self._record('images.prune')
+        with self._lock:
+            dangling = [image for key, image in self.images.items() if key == image.id and not image.tags]
+            for image in dangling:
+                del self.images[image.id]
+        return {'ImagesDeleted': [{'Deleted': image.id} for image in dangling],
+                'SpaceReclaimed': sum(image.attrs['Size'] for image in dangling)}
+
+    def total_size(self) -> int:
+        with self._lock:
+            return sum(image.attrs['Size'] for key, image in self.images.items() if key == image.id)
+
+
+class FakeContainer:
+    def __init__(self, client: 'FakeDockerClient', image: str, name: str, ports: Optional[Dict[str, Any]],
+                 labels: Optional[Dict[str, str]], network: str = 'bridge', environment: Optional[Dict[str, str]] = None, **kwargs):
+        self._client = client
+        self.id = _fake_id(f'{name}-{time.monotonic_ns()}')[7:]
+        self.short_id = self.id[:12]
+        self.name = name
+        self.image_ref = image
+        known = client.images.images.get(image)
+        self.image_id = known.id if known else image
+        # Like docker-py, the image of a container is an image object
+        self.image = known or SimpleNamespace(id=self.image_id)
+        self.environment = dict(environment or {})
+        self.labels = dict(labels or {})
+        self.status = 'running'
+        self.ports = {
+            container_port: [{'HostIp': '0.0.0.0', 'HostPort': str(host_port or next(client.ephemeral_ports))}]
+            for container_port, host_port in (ports or {}).items()
+        }
+        self.attrs = {'NetworkSettings': {'Networks': {network: {'IPAddress': '172.17.0.2'}}}}
+
+    def reload(self):
+        self._client.record('container.reload')
+
+    def stop(self, timeout: int = 10):
+        self._client.record('container.stop')
+        self.status = 'exited'
+
+    def remove(self, force: bool = False):
+        self._client.record('container.remove')
+        self._client.containers.forget(self)
+
+    def rename(self, name: str):
+        self._client.record('container.rename')
+        self._client.containers.rename(self, name)
+
+    def logs(self, tail: int = 20) -> bytes:
+        self._client.record('container.logs')
+        return b''
+
+    def summary(self) -> Dict[str, Any]:
+        """Container as listed by the low-level API (docker ps)."""
+        ports = [{'PrivatePort': int(container_port.split('/')[0]), 'PublicPort': int(bindings[0]['HostPort']), 'Type': 'tcp'}
+                 for container_port, bindings in self.ports.items()]
+        return {'Id': self.id, 'Names': [f'/{self.name}'], 'Image': self.image_ref, 'ImageID': self.image_id, 'State': self.status,
+                'Labels': self.labels, 'Ports': ports}
+
+
+class FakeContainers:
+    def __init__(self, client: 'FakeDockerClient'):
+        self._client = client
+        self._by_name: Dict[str, FakeContainer] = {}
+        self._lock = threading.Lock()
+
+    def run(self, image: str, name: str, ports: Optional[Dict[str, Any]] = None,
+            labels: Optional[Dict[str, str]] = None, **kwargs) -> FakeContainer:
+        self._client.record('containers.run')
+        container = FakeContainer(self._client, image, name, ports, labels, network=kwargs.get('network', 'bridge'),
+                                  environment=kwargs.get('environment'))
+        with self._lock:
+            if name in self._by_name:
+                raise APIError(f'Conflict. The container name "/{name}" is already in use.')
+            self._by_name[name] = container
+        return container
+
+    def get(self, name: str) -> FakeContainer:
+        self._client.record('containers.get')
+        with self._lock:
+            container = self._by_name.get(name)
+        if container is None:
+            raise NotFound(f'No such container: {name}')
+        return container
+
+    def list(self, all: bool = False, filters: Optional[Dict[str, Any]] = None) -> List[FakeContainer]:
+        self._client.record('containers.list')
+        return [container for container in self.snapshot() if _matches_label(container.labels, (filters or {}).get('label'))]
+
+    def snapshot(self) -> List[FakeContainer]:
+        with self._lock:
+            return list(self._by_name.values())
+
+    def forget(self, container: FakeContainer):
+        with self._lock:
+            if self._by_name.get(container.name) is container:
+                del self._by_name[container.name]
+
+    def rename(self, container: FakeContainer, name: str):
+        with self._lock:
+            self._by_name.pop(container.name, None)
+            container.name = name
+            self._by_name[name] = container
+
+
+def _matches_label(labels: Dict[str, str], label_filter: Optional[str]) -> bool:
+    if not label_filter:
+        return True
+    key, _, value = label_filter.partition('=')
+    return key in labels and (not value or labels[key] == value)
+
+
+class FakeAPI:
+    def __init__(self, client: 'FakeDockerClient'):
+        self._client = client
+        # Extra containers reported by containers(), e.g. left over from a previous run of the server
+        self.container_summaries: List[Dict[str, Any]] = []
+        # Hooks of the requests session of docker.APIClient (never called: no HTTP requests are made)
+        self.hooks: Dict[str, List[Any]] = {'response': []}
+
+    def containers(self, all: bool = False, filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        self._client.record('api.containers')
+        label = (filters or {}).get('label')
+        summaries = self.container_summaries + [c.summary() for c in self._client.containers.snapshot()]
+        return [c for c in summaries if _matches_label(c.get('Labels', {}), label)]
+
+    def prune_builds(self, **kwargs) -> Dict[str, Any]:
+        self._client.record('api.prune_builds')
+        return {'CachesDeleted': [], 'SpaceReclaimed': 0}
+
+    def build(self, tag: str, path: Optional[str] = None, dockerfile: Optional[str] = None, decode: bool = False,
+              **kwargs) -> Iterator[Dict[str, Any]]:
+        self._client.record('api.build')
+        # The daemon reads the whole context (a file or the chunks of a stream) before building
+        for _ in kwargs.get('fileobj') or ():
+            pass
+        yield {'stream': f'Step 1/2 : FROM python (fake build of {tag})\n'}
+        image = self._client.images.add(tag)
+        yield {'stream': f'Successfully built {image.short_id[7:]}\n'}
+        yield {'stream': f'Successfully tagged {tag}\n'}
+
+
+class FakeDockerClient:
+    def __init__(self, latencies: Optional[Dict[str, float]] = None):
+        """:param latencies: Seconds added to each call, by call name (e.g. {'api.build': 0.5}). None uses DEFAULT_LATENCIES."""
+        self.record = CallRecorder(latencies)
+        self.images = FakeImages(self.record)
+        self.containers = FakeContainers(self)
+        self.api = FakeAPI(self)
+        self.ephemeral_ports = itertools.count(32768)
+
+    def ping(self) -> bool:
+        self.record('ping')
+        return True
+
+    def close(self):
+        pass
+
+    def df(self) -> Dict[str, Any]:
+        self.record('df')
+        return {'LayersSize': self.images.total_size()}
+
+    def info(self) -> Dict[str, Any]:
+        self.record('info')
+        running = sum(1 for c in self.containers.snapshot() if c.status == 'running')
+        return {'MemTotal': 16 * 1024 ** 3, 'ContainersRunning': running}
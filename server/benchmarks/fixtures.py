@@ -0,0 +1,57 @@
+"""
+Local git remotes for the benchmarks: bare repositories holding a minimal DockerFly
+app, so cloning, pulling and polling run against real git without network access.
+"""
+import os
+import shutil
+from typing import Optional
+from git import Actor, Repo
+
+_AUTHOR = Actor('DockerFly Benchmarks', 'benchmarks@dockerfly.local')
+
+
+def create_remote(base_path: str, name: str, port: int, extra_files: int = 0) -> str:
+    """
+    Creates a bare repository with a DockerFly app (dockerfly.yaml, requirements.txt, main.py).
+    :param extra_files: Additional source files, to make the repository bigger.
+    :return: Path of the bare repository, usable as clone URL.
+    """
+    remote_path = os.path.join(base_path, 'remotes', f'{name}.git')
+    work_path = os.path.join(base_path, 'work', name)
+    Repo.init(remote_path, bare=True, initial_branch='main')
+    work_repo = Repo.init(work_path, initial_branch='main')
+
+    files = {
+        'dockerfly.yaml': f"app_name: {name}\nport: {port}\npython_version: '3.10'\nstart_command: ['python', 'main.py']\n",
+        'requirements.txt': "flask\n",
+        'main.py': "print('hello')\n",
+        'README.md': f"# {name}\n",
+    }
+    for i in range(extra_files):
+        files[f'src/module_{i}.py'] = f"VALUE = {i}\n" * 50
+    for relative_path, content in files.items():
+        full_path = os.path.join(work_path, relative_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+    work_repo.index.add(list(files))
+    work_repo.index.commit('Initial commit', author=_AUTHOR, committer=_AUTHOR)
+    work_repo.create_remote('origin', remote_path).push('main')
+    return remote_path
+
+
+def push_commit(base_path: str, name: str, path: str = 'main.py', content: Optional[str] = None) -> str:
+    """Commits a change to a file of the app and pushes it. Returns the new commit."""
+    work_path = os.path.join(base_path, 'work', name)
+    work_repo = Repo(work_path)
+    with open(os.path.join(work_path, path), 'a', encoding='utf-8') as f:
+        f.write(content or "print('update')\n")
+    work_repo.index.add([path])
+    commit = work_repo.index.commit(f'Update {path}', author=_AUTHOR, committer=_AUTHOR)
+    work_repo.remotes.origin.push('main')
+    return commit.hexsha
+
+
+def clone_copy(template_path: str, target_path: str):
+    """Copies an existing clone, much faster than cloning again when many apps share a remote."""
+    shutil.copytree(template_path, target_path, symlinks=True)
@@ -5,6 +5,7 @@ IMAGE_NAME=$1
 EXPOSED_PORT=$2
 DIR_PATH=$3
 NETWORK_NAME=$4
+CONFIG_FILE=$5
 
 if [ -z "$IMAGE_NAME" ] || [ -z "$EXPOSED_PORT" ] || [ -z "$DIR_PATH" ]; then
     echo "Error: All parameters are required"
@@ -20,6 +21,12 @@ else
     echo "Directory already exists: $DIR_PATH"
 fi
 
+# config.yml lists the docker nodes, if any
+CONFIG_MOUNT=""
+if [ -n "$CONFIG_FILE" ] && [ -f "$CONFIG_FILE" ]; then
+    CONFIG_MOUNT="-v $CONFIG_FILE:/app/config.yml:ro"
+fi
+
 # Run FastAPI application
 echo "Starting FastAPI application..."
 docker run \
@@ -28,6 +35,7 @@ docker run \
     -p $EXPOSED_PORT:$EXPOSED_PORT \
     -v $DIR_PATH:$DIR_PATH \
     -v /var/run/docker.sock:/var/run/docker.sock \
+    $CONFIG_MOUNT \
     --network=$NETWORK_NAME \
     $IMAGE_NAME \
     bash -c "uvicorn main:app --host 0.0.0.0 --port $EXPOSED_PORT"
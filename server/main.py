@@ -1,18 +1,78 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, HTMLResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from src import Server, RepoRequest
+from src import Server, BulkDeploymentRequest, RepoRequest, ScaleRequest
+from src.webhooks import verify_signature, parse_push_event
+from src.metrics import register_server
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 from loguru import logger as log
 import sys
+import json
+import os
+import yaml
+import asyncio
+from datetime import datetime
 from os import getenv
+from typing import Optional
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED
 
 log.add(sys.stderr, level="INFO")
 
 app = FastAPI(title='DockerFly API')
 
+def load_docker_nodes(config_path: str):
+    """Docker nodes and registry from the 'docker' section of config.yml (none if the file is not mounted)."""
+    if not os.path.isfile(config_path):
+        return [], None
+    with open(config_path, 'r', encoding='utf-8') as f:
+        docker_config = (yaml.safe_load(f) or {}).get('docker') or {}
+    return docker_config.get('nodes') or [], docker_config.get('registry')
+
 try:
+    docker_nodes, docker_registry = load_docker_nodes(getenv('NODES_CONFIG', '/app/config.yml'))
     repo_base_path = getenv('REPO_PATH', '/repositories')
-    server = Server(path=repo_base_path)
+    deploy_workers = getenv('DEPLOY_WORKERS')
+    main_config = {
+        'update_interval_seconds': int(getenv('UPDATE_INTERVAL_SECONDS', '60')),
+        'poll_concurrency': int(getenv('POLL_CONCURRENCY', '16')),
+        'poll_timeout_seconds': int(getenv('POLL_TIMEOUT_SECONDS', '20')),
+        'poll_enabled': getenv('POLL_ENABLED', 'true').lower() not in ('0', 'false', 'no'),
+        'webhook_secret': getenv('WEBHOOK_SECRET'),
+        'webhook_recent_seconds': int(getenv('WEBHOOK_RECENT_SECONDS', str(24 * 3600))),
+        'max_poll_backoff_seconds': int(getenv('MAX_POLL_BACKOFF_SECONDS', '3600')),
+        'state_db_path': getenv('STATE_DB_PATH'),
+        'clone_strategy': getenv('CLONE_STRATEGY', 'full'),
+        'skip_unchanged_builds': getenv('SKIP_UNCHANGED_BUILDS', 'true').lower() in ('1', 'true', 'yes'),
+        'probe_host': getenv('PROBE_HOST', 'localhost'),
+        'deps_cache_enabled': getenv('DEPS_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes'),
+        'deps_cache_budget_bytes': int(getenv('DEPS_CACHE_BUDGET_MB', '10240')) * 1024 ** 2,
+        'max_parallel_builds': int(getenv('MAX_PARALLEL_BUILDS', '2')),
+        'build_timeout_seconds': int(getenv('BUILD_TIMEOUT_SECONDS', '1800')),
+        'build_memory': getenv('BUILD_MEMORY_LIMIT'),
+        'build_cpu_shares': int(getenv('BUILD_CPU_SHARES')) if getenv('BUILD_CPU_SHARES') else None,
+        'build_cpuset_cpus': getenv('BUILD_CPUSET_CPUS'),
+        'gc_interval_seconds': int(getenv('GC_INTERVAL_SECONDS', '3600')),
+        'gc_keep_images': int(getenv('GC_KEEP_IMAGES', '3')),
+        'gc_image_budget_bytes': int(getenv('IMAGE_DISK_BUDGET_MB')) * 1024 ** 2 if getenv('IMAGE_DISK_BUDGET_MB') else None,
+        'gc_repo_budget_bytes': int(getenv('REPO_DISK_BUDGET_MB')) * 1024 ** 2 if getenv('REPO_DISK_BUDGET_MB') else None,
+        'gc_build_cache_budget_bytes': int(getenv('BUILD_CACHE_BUDGET_MB')) * 1024 ** 2 if getenv('BUILD_CACHE_BUDGET_MB') else None,
+        'nodes': docker_nodes,
+        'registry': getenv('DOCKER_REGISTRY') or docker_registry,
+        'node_health_interval_seconds': int(getenv('NODE_HEALTH_INTERVAL_SECONDS', '30')),
+        'base_images': [image for image in getenv('BASE_IMAGES', '').split(',') if image.strip()],
+        'wheelhouse_url': getenv('WHEELHOUSE_URL'),
+        'wheelhouse_index_url': getenv('WHEELHOUSE_INDEX_URL'),
+        'wheelhouse_budget_bytes': int(getenv('WHEELHOUSE_BUDGET_MB', '5120')) * 1024 ** 2,
+        'build_network': getenv('BUILD_NETWORK'),
+        'build_context_cache_bytes': int(getenv('BUILD_CONTEXT_CACHE_MB', '512')) * 1024 ** 2,
+        'bulk_clone_concurrency': int(getenv('BULK_CLONE_CONCURRENCY', '8')),
+        'telemetry_interval_seconds': int(getenv('TELEMETRY_INTERVAL_SECONDS', '15')),
+        'telemetry_samples': int(getenv('TELEMETRY_SAMPLES', '240')),
+        'base_image_refresh_seconds': int(getenv('BASE_IMAGE_REFRESH_SECONDS', str(6 * 3600))),
+    }
+    server = Server(path=repo_base_path, main_config=main_config, max_workers=int(deploy_workers) if deploy_workers else None)
+    register_server(server)
 except Exception as e:
     log.critical(f'Error initializing Server: {e}')
     sys.exit(1)
@@ -39,10 +99,70 @@ async def check_all_repos_for_updates():
     except Exception as e:
         log.error(f"Error during scheduled check: {e}")
 
+async def check_node_health():
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, server.nodes.check_health)
+    except Exception as e:
+        log.error(f"Error during node health check: {e}")
+
+async def collect_garbage():
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, server.gc.run)
+    except Exception as e:
+        log.error(f"Error during garbage collection: {e}")
+
+async def refresh_base_images():
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, server.base_images.refresh, server.deployed_apps)
+    except Exception as e:
+        log.error(f"Error refreshing base images: {e}")
+
+async def collect_telemetry():
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, server.telemetry.sample)
+    except Exception as e:
+        log.error(f"Error collecting container telemetry: {e}")
+
+def on_update_check_skipped(event):
+    if event.job_id == 'repo_update_check':
+        server.record_skipped_tick()
+
 @app.on_event("startup")
 async def startup_event():
     log.info('Starting scheduler...')
-    scheduler.add_job(check_all_repos_for_updates, 'interval', minutes=1, id='repo_update_check')
+    if main_config['poll_enabled']:
+        scheduler.add_job(
+            check_all_repos_for_updates, 'interval',
+            seconds=server.update_interval, id='repo_update_check',
+            max_instances=1, coalesce=True,
+        )
+        scheduler.add_listener(on_update_check_skipped, EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED)
+    else:
+        log.info('Update polling disabled. Updates are only triggered by webhooks.')
+    scheduler.add_job(
+        check_node_health, 'interval',
+        seconds=main_config['node_health_interval_seconds'], id='node_health_check',
+        max_instances=1, coalesce=True,
+    )
+    if server.gc_interval > 0:
+        scheduler.add_job(
+            collect_garbage, 'interval',
+            seconds=server.gc_interval, id='garbage_collection',
+            max_instances=1, coalesce=True,
+        )
+    if server.telemetry_interval > 0:
+        scheduler.add_job(
+            collect_telemetry, 'interval',
+            seconds=server.telemetry_interval, id='telemetry',
+            max_instances=1, coalesce=True,
+        )
+    if server.base_image_refresh_interval > 0:
+        # First refresh right away, so the base images are on the nodes before the first builds
+        scheduler.add_job(
+            refresh_base_images, 'interval',
+            seconds=server.base_image_refresh_interval, id='base_image_refresh',
+            max_instances=1, coalesce=True, next_run_time=datetime.now(),
+        )
     scheduler.start()
     log.info('Scheduler started.')
 
@@ -51,57 +171,228 @@ async def startup_event():
     log.info('Shutting down scheduler...')
     scheduler.shutdown()
     log.info('Scheduler shutdown complete.')
+    server.job_queue.shutdown()
+    server.base_images.close()
+    server.telemetry.close()
+    server.bulk.close()
+    server.nodes.close()
 
 """
 Receives a POST request with a JSON body containing the URL of the repository to clone
 """
-@app.post('/repo', status_code=202, summary="Clone a repo, generate Dockerfile and deploy application")
+@app.post('/repo', status_code=202, summary="Queue a deployment: clone a repo, generate Dockerfile and deploy application")
 async def send_repo(repo_request: RepoRequest):
     """
-    Received Git repo URL, clones it, generates Dockerfile based on dockerfly.yaml,
-    builds the image and runs the container.
+    Receives a Git repo URL and enqueues a deployment job that clones it, generates the
+    Dockerfile based on dockerfly.yaml, builds the image and runs the container.
+    Returns immediately with the job id; progress is available at GET /jobs/{job_id}.
     """
 
     log.info(f'Received request for repository: {repo_request.url}')
+    job = server.dispatch_deployment(repo_request.url, repo_request.clone_strategy)
+    return {
+        "message": "Deployment queued",
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "logs_url": f"/jobs/{job.id}/logs",
+    }
 
-    # 1. Clone repo
-    clone_result = server.clone_git(repo_request.url)
-    if clone_result is None:
-        raise HTTPException(
-            status_code=400,
-            detail="Failed to clone the repository. Check URL or server logs"
-        )
-    repo_path, repo_name, repo_url = clone_result
-    log.info(f"Repository '{repo_name}' cloned at: '{repo_path}'")
-
-    # 2. Generate Dockerfile
-    generation_result = server.generate_dockerfile_content(repo_path)
-    if generation_result is None:
-        raise HTTPException(
-            status_code=400,
-            detail="Failed to generate Dockerfile for '{repo_name}'. Check 'dockerfly.yaml' or server logs"
-        )
+@app.post('/deployments/bulk', status_code=202, summary="Queue the deployment of a manifest of repositories")
+async def deploy_bulk(bulk_request: BulkDeploymentRequest):
+    """
+    Clones the repositories of the manifest in parallel and deploys each one as soon as it is
+    cloned and the apps it depends on are deployed. Returns immediately with the bulk id;
+    progress of every app is available at GET /deployments/bulk/{bulk_id}.
+    """
+    try:
+        bulk = server.bulk.submit([app.model_dump() for app in bulk_request.apps])
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {
+        "message": f"Bulk deployment of {len(bulk.apps)} app(s) queued",
+        "bulk_id": bulk.id,
+        "status_url": f"/deployments/bulk/{bulk.id}",
+    }
+
+@app.get('/deployments/bulk/{bulk_id}', summary="Get the status of every app of a bulk deployment")
+async def get_bulk_deployment(bulk_id: str):
+    bulk = server.bulk.get(bulk_id)
+    if bulk is None:
+        raise HTTPException(status_code=404, detail=f"Bulk deployment '{bulk_id}' not found")
+    return bulk.to_dict()
 
-    dockerfile_content, app_config = generation_result
-    log.info(f"Dockerfile content generated for '{repo_name}' based on its 'dockerfly.yaml'")
+@app.get('/jobs/{job_id}', summary="Get status and timings of a deployment job")
+async def get_job(job_id: str):
+    job = server.job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    return job.to_dict()
+
+LOG_POLL_INTERVAL_SECONDS = 0.5
+LOG_KEEPALIVE_SECONDS = 15
+
+@app.get('/jobs/{job_id}/logs', summary="Stream the logs of a deployment job (Server-Sent Events)")
+async def stream_job_logs(job_id: str, request: Request):
+    """
+    Streams git progress, build output and container events of a job as Server-Sent Events.
+    The stream ends with an 'end' event carrying the final status of the job.
+    Clients reconnecting with Last-Event-ID resume after the last line received.
+    """
+    job = server.job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
 
-    # 3. Deploy application
     try:
-        deployment_result = server.deploy_app(repo_path, repo_name, repo_url, dockerfile_content, app_config)
-        if deployment_result is None:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Deployment failed for '{repo_name}'. Check server logs"
-            )
-
-        log.success(f"Deployment succesful for '{repo_name}'. Result: {deployment_result}")
-        return deployment_result
-    except Exception as e:
-        log.exception(f"Unexpected error during deployment step for '{repo_name}': {e}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Deployment step failed unexpectedly for '{repo_name}'. Check server logs",
-        ) from e
+        last_seq = int(request.headers.get('last-event-id', 0))
+    except ValueError:
+        last_seq = 0
+
+    async def event_stream():
+        nonlocal last_seq
+        idle_seconds = 0.0
+        while True:
+            finished = job.finished
+            entries = job.logs_since(last_seq)
+            for seq, line in entries:
+                yield f"id: {seq}\ndata: {line}\n\n"
+                last_seq = seq
+            if finished:
+                yield f"event: end\ndata: {json.dumps({'status': job.status, 'error': job.error})}\n\n"
+                return
+            if await request.is_disconnected():
+                return
+
+            idle_seconds = 0.0 if entries else idle_seconds + LOG_POLL_INTERVAL_SECONDS
+            if idle_seconds >= LOG_KEEPALIVE_SECONDS:
+                # Comment line: keeps proxies from closing an idle stream
+                yield ": keep-alive\n\n"
+                idle_seconds = 0.0
+            await asyncio.sleep(LOG_POLL_INTERVAL_SECONDS)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+@app.post('/hooks/git', status_code=202, summary="Receive a push webhook (GitHub, GitLab or Gitea) and redeploy the matching apps")
+async def git_webhook(request: Request):
+    if not server.webhook_secret:
+        raise HTTPException(status_code=503, detail="Webhooks are not enabled. Set WEBHOOK_SECRET on the server")
+
+    body = await request.body()
+    if not verify_signature(request.headers, body, server.webhook_secret):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
+
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Webhook payload is not valid JSON")
+
+    push_event = parse_push_event(payload) if isinstance(payload, dict) else None
+    if push_event is None:
+        log.debug('Webhook received, but it is not a branch push. Ignoring.')
+        return {"message": "Event ignored", "jobs": []}
+
+    repo_urls, branch, after = push_event
+    jobs = server.handle_push_event(repo_urls, branch, after)
+    return {
+        "message": f"{len(jobs)} redeploy(s) queued",
+        "jobs": [{"job_id": job.id, "app": job.target, "status_url": f"/jobs/{job.id}"} for job in jobs],
+    }
+
+@app.post('/apps/{app_name}/scale', status_code=202, summary="Change the number of replicas of an app without rebuilding it")
+async def scale_app(app_name: str, scale_request: ScaleRequest):
+    if app_name not in server.deployed_apps:
+        raise HTTPException(status_code=404, detail=f"App '{app_name}' is not deployed")
+    job = server.dispatch_scale(app_name, scale_request.replicas)
+    return {
+        "message": f"Scaling '{app_name}' to {scale_request.replicas} replica(s)",
+        "job_id": job.id,
+        "status_url": f"/jobs/{job.id}",
+    }
+
+@app.get('/apps/{app_name}', summary="Get the state of a deployed app")
+async def get_app(app_name: str):
+    app_state = server.deployed_apps.get(app_name)
+    if app_state is None:
+        raise HTTPException(status_code=404, detail=f"App '{app_name}' is not deployed")
+    return {
+        "app_name": app_state.get('app_name'),
+        "repo_url": app_state.get('repo_url'),
+        "branch": app_state.get('branch'),
+        "last_commit": app_state.get('last_commit'),
+        "image_tag": app_state.get('image_tag'),
+        "container_status": app_state.get('container_status'),
+        "replicas": len(app_state.get('replicas') or []),
+        "node": app_state.get('node'),
+        "clone_stats": app_state.get('clone_stats'),
+        "last_build_seconds": app_state.get('build_seconds'),
+        "first_response_seconds": app_state.get('first_response_seconds'),
+        "time_to_first_response_seconds": app_state.get('time_to_first_response_seconds'),
+        "build_skips": app_state.get('build_skips') or {"skipped": 0, "restarted": 0, "saved_build_seconds": 0.0},
+    }
+
+@app.get('/apps/{app_name}/stats', summary="Get the resource samples of an app and its autoscaling decisions")
+async def get_app_stats(app_name: str, since: Optional[float] = None):
+    if app_name not in server.deployed_apps:
+        raise HTTPException(status_code=404, detail=f"App '{app_name}' is not deployed")
+    return {"interval_seconds": server.telemetry_interval, **server.telemetry.app_stats(app_name, since)}
+
+@app.get('/cache', summary="Get dependency image cache statistics")
+async def get_cache_stats():
+    return {"enabled": server.deps_cache_enabled, **server.deps_cache.stats()}
+
+@app.get('/builds', summary="Get build slots, queue wait times per lane and the build context cache")
+async def get_build_stats():
+    return {**server.build_admission.stats(), "context_cache": server.build_contexts.stats()}
+
+@app.get('/base-images', summary="Get the pinned base images, their pulls and the prefetch hit rate")
+async def get_base_images():
+    return server.base_images.stats()
+
+@app.get('/wheelhouse', summary="Get wheelhouse hit rate, size and served wheels")
+async def get_wheelhouse_stats():
+    return server.wheelhouse.stats()
+
+@app.get('/wheelhouse/{platform_tag}/', response_class=HTMLResponse, summary="find-links page of every cached wheel of a platform")
+async def get_wheelhouse_index(platform_tag: str):
+    return server.wheelhouse.index_page(platform_tag)
+
+@app.get('/wheelhouse/{platform_tag}/files/{wheel_name}', summary="Download a cached wheel")
+async def get_wheel(platform_tag: str, wheel_name: str):
+    wheel_path = server.wheelhouse.wheel_path(platform_tag, wheel_name)
+    if wheel_path is None:
+        raise HTTPException(status_code=404, detail=f"Wheel '{wheel_name}' is not in the wheelhouse")
+    return FileResponse(wheel_path, media_type='application/octet-stream', filename=wheel_name)
+
+@app.get('/wheelhouse/{platform_tag}/{set_key}/', response_class=HTMLResponse, summary="find-links page of the wheels of a requirements file")
+async def get_wheel_set(platform_tag: str, set_key: str):
+    page = server.wheelhouse.index_page(platform_tag, set_key)
+    if page is None:
+        raise HTTPException(status_code=404, detail=f"Unknown wheel set '{set_key}'")
+    return page
+
+@app.get('/gc', summary="Get garbage collection settings and reclaimed bytes")
+async def get_gc_stats():
+    return server.gc.stats()
+
+@app.post('/gc', summary="Run a garbage collection now (skipped while builds are running)")
+async def run_gc():
+    return await asyncio.get_running_loop().run_in_executor(None, server.gc.run)
+
+@app.get('/updates/stats', summary="Get update polling metrics")
+async def get_update_stats():
+    return {"interval_seconds": server.update_interval, **server.poll_stats, "jobs": server.job_queue.stats()}
+
+@app.get('/nodes', summary="Get the docker nodes with their roles, health and load")
+async def get_nodes():
+    return server.nodes.stats()
+
+@app.get('/metrics', summary="Prometheus metrics: phase timings, job outcomes, queue depth and app sizes")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
 
 @app.get("/", summary="Check API status")
 async def root():
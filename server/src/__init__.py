@@ -1,2 +1,4 @@
+from .bulk_request import BulkDeploymentRequest
 from .repo_request import RepoRequest
-from .server import Server
\ No newline at end of file
+from .scale_request import ScaleRequest
+from .server import Server
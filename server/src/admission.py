@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+from loguru import logger as log
+from .jobs import DeploymentJob, job_log
+from .metrics import BUILD_QUEUE_WAIT, BUILD_TIMEOUTS
+from .nodes import parse_memory
+
+# Admission order: builds requested by a user go before the ones of automatic updates
+LANES = ('user', 'scheduler')
+# Job kinds started by the update polling or webhooks
+SCHEDULER_KINDS = ('update',)
+
+
+class BuildTimeout(Exception):
+    """Raised when a build runs longer than its timeout. The build is cancelled on the daemon."""
+
+
+def lane_for(job: Optional[DeploymentJob]) -> str:
+    """Lane of the build of a job: 'scheduler' for automatic updates, 'user' for the rest."""
+    return 'scheduler' if job is not None and job.kind in SCHEDULER_KINDS else 'user'
+
+
+def build_limits(memory: Any = None, cpu_shares: Optional[int] = None, cpuset_cpus: Optional[str] = None) -> Dict[str, Any]:
+    """container_limits of docker-py builds. Memory is a docker value ('2g'); swap is not allowed on top of it."""
+    limits: Dict[str, Any] = {}
+    memory_bytes = parse_memory(memory) if memory else None
+    if memory_bytes:
+        limits['memory'] = memory_bytes
+        limits['memswap'] = memory_bytes
+    if cpu_shares:
+        limits['cpushares'] = int(cpu_shares)
+    if cpuset_cpus:
+        limits['cpusetcpus'] = str(cpuset_cpus)
+    return limits
+
+
+class BuildAdmission:
+    """
+    Limits the builds running at the same time. Builds over the limit wait for a slot;
+    when one frees up it goes to the oldest build of the highest priority lane, so a
+    deployment requested through the API never waits behind a burst of automatic updates.
+    """
+
+    def __init__(self, max_parallel: int = 2, max_wait_samples: int = 500):
+        self.max_parallel = max(1, max_parallel)
+        self._condition = threading.Condition()
+        self._running: Dict[str, int] = {lane: 0 for lane in LANES}
+        self._waiting: Dict[str, deque] = {lane: deque() for lane in LANES}
+        self._waits: Dict[str, deque] = {lane: deque(maxlen=max_wait_samples) for lane in LANES}
+        self._admitted: Dict[str, int] = {lane: 0 for lane in LANES}
+        self._timeouts: Dict[str, int] = {lane: 0 for lane in LANES}
+
+    @contextmanager
+    def admit(self, lane: str) -> Iterator[float]:
+        """
+        Holds a build slot while the block runs. Blocks until a slot is free for this build.
+        :return: Seconds waited for the slot.
+        """
+        lane = lane if lane in LANES else LANES[0]
+        ticket = object()
+        start = time.monotonic()
+        with self._condition:
+            self._waiting[lane].append(ticket)
+            if not self._can_start(ticket):
+                running = sum(self._running.values())
+                log.info(f"Build waiting for a slot ({running}/{self.max_parallel} running, lane '{lane}').")
+                job_log(f"Waiting for a build slot ({running}/{self.max_parallel} builds running)...")
+                while not self._can_start(ticket):
+                    self._condition.wait()
+            self._waiting[lane].popleft()
+            self._running[lane] += 1
+            self._admitted[lane] += 1
+            waited = time.monotonic() - start
+            self._waits[lane].append(waited)
+            # The next build in line may fit in another free slot
+            self._condition.notify_all()
+        BUILD_QUEUE_WAIT.labels(lane).observe(waited)
+        try:
+            yield waited
+        finally:
+            with self._condition:
+                self._running[lane] -= 1
+                self._condition.notify_all()
+
+    def _can_start(self, ticket: object) -> bool:
+        if sum(self._running.values()) >= self.max_parallel:
+            return False
+        for lane in LANES:
+            if self._waiting[lane]:
+                return self._waiting[lane][0] is ticket
+        return False
+
+    def record_timeout(self, lane: str):
+        lane = lane if lane in LANES else LANES[0]
+        with self._condition:
+            self._timeouts[lane] += 1
+        BUILD_TIMEOUTS.labels(lane).inc()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._condition:
+            lanes = {}
+            for lane in LANES:
+                waits = sorted(self._waits[lane])
+                lanes[lane] = {
+                    "running": self._running[lane],
+                    "waiting": len(self._waiting[lane]),
+                    "admitted": self._admitted[lane],
+                    "timeouts": self._timeouts[lane],
+                    "wait_seconds": {
+                        "avg": round(sum(waits) / len(waits), 3) if waits else None,
+                        "p50": round(waits[len(waits) // 2], 3) if waits else None,
+                        "p95": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else None,
+                        "max": round(waits[-1], 3) if waits else None,
+                    },
+                }
+            return {"max_parallel": self.max_parallel, "running": sum(self._running.values()), "lanes": lanes}
@@ -0,0 +1,124 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Set, Tuple
+from loguru import logger as log
+from .dockerfile import DEFAULT_PYTHON_VERSION, base_image
+from .nodes import DockerNode, NodePool
+
+
+def normalize_base_image(reference: str) -> str:
+    """'3.12' -> 'python:3.12-slim'; full references are kept as they are."""
+    reference = reference.strip()
+    return reference if ':' in reference or '/' in reference else base_image(reference)
+
+
+def base_images_in_use(deployed_apps: Dict[str, Dict[str, Any]]) -> Set[str]:
+    """Base images of the deployed apps, from the python_version of their dockerfly.yaml."""
+    return {
+        base_image(str(app_state['app_config'].get('python_version', DEFAULT_PYTHON_VERSION)))
+        for app_state in list(deployed_apps.values()) if app_state.get('app_config')
+    }
+
+
+class BaseImagePuller:
+    """
+    Keeps the base images of the apps pulled on the build nodes, so builds do not wait for
+    them: the images of the apps deployed and the ones configured are pulled in the
+    background (a pull of an image that is up to date only checks its manifest), and a
+    deployment with a base image the node does not have starts pulling it as soon as its
+    dockerfly.yaml is read. Pulled images are pinned: the garbage collector keeps them.
+    """
+
+    def __init__(self, nodes: NodePool, configured: Iterable[str] = (), max_workers: int = 2):
+        self.nodes = nodes
+        self.configured = {normalize_base_image(reference) for reference in configured if reference.strip()}
+        self._in_use: Set[str] = set()
+        # Reentrant: a pull that finishes right away runs its done callback while the lock is held
+        self._lock = threading.RLock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='dockerfly-pull')
+        self._pending: Dict[Tuple[str, str], Future] = {}
+        # Last pull of each image on each node
+        self.pulls: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def pinned(self) -> Set[str]:
+        """Base images kept pulled: the configured ones and the ones of the deployed apps."""
+        with self._lock:
+            return self.configured | self._in_use
+
+    def _build_nodes(self):
+        return [node for node in self.nodes.nodes.values() if node.healthy and 'build' in node.roles]
+
+    def refresh(self, deployed_apps: Dict[str, Dict[str, Any]]):
+        """Pulls every pinned image on every build node. Blocking: run it off the event loop."""
+        with self._lock:
+            self._in_use = base_images_in_use(deployed_apps)
+        images = sorted(self.pinned())
+        if not images:
+            return
+        log.info(f"Refreshing base images on {len(self._build_nodes())} node(s): {', '.join(images)}")
+        futures = [self._submit(node, image) for node in self._build_nodes() for image in images]
+        for future in futures:
+            future.result()
+
+    def prefetch(self, image: str) -> bool:
+        """
+        Starts pulling a base image in the background on the build nodes that do not have it.
+        :return: True if every build node already had it (a hit).
+        """
+        missing = [node for node in self._build_nodes() if not node.has_image(image)]
+        with self._lock:
+            self._in_use.add(image)
+            if missing:
+                self.misses += 1
+            else:
+                self.hits += 1
+        for node in missing:
+            log.info(f"Base image '{image}' missing on node '{node.name}'. Pulling it in the background.")
+            self._submit(node, image)
+        return not missing
+
+    def _submit(self, node: DockerNode, image: str) -> Future:
+        # A pull already running for the same image and node is shared
+        with self._lock:
+            future = self._pending.get((node.name, image))
+            if future is None:
+                future = self._executor.submit(self._pull, node, image)
+                self._pending[(node.name, image)] = future
+                future.add_done_callback(lambda _, key=(node.name, image): self._forget(key))
+            return future
+
+    def _forget(self, key: Tuple[str, str]):
+        with self._lock:
+            self._pending.pop(key, None)
+
+    def _pull(self, node: DockerNode, image: str):
+        repository, _, tag = image.rpartition(':')
+        start = time.monotonic()
+        record: Dict[str, Any] = {"pulled_at": None, "seconds": None, "error": None}
+        try:
+            node.client.images.pull(repository, tag=tag)
+            record.update(pulled_at=time.time(), seconds=round(time.monotonic() - start, 3))
+            log.debug(f"Base image '{image}' pulled on node '{node.name}' in {record['seconds']}s.")
+        except Exception as e:
+            record['error'] = str(e)
+            log.warning(f"Could not pull base image '{image}' on node '{node.name}': {e}")
+        with self._lock:
+            self.pulls.setdefault(image, {})[node.name] = record
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "pinned": sorted(self.configured | self._in_use),
+                "pulling": len(self._pending),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "pulls": {image: dict(nodes) for image, nodes in self.pulls.items()},
+            }
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,176 @@
+import hashlib
+import tarfile
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from docker.utils.build import PatternMatcher
+from git import Repo
+from loguru import logger as log
+
+# Modes of the entries of a git tree
+_EXECUTABLE_MODE = 0o100755
+_SYMLINK_MODE = 0o120000
+_SUBMODULE_MODE = 0o160000
+
+# A tar archive ends with two empty blocks
+_END_OF_ARCHIVE = tarfile.NUL * tarfile.BLOCKSIZE * 2
+# Bytes read from the object database (or sent from a cached context) at a time
+_CHUNK_SIZE = 1024 ** 2
+
+
+class BuildContextError(Exception):
+    """Raised when the build context of a commit cannot be read from the repository."""
+
+
+def _header(name: str, size: int, mode: int, mtime: int, linkname: Optional[str] = None) -> bytes:
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = mode
+    info.mtime = mtime
+    if linkname is not None:
+        info.type = tarfile.SYMTYPE
+        info.linkname = linkname
+    return info.tobuf(format=tarfile.PAX_FORMAT)
+
+
+def _padding(size: int) -> bytes:
+    return tarfile.NUL * (-size % tarfile.BLOCKSIZE)
+
+
+class BuildContextCache:
+    """
+    Build contexts made straight from the git tree of a commit: the files of the tree that
+    its ignore rules do not exclude are read from the object database and streamed to the
+    daemon as a tar, with the generated Dockerfile appended, while the daemon reads it.
+    Neither the working tree nor .git is walked, nothing is written to the clone, and any
+    commit of the repository can be built without checking it out.
+
+    The tars are kept per commit and ignore rules, up to a memory budget, so rebuilds of a
+    commit (a new Dockerfile, a failed build retried) do not read it again. A context larger
+    than the budget is only streamed, never held in memory.
+    Files get the commit time as mtime: the context of a commit is the same on every clone.
+    """
+
+    def __init__(self, budget_bytes: int = 512 * 1024 ** 2):
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        # (commit, ignore rules hash) -> (tar without its end blocks, files, bytes of the files)
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[bytes, int, int]]" = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def context(self, repo_path: str, commit: str, dockerfile: str, dockerfile_content: str,
+                patterns: List[str]) -> Tuple[Iterator[bytes], Dict[str, Any]]:
+        """
+        Build context of a commit with the generated Dockerfile.
+        :param commit: Commit (or any revision) whose tree is sent.
+        :param dockerfile: Name of the Dockerfile in the context. A file of the tree with the same name is replaced.
+        :param patterns: Ignore rules of the context (see fingerprint.context_ignore_patterns).
+        :return: The chunks of the tar, produced as they are consumed, and the files, bytes and cache hit
+            of the context (files and bytes are complete once every chunk was consumed).
+            Raises BuildContextError if the commit cannot be read; errors while streaming raise it too.
+        """
+        try:
+            commit_object = Repo(repo_path).commit(commit)
+            mtime = commit_object.committed_date
+        except Exception as e:
+            raise BuildContextError(f"Could not read commit {commit[:7]} in {repo_path}: {e}") from e
+        key = (commit_object.hexsha, hashlib.sha256("\n".join(patterns + [dockerfile]).encode('utf-8')).hexdigest())
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        info: Dict[str, Any] = {"files": 0, "bytes": 0, "cached": entry is not None}
+
+        def chunks() -> Iterator[bytes]:
+            if entry is not None:
+                body, info['files'], info['bytes'] = entry
+                for offset in range(0, len(body), _CHUNK_SIZE):
+                    yield body[offset:offset + _CHUNK_SIZE]
+            else:
+                try:
+                    yield from self._stream(key, commit_object, patterns, dockerfile, info)
+                except Exception as e:
+                    raise BuildContextError(f"Could not read the tree of {commit[:7]} in {repo_path}: {e}") from e
+            dockerfile_data = dockerfile_content.encode('utf-8')
+            info['files'] += 1
+            info['bytes'] += len(dockerfile_data)
+            yield _header(dockerfile, len(dockerfile_data), 0o644, mtime) + dockerfile_data + _padding(len(dockerfile_data))
+            yield _END_OF_ARCHIVE
+
+        return chunks(), info
+
+    def _stream(self, key: Tuple[str, str], commit, patterns: List[str], dockerfile: str, info: Dict[str, Any]) -> Iterator[bytes]:
+        """Tar of the files of a commit, file by file. It is kept in the cache once complete, if it fits in the budget."""
+        matcher = PatternMatcher(patterns)
+        exceptions = [pattern.cleaned_pattern for pattern in matcher.patterns if pattern.exclusion]
+        mtime = commit.committed_date
+        # Copy for the cache, dropped as soon as it no longer fits
+        kept: Optional[List[bytes]] = []
+        kept_size = 0
+
+        def blocks(tree) -> Iterator[bytes]:
+            for item in tree:
+                if item.type == 'tree':
+                    # Excluded directories are skipped unless an exception ('!pattern') includes something under them, like docker-py does
+                    if not matcher.matches(item.path) or any(exception.startswith(item.path) for exception in exceptions):
+                        yield from blocks(item)
+                    continue
+                if item.mode == _SUBMODULE_MODE or item.path == dockerfile or matcher.matches(item.path):
+                    continue
+                info['files'] += 1
+                if item.mode == _SYMLINK_MODE:
+                    yield _header(item.path, 0, 0o777, mtime, linkname=item.data_stream.read().decode('utf-8'))
+                    continue
+                yield _header(item.path, item.size, 0o755 if item.mode == _EXECUTABLE_MODE else 0o644, mtime)
+                stream = item.data_stream
+                while True:
+                    data = stream.read(_CHUNK_SIZE)
+                    if not data:
+                        break
+                    yield data
+                yield _padding(item.size)
+                info['bytes'] += item.size
+
+        for block in blocks(commit.tree):
+            if kept is not None:
+                kept_size += len(block)
+                if kept_size > self.budget_bytes:
+                    kept = None
+                else:
+                    kept.append(block)
+            yield block
+        log.debug(f"Build context of {commit.hexsha[:7]}: {info['files']} file(s), {info['bytes']} bytes.")
+        if kept is not None:
+            self._store(key, (b''.join(kept), info['files'], info['bytes']))
+
+    def _store(self, key: Tuple[str, str], entry: Tuple[bytes, int, int]):
+        length = len(entry[0])
+        if length > self.budget_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                return
+            self._entries[key] = entry
+            self._size += length
+            # Least recently used contexts go first
+            while self._size > self.budget_bytes:
+                _, (body, _, _) = self._entries.popitem(last=False)
+                self._size -= len(body)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_bytes": self._size,
+                "budget_bytes": self.budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+            }
@@ -0,0 +1,117 @@
+import os
+import signal
+import shutil
+import subprocess
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+from loguru import logger as log
+
+
+class BuildKitError(Exception):
+    """Raised when a BuildKit build fails. Keeps the build output for logging."""
+
+    def __init__(self, message: str, build_log: List[str], timed_out: bool = False):
+        super().__init__(message)
+        self.build_log = build_log
+        self.timed_out = timed_out
+
+
+def buildkit_available() -> bool:
+    return shutil.which('docker') is not None
+
+
+def _write_context(process: subprocess.Popen, context: Iterable[bytes]):
+    try:
+        for chunk in context:
+            process.stdin.buffer.write(chunk)
+    except (BrokenPipeError, ValueError):
+        # The CLI exited (or was killed) before reading all of it: the build fails on its own
+        pass
+    except Exception as e:
+        # The context could not be read: the CLI gets a truncated tar and the build fails
+        log.error(f"Could not send the build context to BuildKit: {e}")
+    finally:
+        try:
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+
+def tls_options(tls: Optional[Dict[str, Any]]) -> List[str]:
+    """Global options of the docker CLI for a node 'tls' entry of config.yml (the same files docker-py is given)."""
+    if not tls:
+        return []
+    options = ['--tlsverify' if tls.get('verify', True) else '--tls']
+    if tls.get('ca_cert'):
+        options += ['--tlscacert', tls['ca_cert']]
+    if tls.get('client_cert'):
+        options += ['--tlscert', tls['client_cert'], '--tlskey', tls['client_key']]
+    return options
+
+
+def build_with_buildkit(context_path: str, dockerfile: str, tag: str, on_line: Optional[Callable[[str], None]] = None,
+                        docker_host: Optional[str] = None, timeout: Optional[float] = None,
+                        context: Optional[Iterable[bytes]] = None, tls: Optional[Dict[str, Any]] = None) -> List[str]:
+    """
+    Builds an image with BuildKit through the docker CLI. docker-py only talks to the
+    legacy builder, which does not support cache mounts or the dockerfile syntax directive.
+    :param context_path: Path of the build context (ignored when context is given).
+    :param dockerfile: Dockerfile path, relative to the context.
+    :param tag: Tag of the resulting image.
+    :param on_line: Called with each line of output as it is produced.
+    :param docker_host: Daemon to build on (tcp:// or ssh:// url), instead of the local one.
+    :param timeout: Seconds after which the CLI is killed, which cancels the build in BuildKit.
+    :param context: Chunks of the tar of the build context, written to the standard input of the CLI as it reads them.
+    :param tls: TLS settings of docker_host (ca_cert, client_cert, client_key, verify), as in config.yml.
+    :return: Lines of the build output.
+    """
+    if context is not None:
+        command = ['docker', *tls_options(tls), 'build', '--progress=plain', '-f', dockerfile, '-t', tag, '-']
+    else:
+        command = ['docker', *tls_options(tls), 'build', '--progress=plain', '-f', os.path.join(context_path, dockerfile), '-t', tag, context_path]
+    log.debug(f"Running BuildKit build: {' '.join(command)}")
+
+    process = subprocess.Popen(
+        command,
+        stdin=subprocess.PIPE if context is not None else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True,
+        # Own process group: the CLI runs the buildx plugin as a child process, both are killed on timeout
+        start_new_session=True,
+        env={**os.environ, 'DOCKER_BUILDKIT': '1', **({'DOCKER_HOST': docker_host} if docker_host else {})},
+    )
+    if context is not None:
+        # Written from another thread: the CLI only reads the whole context while its output is consumed here
+        threading.Thread(target=_write_context, args=(process, context), name='dockerfly-buildkit-context', daemon=True).start()
+    timed_out = threading.Event()
+
+    def kill():
+        timed_out.set()
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    watchdog = threading.Timer(timeout, kill) if timeout else None
+    if watchdog:
+        watchdog.daemon = True
+        watchdog.start()
+    build_log = []
+    try:
+        for line in process.stdout:
+            line = line.rstrip()
+            build_log.append(line)
+            log.debug(line)
+            if on_line:
+                on_line(line)
+        return_code = process.wait()
+    finally:
+        if watchdog:
+            watchdog.cancel()
+
+    if timed_out.is_set():
+        raise BuildKitError(f"docker build killed after {timeout}s", build_log, timed_out=True)
+    if return_code != 0:
+        raise BuildKitError(f"docker build exited with code {return_code}", build_log)
+    return build_log
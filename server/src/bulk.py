@@ -0,0 +1,223 @@
+import copy
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+from loguru import logger as log
+from .clone_strategies import repo_name
+from .jobs import DeploymentJob
+
+if TYPE_CHECKING:
+    from .server import Server
+
+# States of an app of a bulk deployment, in order. The last three are final.
+BULK_STATES = ('pending', 'cloning', 'waiting', 'deploying', 'succeeded', 'failed', 'skipped')
+FINAL_STATES = ('succeeded', 'failed', 'skipped')
+
+
+def apply_overrides(config: Dict[str, Any], overrides: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """dockerfly.yaml with the overrides of a manifest applied: mappings are merged key by key, other values replaced."""
+    merged = copy.deepcopy(config)
+    for key, value in (overrides or {}).items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = apply_overrides(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+class BulkDeployment:
+    """The apps of a manifest and where each one is in the pipeline."""
+
+    def __init__(self, apps: List[Dict[str, Any]]):
+        self.id = uuid.uuid4().hex
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.lock = threading.Lock()
+        self.apps: "OrderedDict[str, Dict[str, Any]]" = OrderedDict(
+            (app['name'], {**app, "state": 'pending', "job_id": None, "clone": None, "error": None, "finished_at": None})
+            for app in apps
+        )
+
+    @property
+    def finished(self) -> bool:
+        return all(app['state'] in FINAL_STATES for app in self.apps.values())
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self.lock:
+            apps = [dict(app) for app in self.apps.values()]
+        counts = Counter(app['state'] for app in apps)
+        if not all(app['state'] in FINAL_STATES for app in apps):
+            status = 'running'
+        else:
+            status = 'succeeded' if counts['succeeded'] == len(apps) else 'failed'
+        return {
+            "bulk_id": self.id,
+            "status": status,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "duration_seconds": round((self.finished_at or time.time()) - self.created_at, 3),
+            "counts": {state: counts[state] for state in BULK_STATES},
+            "apps": [
+                {
+                    "name": app['name'],
+                    "url": app['url'],
+                    "branch": app['branch'],
+                    "depends_on": app['depends_on'],
+                    "state": app['state'],
+                    "job_id": app['job_id'],
+                    "status_url": f"/jobs/{app['job_id']}" if app['job_id'] else None,
+                    "clone": app['clone'],
+                    "error": app['error'],
+                    "finished_at": app['finished_at'],
+                }
+                for app in apps
+            ],
+        }
+
+
+class BulkDeployer:
+    """
+    Deploys the apps of a manifest as a pipeline. Clones run on their own pool, ahead of the
+    deployment jobs, so by the time a job worker and a build slot are free the next repository
+    is already on disk: the builds, not the clones or the requests, set the pace. An app is
+    queued for deployment as soon as it is cloned and the apps it depends on are deployed;
+    if one of them fails, the apps depending on it are skipped.
+    """
+
+    def __init__(self, server: 'Server', clone_concurrency: int = 8, max_bulks: int = 100):
+        self.server = server
+        self.max_bulks = max_bulks
+        self._clones = ThreadPoolExecutor(max_workers=max(1, clone_concurrency), thread_name_prefix='dockerfly-bulk-clone')
+        self._bulks: "OrderedDict[str, BulkDeployment]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def validate(apps: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Names the apps of a manifest (their repository name unless given) and checks their dependencies.
+        Raises ValueError if names repeat, a dependency is unknown or dependencies form a cycle.
+        """
+        if not apps:
+            raise ValueError("The manifest has no apps.")
+        named = []
+        for app in apps:
+            name = app.get('name') or repo_name(app['url'])
+            if not name:
+                raise ValueError(f"Cannot tell the name of '{app['url']}'. Set 'name'.")
+            named.append({**app, "name": name, "branch": app.get('branch'), "clone_strategy": app.get('clone_strategy'),
+                          "overrides": app.get('overrides') or {}, "depends_on": list(app.get('depends_on') or [])})
+        names = [app['name'] for app in named]
+        duplicated = sorted({name for name in names if names.count(name) > 1})
+        if duplicated:
+            raise ValueError(f"Apps listed more than once: {', '.join(duplicated)}. Set a distinct 'name'.")
+        # The clone of an app goes to a directory named after its repository
+        repositories = [repo_name(app['url']) for app in named]
+        shared = sorted({name for name in repositories if repositories.count(name) > 1})
+        if shared:
+            raise ValueError(f"Several apps would be cloned from repositories named {', '.join(shared)}.")
+        for app in named:
+            unknown = [dependency for dependency in app['depends_on'] if dependency not in names]
+            if unknown:
+                raise ValueError(f"'{app['name']}' depends on apps not in the manifest: {', '.join(unknown)}.")
+
+        # Dependencies must form a DAG: peel off the apps whose dependencies are all placed
+        remaining = {app['name']: set(app['depends_on']) for app in named}
+        while remaining:
+            ready = [name for name, dependencies in remaining.items() if not dependencies & remaining.keys()]
+            if not ready:
+                raise ValueError(f"Dependency cycle between: {', '.join(sorted(remaining))}.")
+            for name in ready:
+                del remaining[name]
+        return named
+
+    def submit(self, apps: List[Dict[str, Any]]) -> BulkDeployment:
+        """Starts a bulk deployment. Raises ValueError if the manifest is invalid."""
+        bulk = BulkDeployment(self.validate(apps))
+        with self._lock:
+            self._bulks[bulk.id] = bulk
+            # Keep memory bounded: forget the oldest finished bulk deployments first
+            for bulk_id in [bulk_id for bulk_id, old in self._bulks.items() if old.finished][:max(0, len(self._bulks) - self.max_bulks)]:
+                del self._bulks[bulk_id]
+        log.info(f"Bulk deployment {bulk.id} started with {len(bulk.apps)} app(s).")
+        for app in bulk.apps.values():
+            self._clones.submit(self._clone, bulk, app)
+        return bulk
+
+    def get(self, bulk_id: str) -> Optional[BulkDeployment]:
+        with self._lock:
+            return self._bulks.get(bulk_id)
+
+    def _clone(self, bulk: BulkDeployment, app: Dict[str, Any]):
+        with bulk.lock:
+            # Skipped while it waited for a clone slot: one of its dependencies failed
+            if app['state'] in FINAL_STATES:
+                return
+            app['state'] = 'cloning'
+        clone_stats: Dict[str, Any] = {}
+        try:
+            clone_result = self.server.clone_git(app['url'], app['clone_strategy'], clone_stats, branch=app['branch'])
+        except Exception as e:
+            log.exception(f"Unexpected error cloning '{app['url']}': {e}")
+            clone_result = None
+        with bulk.lock:
+            if app['state'] in FINAL_STATES:
+                pass
+            elif clone_result is None:
+                self._finish(bulk, app, 'failed', "Failed to clone the repository. Check URL or server logs")
+            else:
+                app['state'] = 'waiting'
+                app['clone'] = clone_stats or None
+                app['prepared_clone'] = clone_result
+        self._advance(bulk)
+
+    def _advance(self, bulk: BulkDeployment):
+        """Queues the deployment of the cloned apps whose dependencies are deployed, and skips the ones that lost one."""
+        ready = []
+        with bulk.lock:
+            changed = True
+            while changed:
+                changed = False
+                for app in bulk.apps.values():
+                    if app['state'] not in ('pending', 'cloning', 'waiting'):
+                        continue
+                    dependencies = [bulk.apps[name] for name in app['depends_on']]
+                    failed = [dependency['name'] for dependency in dependencies if dependency['state'] in ('failed', 'skipped')]
+                    if failed:
+                        self._finish(bulk, app, 'skipped', f"Not deployed: {', '.join(failed)} failed")
+                        changed = True
+                    elif app['state'] == 'waiting' and all(dependency['state'] == 'succeeded' for dependency in dependencies):
+                        app['state'] = 'deploying'
+                        ready.append(app)
+
+        for app in ready:
+            job = self.server.dispatch_deployment(app['url'], app['clone_strategy'], branch=app['branch'],
+                                                  overrides=app['overrides'], prepared_clone=(app.pop('prepared_clone'), app['clone']))
+            with bulk.lock:
+                app['job_id'] = job.id
+            job.add_done_callback(lambda job, app=app: self._job_done(bulk, app, job))
+
+    def _job_done(self, bulk: BulkDeployment, app: Dict[str, Any], job: DeploymentJob):
+        with bulk.lock:
+            if job.status == DeploymentJob.SUCCEEDED:
+                self._finish(bulk, app, 'succeeded')
+            else:
+                self._finish(bulk, app, 'failed', job.error)
+        self._advance(bulk)
+
+    @staticmethod
+    def _finish(bulk: BulkDeployment, app: Dict[str, Any], state: str, error: Optional[str] = None):
+        # Called with bulk.lock held
+        app['state'] = state
+        app['error'] = error
+        app['finished_at'] = time.time()
+        if bulk.finished and bulk.finished_at is None:
+            bulk.finished_at = time.time()
+            counts = Counter(app['state'] for app in bulk.apps.values())
+            log.info(f"Bulk deployment {bulk.id} finished in {bulk.finished_at - bulk.created_at:.1f}s: "
+                     f"{counts['succeeded']} succeeded, {counts['failed']} failed, {counts['skipped']} skipped.")
+
+    def close(self):
+        self._clones.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,15 @@
+from pydantic import BaseModel, Field
+from typing import Any, Dict, List, Literal, Optional
+
+class BulkApp(BaseModel):
+    url: str
+    # Name of the app in the manifest (for depends_on); defaults to the repository name
+    name: Optional[str] = None
+    branch: Optional[str] = None
+    clone_strategy: Optional[Literal['full', 'shallow', 'partial', 'reference']] = None
+    # Values applied over the dockerfly.yaml of the app
+    overrides: Dict[str, Any] = {}
+    depends_on: List[str] = []
+
+class BulkDeploymentRequest(BaseModel):
+    apps: List[BulkApp] = Field(min_length=1)
@@ -0,0 +1,86 @@
+import hashlib
+import os
+import re
+import threading
+from typing import Any, Dict, Optional
+from git import Repo
+from loguru import logger as log
+from .webhooks import normalize_repo_url
+
+# full: complete history. shallow: only the last commit. partial: history without file contents
+# (blobs are fetched on checkout). reference: objects copied from a local mirror of the remote.
+CLONE_STRATEGIES = ('full', 'shallow', 'partial', 'reference')
+
+_SIZE = re.compile(r'(\d+(?:\.\d+)?)\s*(bytes|B|KiB|MiB|GiB)\b')
+_UNITS = {'bytes': 1, 'B': 1, 'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}
+
+
+def repo_name(repo_url: str) -> str:
+    """Name of a repository from its URL, which is also the directory of its clone."""
+    return repo_url.rstrip('/').split('/')[-1].replace('.git', '')
+
+
+def parse_transfer_size(message: str) -> Optional[int]:
+    """Bytes received, from a git progress message such as ', 1.21 MiB | 2.41 MiB/s, done.'"""
+    match = _SIZE.search(message or '')
+    if not match:
+        return None
+    return int(float(match.group(1)) * _UNITS[match.group(2)])
+
+
+def clone_options(strategy: str, mirror_path: Optional[str] = None) -> Dict[str, Any]:
+    """Keyword arguments for Repo.clone_from implementing a clone strategy."""
+    if strategy == 'shallow':
+        return {'depth': 1, 'single_branch': True}
+    if strategy == 'partial':
+        return {'filter': 'blob:none'}
+    if strategy == 'reference' and mirror_path:
+        # Dissociated: the mirror prunes the objects of force-pushed refs, the clone must not borrow them
+        return {'reference': mirror_path, 'dissociate': True}
+    return {}
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+class MirrorCache:
+    """
+    Bare mirrors of the remotes, the source of the objects of every clone of the same repository
+    (--reference --dissociate), so their objects are downloaded once. Clones copy the objects
+    they need and keep no link to the mirror, which can prune and gc them.
+    """
+
+    def __init__(self, base_path: str):
+        self.base_path = base_path
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_guard = threading.Lock()
+
+    def mirror_path(self, repo_url: str) -> str:
+        key = hashlib.sha1(normalize_repo_url(repo_url).encode()).hexdigest()
+        return os.path.join(self.base_path, f'{key}.git')
+
+    def ensure(self, repo_url: str) -> str:
+        """
+        Creates the mirror of a remote, or brings it up to date if it already exists.
+        :return: Path of the mirror.
+        """
+        mirror_path = self.mirror_path(repo_url)
+        with self._locks_guard:
+            lock = self._locks.setdefault(mirror_path, threading.Lock())
+        with lock:
+            if os.path.isdir(mirror_path):
+                log.info(f"Updating mirror of {repo_url} at {mirror_path}...")
+                Repo(mirror_path).git.remote('update', '--prune')
+            else:
+                log.info(f"Creating mirror of {repo_url} at {mirror_path}...")
+                os.makedirs(self.base_path, exist_ok=True)
+                Repo.clone_from(repo_url, mirror_path, mirror=True)
+        return mirror_path
@@ -0,0 +1,275 @@
+import hashlib
+import io
+import re
+import tarfile
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Any, Dict, List, Optional
+from loguru import logger as log
+from docker.errors import APIError, BuildError, ImageNotFound
+from requests.exceptions import RequestException
+from .admission import BuildAdmission, lane_for
+from .dockerfile import base_image
+from .jobs import current_job
+
+# Requirement lines pointing to other files or local paths cannot be installed in isolation
+_NOT_CACHEABLE = ('-r', '--requirement', '-c', '--constraint', '-e', '--editable', '.', '/', 'file:')
+_PROJECT_NAME = re.compile(r'^([A-Za-z0-9][A-Za-z0-9._-]*)(.*)$')
+# Comments, like pip reads them: a '#' at the start of a line or after whitespace
+_COMMENT = re.compile(r'(^|\s+)#.*$')
+# Per-requirement options ('--hash=...', '--config-settings ...') follow the requirement after whitespace
+_OPTIONS = re.compile(r'\s+(?=--)')
+
+
+class DependencyImageCache:
+    """
+    Content-addressed cache of images with the dependencies of an app pre-installed.
+    Images are keyed by (python_version, normalized requirements), so apps sharing their
+    requirements share one image, and are evicted LRU when the cache exceeds its disk budget.
+    Images that app images are built from are kept, and do not count against the budget:
+    removing them would free nothing while their children exist.
+    """
+    REPOSITORY = 'dockerfly/deps'
+    KEY_LABEL = 'dockerfly.deps.key'
+
+    def __init__(self, docker_client, disk_budget_bytes: int = 10 * 1024 ** 3, admission: Optional[BuildAdmission] = None,
+                 build_limits: Optional[Dict[str, Any]] = None, build_timeout: Optional[float] = None):
+        """
+        :param admission: Build slots shared with the app builds.
+        :param build_limits: container_limits of the dependency builds.
+        :param build_timeout: HTTP timeout of the builds: a build without output for that long fails.
+        """
+        self.docker_client = docker_client
+        self.disk_budget_bytes = disk_budget_bytes
+        self.admission = admission
+        self.build_limits = build_limits or {}
+        self.build_timeout = build_timeout
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Key -> [lock, number of deploys holding or waiting for it]; dropped when nobody does
+        self._key_locks: Dict[str, List[Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self._load_existing()
+
+    @staticmethod
+    def normalize_requirements(requirements_text: str) -> Optional[str]:
+        """
+        Normalizes a requirements file so that formatting, comments, ordering and
+        project name spelling do not change the cache key.
+        :return: The normalized requirements, or None if they reference other files or local paths.
+        """
+        requirements = set()
+        # Lines ending with a backslash continue on the next one
+        for line in re.sub(r'\\\r?\n', ' ', requirements_text).splitlines():
+            line = _COMMENT.sub('', line).strip()
+            if not line:
+                continue
+            if line.startswith(_NOT_CACHEABLE):
+                return None
+            requirement, *options = _OPTIONS.split(line)
+            match = _PROJECT_NAME.match(requirement)
+            if match:
+                requirement = DependencyImageCache._normalize_requirement(*match.groups())
+            requirements.add(" ".join([requirement] + [" ".join(option.split()) for option in options]))
+        return "\n".join(sorted(requirements))
+
+    @staticmethod
+    def _normalize_requirement(name: str, rest: str) -> str:
+        """
+        PEP 503 project name, without whitespace in the extras and version specifiers.
+        Environment markers and URLs are kept as written.
+        """
+        name = re.sub(r'[-_.]+', '-', name).lower()
+        if rest.strip().startswith('@'):
+            # Direct reference: 'name @ url', whose marker only starts at a ';' after whitespace
+            url, *marker = re.split(r'\s+;', rest.strip()[1:], maxsplit=1)
+            specifier = f" @ {url.strip()}"
+        else:
+            specifier, *marker = rest.split(';', 1)
+            specifier = re.sub(r'\s+', '', specifier)
+        return f"{name}{specifier}" + (f" ; {marker[0].strip()}" if marker else '')
+
+    @staticmethod
+    def cache_key(python_version: str, normalized_requirements: str) -> str:
+        return hashlib.sha256(f"{python_version}\n{normalized_requirements}".encode()).hexdigest()
+
+    def ensure(self, python_version: str, requirements_text: str) -> Optional[str]:
+        """
+        Returns the tag of the dependency image for the given requirements, building it on a miss.
+        :return: Image tag, or None if the requirements cannot be cached or the build fails.
+        """
+        normalized = self.normalize_requirements(requirements_text)
+        if normalized is None:
+            log.info("Requirements reference other files or local paths. Dependency image cache not used.")
+            return None
+
+        key = self.cache_key(python_version, normalized)
+        tag = f"{self.REPOSITORY}:{key[:16]}"
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            built = self._ensure_locked(key_lock[0], key, tag, python_version, normalized)
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if key_lock[1] == 0:
+                    del self._key_locks[key]
+        if built:
+            self._evict()
+        return tag if built else None
+
+    def _ensure_locked(self, key_lock: threading.Lock, key: str, tag: str, python_version: str, normalized: str) -> bool:
+        # Concurrent deploys of apps with the same requirements wait for a single build
+        with key_lock:
+            if self._image_exists(tag):
+                with self._lock:
+                    self.hits += 1
+                    self._touch(key, tag)
+                log.info(f"Dependency image cache hit: {tag}")
+                return True
+
+            with self._lock:
+                self.misses += 1
+            log.info(f"Dependency image cache miss. Building '{tag}' for Python {python_version}...")
+            if not self._build(tag, key, python_version, normalized):
+                with self._lock:
+                    self.failures += 1
+                return False
+
+            with self._lock:
+                self._touch(key, tag)
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "size_bytes": sum(entry['size'] for entry in self._entries.values()),
+                "disk_budget_bytes": self.disk_budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "build_failures": self.failures,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "images": [
+                    {"tag": entry['tag'], "size_bytes": entry['size'], "last_used": entry['last_used']}
+                    for entry in self._entries.values()
+                ],
+            }
+
+    def _load_existing(self):
+        # Images built before a restart are still in the daemon: start from them, oldest first
+        try:
+            images = self.docker_client.images.list(filters={'label': self.KEY_LABEL})
+        except APIError as e:
+            log.warning(f"Could not list cached dependency images: {e}")
+            return
+        images.sort(key=lambda image: image.attrs.get('Created', ''))
+        for image in images:
+            key = image.labels.get(self.KEY_LABEL)
+            tags = [tag for tag in image.tags if tag.startswith(self.REPOSITORY)]
+            if key and tags:
+                self._entries[key] = {"tag": tags[0], "size": image.attrs.get('Size', 0), "last_used": None}
+        log.info(f"Dependency image cache loaded with {len(self._entries)} image(s).")
+
+    def _image_exists(self, tag: str) -> bool:
+        try:
+            self.docker_client.images.get(tag)
+            return True
+        except ImageNotFound:
+            return False
+
+    def _touch(self, key: str, tag: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            try:
+                size = self.docker_client.images.get(tag).attrs.get('Size', 0)
+            except (APIError, ImageNotFound):
+                size = 0
+            entry = {"tag": tag, "size": size, "last_used": None}
+        entry['last_used'] = time.time()
+        self._entries[key] = entry
+
+    def _build(self, tag: str, key: str, python_version: str, normalized_requirements: str) -> bool:
+        dockerfile = "\n".join((
+            "# Auto-generated by DockerFly (dependency image)",
+            f"FROM {base_image(python_version)}",
+            "COPY requirements.txt /tmp/dockerfly-requirements.txt",
+            "RUN pip install --no-cache-dir -r /tmp/dockerfly-requirements.txt && rm /tmp/dockerfly-requirements.txt",
+        ))
+        context = io.BytesIO()
+        with tarfile.open(fileobj=context, mode='w') as tar:
+            for name, content in (('Dockerfile', dockerfile), ('requirements.txt', normalized_requirements + "\n")):
+                data = content.encode()
+                info = tarfile.TarInfo(name)
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+        context.seek(0)
+
+        try:
+            with self.admission.admit(lane_for(current_job())) if self.admission else nullcontext():
+                self.docker_client.images.build(
+                    fileobj=context,
+                    custom_context=True,
+                    tag=tag,
+                    labels={self.KEY_LABEL: key, 'dockerfly.deps.python_version': python_version},
+                    rm=True,
+                    forcerm=True,
+                    container_limits=self.build_limits,
+                    timeout=self.build_timeout,
+                )
+            log.success(f"Dependency image '{tag}' built.")
+            return True
+        except BuildError as e:
+            log.error(f"Failed to build dependency image '{tag}': {e}")
+            for line in e.build_log:
+                if isinstance(line, dict) and 'stream' in line:
+                    log.error(line['stream'].strip())
+            return False
+        except APIError as e:
+            log.error(f"Docker API error building dependency image '{tag}': {e}")
+            return False
+        except RequestException as e:
+            log.error(f"Build of dependency image '{tag}' aborted: {e}")
+            return False
+
+    def _has_children(self, key: str, tag: str) -> bool:
+        """Whether app images are built from a dependency image (they inherit its key label)."""
+        try:
+            image_id = self.docker_client.images.get(tag).id
+            return any(image.id != image_id for image in self.docker_client.images.list(filters={'label': f'{self.KEY_LABEL}={key}'}))
+        except ImageNotFound:
+            return False
+        except APIError as e:
+            log.warning(f"Could not list the images built from '{tag}': {e}")
+            return True
+
+    def _evict(self):
+        """Removes the least recently used images without children until the cache fits in its disk budget."""
+        with self._lock:
+            entries = list(self._entries.items())
+        # Images with children cannot be removed, only untagged: they are left out of the budget
+        removable = [(key, entry) for key, entry in entries if not self._has_children(key, entry['tag'])]
+        total_size = sum(entry['size'] for _, entry in removable)
+        victims = []
+        for key, entry in removable:
+            if total_size <= self.disk_budget_bytes or len(removable) - len(victims) <= 1:
+                break
+            victims.append(key)
+            total_size -= entry['size']
+        with self._lock:
+            evicted = [(key, self._entries.pop(key)) for key in victims if key in self._entries]
+
+        for key, entry in evicted:
+            try:
+                self.docker_client.images.remove(entry['tag'])
+                log.info(f"Evicted dependency image '{entry['tag']}' ({entry['size']} bytes).")
+            except ImageNotFound:
+                pass
+            except APIError as e:
+                log.warning(f"Could not evict dependency image '{entry['tag']}': {e}")
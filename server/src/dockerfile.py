@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+from typing import List, Optional
+
+BUILD_MODES = ('standard', 'optimized')
+DEFAULT_PYTHON_VERSION = '3.10'
+
+# Name of the generated Dockerfile in the build context
+GENERATED_DOCKERFILE = 'Dockerfile.dockerfly'
+
+# Ignore rules of the optimized builds of repositories that do not ship their own .dockerignore
+DEFAULT_DOCKERIGNORE = [
+    ".git",
+    ".dockerignore",
+    ".venv",
+    "venv",
+    "env",
+    "**/__pycache__",
+    "**/*.py[cod]",
+    "**/.pytest_cache",
+    "**/.mypy_cache",
+    "**/.ruff_cache",
+    ".tox",
+    ".nox",
+    "*.egg-info",
+]
+
+
+def base_image(python_version: str) -> str:
+    """Image the app images of a Python version are built from."""
+    return f"python:{python_version}-slim"
+
+
+def pip_install_options(find_links: Optional[str]) -> str:
+    """Options of the pip install of the requirements: only the wheels of the wheelhouse when it has them."""
+    return f"--no-index --find-links {find_links} " if find_links else ""
+
+
+def requirements_hash(requirements_path: str) -> str:
+    """SHA-256 of the requirements file, used to key the dependency layer."""
+    with open(requirements_path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def render_optimized_dockerfile(python_version: str, requirements_file: str, requirements_sha256: str,
+                                app_name: str, port: int, start_command: List[str], multi_stage: bool = False,
+                                find_links: Optional[str] = None) -> str:
+    """
+    Renders a BuildKit Dockerfile that keeps the dependencies in their own layer and
+    reuses pip's cache between builds through a cache mount.
+    :param multi_stage: Compile the wheels in a separate stage and install them without network access.
+    :param find_links: URL of the wheelhouse set of the requirements, installed instead of the package index.
+    """
+    req_copy_path = requirements_file.replace(os.path.sep, '/')
+    req_name = os.path.basename(req_copy_path)
+    from_image = base_image(python_version)
+
+    lines = [
+        "# syntax=docker/dockerfile:1",
+        "# Auto-generated by DockerFly (optimized build)",
+    ]
+    if multi_stage:
+        lines.extend((
+            f"FROM {from_image} AS wheels",
+            "",
+            "WORKDIR /wheels",
+            f"COPY {req_copy_path} ./requirements.txt",
+            "RUN --mount=type=cache,target=/root/.cache/pip \\",
+            f"    pip wheel {pip_install_options(find_links)}--wheel-dir /wheels -r requirements.txt",
+            "",
+        ))
+
+    lines.extend((
+        f"FROM {from_image}",
+        "",
+        "WORKDIR /app",
+        "ENV PIP_DISABLE_PIP_VERSION_CHECK=1",
+        "",
+        "# Dependencies layer: only rebuilt when the requirements change",
+        f'LABEL dockerfly.requirements.sha256="{requirements_sha256}"',
+    ))
+    if multi_stage:
+        lines.extend((
+            "RUN --mount=type=bind,from=wheels,source=/wheels,target=/wheels \\",
+            "    pip install --no-index --find-links /wheels -r /wheels/requirements.txt",
+        ))
+    else:
+        lines.extend((
+            f"COPY {req_copy_path} ./{req_name}",
+            "RUN --mount=type=cache,target=/root/.cache/pip \\",
+            f"    pip install {pip_install_options(find_links)}-r {req_name}",
+        ))
+
+    lines.extend((
+        "",
+        "# ENV Variables for nginx reverse proxy",
+        f"ENV VIRTUAL_HOST={app_name}",
+        f"ENV VIRTUAL_PORT={port}",
+        "",
+        "# Copy application code",
+        "COPY . .",
+        "",
+        "# Expose the application port",
+        f"EXPOSE {port}",
+        "",
+        "# Set the start command",
+        f"CMD {json.dumps(start_command)}",
+    ))
+    return "\n".join(lines)
+
+
+def render_deps_image_dockerfile(deps_image: str, app_name: str, port: int, start_command: List[str]) -> str:
+    """
+    Renders a Dockerfile based on a shared dependency image: the requirements are
+    already installed, so the build only copies the application code.
+    """
+    return "\n".join((
+        "# Auto-generated by DockerFly (shared dependency image)",
+        f"FROM {deps_image}",
+        "",
+        "WORKDIR /app",
+        "",
+        "# ENV Variables for nginx reverse proxy",
+        f"ENV VIRTUAL_HOST={app_name}",
+        f"ENV VIRTUAL_PORT={port}",
+        "",
+        "# Copy application code",
+        "COPY . .",
+        "",
+        "# Expose the application port",
+        f"EXPOSE {port}",
+        "",
+        "# Set the start command",
+        f"CMD {json.dumps(start_command)}",
+    ))
@@ -0,0 +1,93 @@
+import hashlib
+import json
+from typing import Any, Dict, List, Optional
+from docker.utils.build import PatternMatcher
+from git import Repo
+from loguru import logger as log
+from .dockerfile import DEFAULT_DOCKERIGNORE
+
+# What a new commit requires from a deployed app
+CHANGE_NONE = 'none'          # Same image and same container settings: nothing to do
+CHANGE_RUNTIME = 'runtime'    # Same image, new container settings (env, volumes...): restart only
+CHANGE_BUILD = 'build'        # The image inputs changed: rebuild and redeploy
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def config_hash(app_config: Dict[str, Any]) -> str:
+    """
+    SHA-256 of dockerfly.yaml. The fields that change the image (python version, port,
+    start command...) are already covered by the Dockerfile hash, so a change here
+    without a Dockerfile change only affects how the containers are run.
+    """
+    return text_hash(json.dumps(app_config, sort_keys=True, default=str))
+
+
+def context_ignore_patterns(repo: Repo, commit: str, app_config: Dict[str, Any]) -> List[str]:
+    """
+    Ignore rules of the build context of a commit: its own .dockerignore, parsed like docker-py
+    does, or DEFAULT_DOCKERIGNORE for optimized builds of repositories that do not ship one.
+    Read from the tree of the commit, so a .dockerignore left in the working tree is not used.
+    """
+    try:
+        content = repo.commit(commit).tree['.dockerignore'].data_stream.read().decode('utf-8')
+    except KeyError:
+        return list(DEFAULT_DOCKERIGNORE) if app_config.get('build', {}).get('mode') == 'optimized' else []
+    return [line.strip() for line in content.splitlines() if line.strip() and not line.strip().startswith('#')]
+
+
+def changed_context_paths(repo_path: str, old_commit: str, new_commit: str, app_config: Dict[str, Any]) -> Optional[List[str]]:
+    """
+    Files changed between two commits that are part of the build context of the new one,
+    i.e. not excluded by its ignore rules (see context_ignore_patterns). Only the trees are
+    compared, so no file is read and it also works on shallow and partial clones.
+    :return: The changed paths, or None if the commits could not be compared.
+    """
+    if old_commit == new_commit:
+        return []
+    try:
+        repo = Repo(repo_path)
+        diff_output = repo.git.diff('--name-only', '--no-renames', old_commit, new_commit)
+        patterns = context_ignore_patterns(repo, new_commit, app_config)
+    except Exception as e:
+        log.warning(f"Could not diff {old_commit[:7]}..{new_commit[:7]} in {repo_path}: {e}")
+        return None
+
+    # dockerfly.yaml is copied into the image too, but what it changes in the image is already
+    # in the generated Dockerfile; the rest (env, volumes...) only needs a restart
+    changed = [path for path in diff_output.splitlines() if path and path != 'dockerfly.yaml']
+    if '.dockerignore' in changed:
+        # The ignore rules themselves changed, every file may enter or leave the context
+        return changed
+    matcher = PatternMatcher(patterns)
+    return [path for path in changed if not matcher.matches(path)]
+
+
+def classify_change(repo_path: str, app_state: Dict[str, Any], new_commit: str,
+                    dockerfile_content: str, app_config: Dict[str, Any]) -> str:
+    """
+    Compares the build inputs of the new commit with the ones of the deployed image:
+    generated Dockerfile, files of the build context and dockerfly.yaml.
+    :param app_state: State of the deployed app (last_commit, dockerfile_sha256, config_sha256).
+    :return: CHANGE_NONE, CHANGE_RUNTIME or CHANGE_BUILD.
+    """
+    old_commit = app_state.get('last_commit')
+    if not old_commit or not app_state.get('dockerfile_sha256') or not app_state.get('config_sha256'):
+        return CHANGE_BUILD
+    if app_state['dockerfile_sha256'] != text_hash(dockerfile_content):
+        log.info("Generated Dockerfile changed.")
+        return CHANGE_BUILD
+
+    changed = changed_context_paths(repo_path, old_commit, new_commit, app_config)
+    if changed is None:
+        return CHANGE_BUILD
+    if changed:
+        shown = ', '.join(changed[:5]) + (f' (+{len(changed) - 5} more)' if len(changed) > 5 else '')
+        log.info(f"{len(changed)} file(s) of the build context changed: {shown}")
+        return CHANGE_BUILD
+
+    if app_state['config_sha256'] != config_hash(app_config):
+        return CHANGE_RUNTIME
+    return CHANGE_NONE
@@ -0,0 +1,284 @@
+import os
+import shutil
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set
+from docker.errors import APIError, NotFound
+from loguru import logger as log
+from .clone_strategies import directory_size
+from .deps_cache import DependencyImageCache
+from .dockerfile import GENERATED_DOCKERFILE
+from .webhooks import normalize_repo_url
+
+if TYPE_CHECKING:
+    from .nodes import DockerNode
+    from .server import Server
+
+APP_REPOSITORY_PREFIX = 'dockerfly/'
+# Files git touches when a clone is fetched or checked out: their mtime tells when the clone was last used
+_CLONE_ACTIVITY_FILES = ('FETCH_HEAD', 'HEAD', 'ORIG_HEAD', 'index')
+
+
+class GCSkipped(Exception):
+    """Raised inside a collection when builds or deployments start: the rest is left for the next run."""
+
+
+def clone_last_used(repo_path: str) -> float:
+    """Last time a clone was fetched or checked out."""
+    git_dir = os.path.join(repo_path, '.git')
+    times = [os.path.getmtime(os.path.join(git_dir, name)) for name in _CLONE_ACTIVITY_FILES
+             if os.path.exists(os.path.join(git_dir, name))]
+    return max(times) if times else os.path.getmtime(repo_path)
+
+
+class GarbageCollector:
+    """
+    Removes what deployments leave behind: app images beyond the last keep_images of each app
+    (older ones are only needed for rollbacks), images of apps that are gone, dangling layers,
+    BuildKit cache over its budget, clones of apps that are gone and generated Dockerfiles left in clones.
+    Images and clones over their disk budget are evicted least recently used first.
+    A collection only runs while no build or deployment is in progress, and stops as soon as one starts.
+    """
+
+    def __init__(self, server: 'Server', keep_images: int = 3, image_budget_bytes: Optional[int] = None,
+                 repo_budget_bytes: Optional[int] = None, build_cache_budget_bytes: Optional[int] = None,
+                 orphan_min_age_seconds: int = 3600):
+        """
+        :param keep_images: Images kept per app, the deployed one included.
+        :param image_budget_bytes: Disk budget of the app images of each node (None: no budget).
+        :param repo_budget_bytes: Disk budget of the clones of deployed apps (None: no budget). Evicted clones are cloned again on their next update.
+        :param build_cache_budget_bytes: BuildKit cache kept on each node (None: left to the daemon).
+        :param orphan_min_age_seconds: Untracked clones younger than this may belong to a deployment in progress.
+        """
+        self.server = server
+        self.keep_images = max(1, keep_images)
+        self.image_budget_bytes = image_budget_bytes
+        self.repo_budget_bytes = repo_budget_bytes
+        self.build_cache_budget_bytes = build_cache_budget_bytes
+        self.orphan_min_age_seconds = orphan_min_age_seconds
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.skipped_runs = 0
+        self.reclaimed_bytes: Dict[str, int] = {"images": 0, "dangling": 0, "build_cache": 0, "clones": 0}
+        self.last_report: Optional[Dict[str, Any]] = None
+
+    def busy(self) -> bool:
+        """True while a build or a deployment job is in progress."""
+        return self.server.build_admission.stats()['running'] > 0 or self.server.job_queue.pending_count() > 0
+
+    def _check_idle(self):
+        if self.busy():
+            raise GCSkipped("a build or deployment started")
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Runs a collection. Blocking: run it off the event loop.
+        :return: Report of what was removed and the bytes reclaimed.
+        """
+        if not self._lock.acquire(blocking=False):
+            return {"skipped": "a collection is already running"}
+        try:
+            if self.busy():
+                self.skipped_runs += 1
+                log.info("Garbage collection skipped: builds or deployments in progress.")
+                return {"skipped": "builds or deployments in progress"}
+            return self._collect()
+        finally:
+            self._lock.release()
+
+    def _collect(self) -> Dict[str, Any]:
+        start = time.monotonic()
+        report: Dict[str, Any] = {
+            "started_at": time.time(),
+            "images_removed": [],
+            "clones_removed": [],
+            "dockerfiles_removed": 0,
+            "reclaimed_bytes": {"images": 0, "dangling": 0, "build_cache": 0, "clones": 0},
+            "stopped": None,
+        }
+        try:
+            for node in list(self.server.nodes.nodes.values()):
+                if node.healthy:
+                    self._collect_images(node, report)
+            self._collect_clones(report)
+        except GCSkipped as e:
+            report['stopped'] = str(e)
+            log.info(f"Garbage collection stopped early: {e}.")
+
+        report['seconds'] = round(time.monotonic() - start, 3)
+        report['total_reclaimed_bytes'] = sum(report['reclaimed_bytes'].values())
+        for kind, reclaimed in report['reclaimed_bytes'].items():
+            self.reclaimed_bytes[kind] += reclaimed
+        self.runs += 1
+        self.last_report = report
+        log.success(f"Garbage collection done in {report['seconds']}s: {len(report['images_removed'])} image(s), "
+                    f"{len(report['clones_removed'])} clone(s) removed, {report['total_reclaimed_bytes']} bytes reclaimed.")
+        return report
+
+    # Images
+
+    def _tracked_repositories(self) -> Set[str]:
+        return {
+            app_state['image_tag'].rpartition(':')[0]
+            for app_state in list(self.server.deployed_apps.values()) if app_state.get('image_tag')
+        }
+
+    @staticmethod
+    def _layers_size(node: 'DockerNode') -> Optional[int]:
+        try:
+            return node.client.df().get('LayersSize')
+        except Exception as e:
+            log.debug(f"Could not read disk usage of node '{node.name}': {e}")
+            return None
+
+    def _collect_images(self, node: 'DockerNode', report: Dict[str, Any]):
+        client = node.client
+        self._check_idle()
+        layers_before = self._layers_size(node)
+        in_use = {c.get('ImageID') for c in client.api.containers(all=True)}
+        in_use.update(app_state.get('image_id') for app_state in list(self.server.deployed_apps.values()))
+        tracked = self._tracked_repositories()
+
+        # App images grouped by repository (dockerfly/<app>), newest first
+        by_repository: Dict[str, List[Any]] = {}
+        for image in client.images.list():
+            repositories = {tag.rpartition(':')[0] for tag in image.tags}
+            for repository in repositories:
+                if repository.startswith(APP_REPOSITORY_PREFIX) and repository != DependencyImageCache.REPOSITORY:
+                    by_repository.setdefault(repository, []).append(image)
+        for images in by_repository.values():
+            images.sort(key=lambda image: image.attrs.get('Created', ''), reverse=True)
+
+        victims: Dict[str, Any] = {}
+        kept: Dict[str, Any] = {}
+        for repository, images in by_repository.items():
+            # Apps that are gone keep nothing; the others their newest images, for rollbacks
+            keep = self.keep_images if repository in tracked else 0
+            for position, image in enumerate(images):
+                if image.id in in_use or position < keep:
+                    kept[image.id] = image
+                else:
+                    victims[image.id] = image
+
+        if self.image_budget_bytes is not None:
+            # Over budget: drop rollback images too, oldest first. Deployed images are never removed.
+            total = sum(image.attrs.get('Size', 0) for image in kept.values())
+            newest = {images[0].id for images in by_repository.values()}
+            rollback_images = sorted(
+                (image for image in kept.values() if image.id not in in_use and image.id not in newest),
+                key=lambda image: image.attrs.get('Created', ''),
+            )
+            for image in rollback_images:
+                if total <= self.image_budget_bytes:
+                    break
+                victims[image.id] = image
+                total -= image.attrs.get('Size', 0)
+
+        removed_size = 0
+        for image in victims.values():
+            self._check_idle()
+            if self._remove_image(node, image):
+                removed_size += image.attrs.get('Size', 0)
+                report['images_removed'].append({"node": node.name, "image": image.short_id, "tags": image.tags})
+
+        layers_after = self._layers_size(node)
+        if layers_before is not None and layers_after is not None:
+            report['reclaimed_bytes']['images'] += max(0, layers_before - layers_after)
+        else:
+            report['reclaimed_bytes']['images'] += removed_size
+
+        self._check_idle()
+        try:
+            pruned = client.images.prune(filters={'dangling': True})
+            report['reclaimed_bytes']['dangling'] += pruned.get('SpaceReclaimed') or 0
+        except APIError as e:
+            log.warning(f"Could not prune dangling images on node '{node.name}': {e}")
+
+        if self.build_cache_budget_bytes is not None:
+            self._check_idle()
+            try:
+                pruned = client.api.prune_builds(keep_storage=self.build_cache_budget_bytes)
+                report['reclaimed_bytes']['build_cache'] += pruned.get('SpaceReclaimed') or 0
+            except APIError as e:
+                log.warning(f"Could not prune the build cache on node '{node.name}': {e}")
+
+    @staticmethod
+    def _remove_image(node: 'DockerNode', image) -> bool:
+        """Removes an image by untagging it (the last tag deletes it). Images used by a stopped container are kept."""
+        try:
+            for tag in image.tags:
+                node.client.images.remove(tag)
+            log.info(f"Removed image {image.short_id} ({', '.join(image.tags)}) from node '{node.name}'.")
+            return True
+        except NotFound:
+            return True
+        except APIError as e:
+            log.warning(f"Could not remove image {image.short_id} from node '{node.name}': {e}")
+            return False
+
+    # Clones
+
+    def _collect_clones(self, report: Dict[str, Any]):
+        base = self.server.path
+        if not os.path.isdir(base):
+            return
+        apps = dict(self.server.deployed_apps)
+        tracked = {os.path.realpath(app_state['repo_path']): name for name, app_state in apps.items() if app_state.get('repo_path')}
+        now = time.time()
+
+        for entry in os.scandir(base):
+            # .dockerfly holds the state database and the reference mirrors
+            if entry.name == '.dockerfly' or not entry.is_dir(follow_symlinks=False):
+                continue
+            path = os.path.realpath(entry.path)
+            if path in tracked:
+                # Written to the clones by earlier versions; builds now take the Dockerfile from memory
+                generated = os.path.join(path, GENERATED_DOCKERFILE)
+                if os.path.isfile(generated):
+                    os.remove(generated)
+                    report['dockerfiles_removed'] += 1
+                continue
+            if now - entry.stat(follow_symlinks=False).st_mtime < self.orphan_min_age_seconds:
+                continue
+            self._check_idle()
+            self._remove_clone(path, None, report)
+
+        if self.repo_budget_bytes is None:
+            return
+        sizes = {path: directory_size(path) for path in tracked if os.path.isdir(path)}
+        total = sum(sizes.values())
+        for path in sorted(sizes, key=clone_last_used):
+            if total <= self.repo_budget_bytes:
+                break
+            container_name = tracked[path]
+            if self.server.job_queue.active_job(normalize_repo_url(apps[container_name]['repo_url'])) is not None:
+                continue
+            self._check_idle()
+            if self._remove_clone(path, container_name, report, sizes[path]):
+                total -= sizes[path]
+
+    @staticmethod
+    def _remove_clone(path: str, container_name: Optional[str], report: Dict[str, Any], size: Optional[int] = None) -> bool:
+        size = directory_size(path) if size is None else size
+        try:
+            shutil.rmtree(path)
+        except OSError as e:
+            log.warning(f"Could not remove clone '{path}': {e}")
+            return False
+        reason = f"least recently used clone of '{container_name}'" if container_name else "no app deployed from it"
+        log.info(f"Removed clone '{path}' ({size} bytes, {reason}).")
+        report['clones_removed'].append({"path": path, "app": container_name, "size_bytes": size})
+        report['reclaimed_bytes']['clones'] += size
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "keep_images": self.keep_images,
+            "image_budget_bytes": self.image_budget_bytes,
+            "repo_budget_bytes": self.repo_budget_bytes,
+            "build_cache_budget_bytes": self.build_cache_budget_bytes,
+            "runs": self.runs,
+            "skipped_runs": self.skipped_runs,
+            "reclaimed_bytes": dict(self.reclaimed_bytes),
+            "last_run": self.last_report,
+        }
@@ -0,0 +1,309 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from loguru import logger as log
+
+# How JobQueue.submit merges a job into one with the same key (see submit)
+DEDUPE_MODES = ('attach', 'follow_up')
+
+# Job currently executed by the calling worker thread (if any)
+_current = threading.local()
+
+
+class DeploymentError(Exception):
+    """
+    Raised by a job function to mark the job as failed with a readable message.
+    :param reason: Short failure category (e.g. 'clone_failed'), used as a metrics label.
+    """
+
+    def __init__(self, message: str, reason: str = 'error'):
+        super().__init__(message)
+        self.reason = reason
+
+
+class DeploymentJob:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    def __init__(self, kind: str, target: str, max_log_lines: int = 2000):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.target = target
+        self.status = self.QUEUED
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.phases: Dict[str, float] = {}
+        self.result: Optional[Dict[str, Any]] = None
+        self.error: Optional[str] = None
+        # Phase being executed when the job failed, and why
+        self.last_phase: Optional[str] = None
+        self.failure_reason: Optional[str] = None
+        # Ring buffer of (sequence, line): memory stays flat however long the build output is
+        self._logs: deque = deque(maxlen=max_log_lines)
+        self._log_seq = 0
+        self._log_lock = threading.Lock()
+        self._callbacks: List[Callable[['DeploymentJob'], None]] = []
+        self._callbacks_lock = threading.Lock()
+
+    def add_log(self, line: str):
+        with self._log_lock:
+            for part in str(line).splitlines():
+                if part.strip():
+                    self._log_seq += 1
+                    self._logs.append((self._log_seq, part.rstrip()))
+
+    def logs_since(self, seq: int) -> List[Tuple[int, str]]:
+        """Returns the buffered log lines with a sequence number greater than seq."""
+        with self._log_lock:
+            return [entry for entry in self._logs if entry[0] > seq]
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (self.SUCCEEDED, self.FAILED)
+
+    def add_done_callback(self, fn: Callable[['DeploymentJob'], None]):
+        """Calls fn(job) once the job succeeded or failed, right away if it already did."""
+        with self._callbacks_lock:
+            if not self.finished:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _run_callbacks(self):
+        with self._callbacks_lock:
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                log.warning(f"Job {self.id} done callback failed: {e}")
+
+    @contextmanager
+    def phase(self, name: str):
+        """Measures the wall-clock duration of a pipeline phase (clone, generate, deploy...)."""
+        self.last_phase = name
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases[name] = round(time.monotonic() - start, 3)
+
+    def to_dict(self) -> Dict[str, Any]:
+        queued_seconds = None
+        run_seconds = None
+        if self.started_at:
+            queued_seconds = round(self.started_at - self.created_at, 3)
+            if self.finished_at:
+                run_seconds = round(self.finished_at - self.started_at, 3)
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "target": self.target,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "timings": {
+                "queued_seconds": queued_seconds,
+                "run_seconds": run_seconds,
+                "phases": dict(self.phases),
+            },
+            "result": self.result,
+            "error": self.error,
+            "failure": {"phase": self.last_phase, "reason": self.failure_reason} if self.status == self.FAILED else None,
+        }
+
+
+def current_job() -> Optional[DeploymentJob]:
+    """Returns the job being executed by the current worker thread, or None."""
+    return getattr(_current, 'job', None)
+
+
+def job_log(line: str):
+    """Appends a line to the log stream of the current job. Does nothing outside of a worker thread."""
+    job = current_job()
+    if job is not None:
+        job.add_log(line)
+
+
+@contextmanager
+def track_phase(name: str):
+    """Times a phase on the current job. Does nothing outside of a worker thread."""
+    job = current_job()
+    if job is None:
+        yield
+        return
+    job.add_log(f"--- {name} ---")
+    with job.phase(name):
+        yield
+
+
+class JobQueue:
+    """
+    Runs deployment jobs on a bounded pool of worker threads so that blocking
+    git and docker calls never run on the event loop.
+    """
+
+    def __init__(self, max_workers: int = 4, max_finished_jobs: int = 1000,
+                 on_finished: Optional[Callable[[DeploymentJob], None]] = None):
+        """
+        :param on_finished: Called with every job once it succeeded or failed (e.g. to record metrics).
+        """
+        self.max_workers = max(1, max_workers)
+        self.max_finished_jobs = max_finished_jobs
+        self.on_finished = on_finished
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='dockerfly-job')
+        self._jobs: "OrderedDict[str, DeploymentJob]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Per key: job submitted to the executor, and jobs waiting for it to finish
+        self._active: Dict[str, DeploymentJob] = {}
+        self._waiting: Dict[str, deque] = {}
+        self.stats_counters = {"attached": 0, "coalesced": 0, "follow_ups": 0}
+        log.info(f'Job queue started with {self.max_workers} worker(s).')
+
+    def submit(self, kind: str, target: str, fn: Callable[..., Optional[Dict[str, Any]]], *args,
+               key: Optional[str] = None, dedupe: Optional[str] = None, **kwargs) -> DeploymentJob:
+        """
+        Enqueues fn(*args, **kwargs) as a new job and returns it immediately.
+        :param kind: Type of job (e.g. 'deploy', 'update').
+        :param target: Repository URL or app the job works on.
+        :param key: Jobs with the same key never run at the same time; they wait for each other in order.
+        :param dedupe: What to do when a job of the same kind and key is already queued or running:
+            'attach' returns the existing job (queued or running),
+            'follow_up' returns a queued job if there is one, or else queues a single job to run after
+            the running one (so that it sees the changes that arrived in the meantime).
+        """
+        job = DeploymentJob(kind, target)
+        with self._lock:
+            if key is not None and dedupe in DEDUPE_MODES:
+                existing = self._find_duplicate(key, kind, target, dedupe)
+                if existing is not None:
+                    self.stats_counters['attached' if existing.status == DeploymentJob.RUNNING else 'coalesced'] += 1
+                    log.info(f"Job {existing.id} ({kind}) already {existing.status} for '{target}'. Request merged into it.")
+                    return existing
+            self._jobs[job.id] = job
+            self._evict_finished()
+            start_now = key is None or key not in self._active
+            blocking_job = None if start_now else self._active[key]
+            if key is not None:
+                if start_now:
+                    self._active[key] = job
+                else:
+                    self._waiting.setdefault(key, deque()).append((job, fn, args, kwargs))
+                    if dedupe == 'follow_up':
+                        self.stats_counters['follow_ups'] += 1
+        if start_now:
+            log.info(f"Job {job.id} ({kind}) queued for '{target}'.")
+            self._executor.submit(self._run, job, fn, args, kwargs, key)
+        else:
+            log.info(f"Job {job.id} ({kind}) queued for '{target}' after job {blocking_job.id}.")
+        return job
+
+    def _find_duplicate(self, key: str, kind: str, target: str, dedupe: str) -> Optional[DeploymentJob]:
+        active = self._active.get(key)
+        if active is None:
+            return None
+        candidates = [active] + [entry[0] for entry in self._waiting.get(key, ())]
+        same = [job for job in candidates if job.kind == kind and job.target == target]
+        queued = [job for job in same if job.status == DeploymentJob.QUEUED]
+        if queued:
+            # Not started yet: it will deploy the latest commit anyway
+            return queued[-1]
+        if dedupe == 'attach' and active in same and not active.finished:
+            return active
+        return None
+
+    def active_job(self, key: str) -> Optional[DeploymentJob]:
+        """Job queued or running for a key, if any."""
+        with self._lock:
+            return self._active.get(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                **self.stats_counters,
+                "active_keys": len(self._active),
+                "waiting": sum(len(waiting) for waiting in self._waiting.values()),
+            }
+
+    def get(self, job_id: str) -> Optional[DeploymentJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def pending_count(self) -> int:
+        """Number of jobs queued or running."""
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.finished)
+
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait, cancel_futures=not wait)
+
+    def _run(self, job: DeploymentJob, fn: Callable, args: tuple, kwargs: dict, key: Optional[str] = None):
+        _current.job = job
+        job.status = DeploymentJob.RUNNING
+        job.started_at = time.time()
+        log.info(f"Job {job.id} ({job.kind}) started for '{job.target}'.")
+        try:
+            job.result = fn(*args, **kwargs)
+            job.finished_at = time.time()
+            job.status = DeploymentJob.SUCCEEDED
+            log.success(f"Job {job.id} ({job.kind}) finished for '{job.target}'.")
+        except DeploymentError as e:
+            job.error = str(e)
+            job.failure_reason = e.reason
+            job.add_log(f"ERROR: {e}")
+            job.finished_at = time.time()
+            job.status = DeploymentJob.FAILED
+            log.error(f"Job {job.id} ({job.kind}) failed for '{job.target}': {e}")
+        except Exception as e:
+            job.error = f"Unexpected error: {e}"
+            job.failure_reason = type(e).__name__
+            job.add_log(f"ERROR: {job.error}")
+            job.finished_at = time.time()
+            job.status = DeploymentJob.FAILED
+            log.exception(f"Unexpected error in job {job.id} ({job.kind}) for '{job.target}': {e}")
+        finally:
+            _current.job = None
+            if self.on_finished is not None:
+                try:
+                    self.on_finished(job)
+                except Exception as e:
+                    log.warning(f"Job {job.id} finish callback failed: {e}")
+            job._run_callbacks()
+            if key is not None:
+                self._start_next(key)
+
+    def _start_next(self, key: str):
+        """Hands the next job waiting on a key to the executor once the previous one finished."""
+        with self._lock:
+            waiting = self._waiting.get(key)
+            if not waiting:
+                self._active.pop(key, None)
+                self._waiting.pop(key, None)
+                return
+            job, fn, args, kwargs = waiting.popleft()
+            self._active[key] = job
+        log.info(f"Job {job.id} ({job.kind}) for '{job.target}' can start now.")
+        try:
+            self._executor.submit(self._run, job, fn, args, kwargs, key)
+        except RuntimeError:
+            # The queue is shutting down
+            job.error = "Server shutting down"
+            job.finished_at = time.time()
+            job.status = DeploymentJob.FAILED
+            job._run_callbacks()
+
+    def _evict_finished(self):
+        # Keep memory bounded: forget the oldest finished jobs first
+        excess = len(self._jobs) - self.max_finished_jobs
+        if excess <= 0:
+            return
+        for job_id in [jid for jid, job in self._jobs.items() if job.finished][:excess]:
+            del self._jobs[job_id]
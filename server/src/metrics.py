@@ -0,0 +1,133 @@
+from typing import TYPE_CHECKING
+from prometheus_client import REGISTRY, Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from .jobs import DeploymentJob
+
+if TYPE_CHECKING:
+    from .server import Server
+
+# Phases go from sub-second (generate) to many minutes (build)
+_PHASE_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200, float('inf'))
+
+PHASE_DURATION = Histogram(
+    'dockerfly_phase_duration_seconds', 'Duration of each phase of the deployment jobs (clone, generate, build, start...).',
+    ['kind', 'phase'], buckets=_PHASE_BUCKETS,
+)
+JOB_DURATION = Histogram(
+    'dockerfly_job_duration_seconds', 'Run time of deployment jobs, from start to finish.',
+    ['kind', 'status'], buckets=_PHASE_BUCKETS,
+)
+JOBS = Counter('dockerfly_jobs', 'Finished deployment jobs.', ['kind', 'status'])
+JOB_FAILURES = Counter('dockerfly_job_failures', 'Failed deployment jobs, by failing phase and reason.', ['kind', 'phase', 'reason'])
+UPDATE_CHECK_DURATION = Histogram(
+    'dockerfly_update_check_duration_seconds', 'Duration of a full update check over all deployed apps.',
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, float('inf')),
+)
+REMOTE_CHECK_DURATION = Histogram(
+    'dockerfly_remote_check_duration_seconds', 'Duration of the remote head check (git ls-remote) of one app.',
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, float('inf')),
+)
+
+TIME_TO_FIRST_RESPONSE = Histogram(
+    'dockerfly_time_to_first_response_seconds', 'Time from a deployment request until the new version answers.',
+    ['kind'], buckets=_PHASE_BUCKETS,
+)
+BUILD_QUEUE_WAIT = Histogram(
+    'dockerfly_build_queue_wait_seconds', 'Time builds waited for a build slot, by lane (user, scheduler).',
+    ['lane'], buckets=(0.01, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, float('inf')),
+)
+AUTOSCALE_ACTIONS = Counter('dockerfly_autoscale_actions', 'Scales started by the autoscaling rules, by direction.', ['direction'])
+BUILD_TIMEOUTS = Counter('dockerfly_build_timeouts', 'Builds cancelled for running longer than their timeout.', ['lane'])
+
+
+def observe_job(job: DeploymentJob):
+    """Records the phases and outcome of a finished job. Meant as JobQueue on_finished callback."""
+    for phase, seconds in job.phases.items():
+        PHASE_DURATION.labels(job.kind, phase).observe(seconds)
+    JOBS.labels(job.kind, job.status).inc()
+    if job.started_at and job.finished_at:
+        JOB_DURATION.labels(job.kind, job.status).observe(job.finished_at - job.started_at)
+    if job.status == DeploymentJob.FAILED:
+        JOB_FAILURES.labels(job.kind, job.last_phase or 'none', job.failure_reason or 'error').inc()
+
+
+class ServerCollector:
+    """Gauges read from the server state at scrape time: apps, queue depth, image and build context sizes, nodes."""
+
+    def __init__(self, server: 'Server'):
+        self.server = server
+
+    def collect(self):
+        apps = dict(self.server.deployed_apps)
+        yield GaugeMetricFamily('dockerfly_deployed_apps', 'Apps tracked by the server.', value=len(apps))
+
+        queue_stats = self.server.job_queue.stats()
+        yield GaugeMetricFamily('dockerfly_jobs_pending', 'Deployment jobs queued or running.', value=self.server.job_queue.pending_count())
+        yield GaugeMetricFamily('dockerfly_jobs_waiting', 'Jobs waiting for another job of the same repository.', value=queue_stats['waiting'])
+        merged = CounterMetricFamily('dockerfly_jobs_merged', 'Requests merged into a job already queued or running.', labels=['mode'])
+        for mode in ('attached', 'coalesced', 'follow_ups'):
+            merged.add_metric([mode], queue_stats[mode])
+        yield merged
+
+        image_size = GaugeMetricFamily('dockerfly_app_image_size_bytes', 'Size of the deployed image of each app.', labels=['app'])
+        context_size = GaugeMetricFamily('dockerfly_app_build_context_bytes', 'Size of the build context of the last build of each app.', labels=['app'])
+        replicas = GaugeMetricFamily('dockerfly_app_replicas', 'Running replicas of each app.', labels=['app'])
+        for container_name, app_state in apps.items():
+            if app_state.get('image_size_bytes') is not None:
+                image_size.add_metric([container_name], app_state['image_size_bytes'])
+            if app_state.get('build_context_bytes') is not None:
+                context_size.add_metric([container_name], app_state['build_context_bytes'])
+            replicas.add_metric([container_name], len(app_state.get('replicas') or []))
+        yield image_size
+        yield context_size
+        yield replicas
+
+        cpu = GaugeMetricFamily('dockerfly_app_cpu_percent', 'CPU of each app in the last telemetry sample, summed over its replicas.', labels=['app'])
+        memory = GaugeMetricFamily('dockerfly_app_memory_bytes', 'Memory of each app in the last telemetry sample, summed over its replicas.', labels=['app'])
+        for container_name, sample in self.server.telemetry.latest().items():
+            if sample['cpu_percent'] is not None:
+                cpu.add_metric([container_name], sample['cpu_percent'])
+            memory.add_metric([container_name], sample['memory_bytes'] or 0)
+        yield cpu
+        yield memory
+
+        healthy = GaugeMetricFamily('dockerfly_node_healthy', 'Whether each docker node passed its last health checks.', labels=['node'])
+        builds = GaugeMetricFamily('dockerfly_node_active_builds', 'Builds in progress on each docker node.', labels=['node'])
+        running = GaugeMetricFamily('dockerfly_node_running_containers', 'Running containers on each docker node.', labels=['node'])
+        for node in self.server.nodes.nodes.values():
+            healthy.add_metric([node.name], 1 if node.healthy else 0)
+            builds.add_metric([node.name], node.active_builds)
+            running.add_metric([node.name], node.running_containers)
+        yield healthy
+        yield builds
+        yield running
+
+        build_stats = self.server.build_admission.stats()
+        builds_running = GaugeMetricFamily('dockerfly_builds_running', 'Builds holding a build slot, by lane.', labels=['lane'])
+        builds_waiting = GaugeMetricFamily('dockerfly_builds_waiting', 'Builds waiting for a build slot, by lane.', labels=['lane'])
+        for lane, lane_stats in build_stats['lanes'].items():
+            builds_running.add_metric([lane], lane_stats['running'])
+            builds_waiting.add_metric([lane], lane_stats['waiting'])
+        yield builds_running
+        yield builds_waiting
+
+        gc_stats = self.server.gc.stats()
+        reclaimed = CounterMetricFamily('dockerfly_gc_reclaimed_bytes', 'Disk space reclaimed by the garbage collector.', labels=['kind'])
+        for kind, reclaimed_bytes in gc_stats['reclaimed_bytes'].items():
+            reclaimed.add_metric([kind], reclaimed_bytes)
+        yield reclaimed
+        gc_runs = CounterMetricFamily('dockerfly_gc_runs', 'Garbage collections, by outcome.', labels=['outcome'])
+        gc_runs.add_metric(['completed'], gc_stats['runs'])
+        gc_runs.add_metric(['skipped'], gc_stats['skipped_runs'])
+        yield gc_runs
+
+        poll_stats = self.server.poll_stats
+        poll = CounterMetricFamily('dockerfly_update_checks', 'Outcomes of the update polling.', labels=['outcome'])
+        for outcome in ('skipped_ticks', 'overrun_ticks', 'timeouts', 'errors', 'backed_off', 'updates_dispatched'):
+            poll.add_metric([outcome], poll_stats[outcome])
+        yield poll
+
+
+def register_server(server: 'Server', registry=REGISTRY):
+    """Exposes the gauges of a server in the registry served at /metrics."""
+    registry.register(ServerCollector(server))
@@ -0,0 +1,305 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+import docker
+from docker.tls import TLSConfig
+from loguru import logger as log
+
+NODE_ROLES = ('build', 'run')
+LOCAL_NODE = 'local'
+
+# Memory assumed for containers without a memory limit when placing apps
+DEFAULT_CONTAINER_MEMORY = 256 * 1024 ** 2
+# A node missing the image counts as this many extra containers (the pull is not free)
+IMAGE_MISSING_PENALTY = 2.0
+
+_MEMORY = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([bkmg]?)b?\s*$', re.IGNORECASE)
+_MEMORY_UNITS = {'': 1, 'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+
+class NodeError(Exception):
+    """Raised when no node can take a build or an app, or an image cannot be moved between nodes."""
+
+
+def parse_memory(value: Any) -> Optional[int]:
+    """Bytes of a docker memory value ('512m', '1g', 268435456)."""
+    if isinstance(value, int):
+        return value
+    match = _MEMORY.match(str(value or ''))
+    if not match:
+        return None
+    return int(float(match.group(1)) * _MEMORY_UNITS[match.group(2).lower()])
+
+
+class DockerNode:
+    """A docker daemon of the pool, with its roles and the health and load seen by the last check."""
+
+    def __init__(self, name: str, client, base_url: Optional[str] = None, roles=NODE_ROLES,
+                 probe_host: Optional[str] = None, failure_threshold: int = 2, tls: Optional[Dict[str, Any]] = None,
+                 client_factory: Optional[Callable[[], Any]] = None):
+        """:param client_factory: Creates another client of the daemon, with connections of its own (see build_client)."""
+        self.name = name
+        self.client = client
+        self.client_factory = client_factory
+        self.base_url = base_url
+        # 'tls' entry of the node in config.yml, also needed by the docker CLI (BuildKit builds)
+        self.tls = tls if isinstance(tls, dict) else None
+        self.roles = set(roles)
+        # Host where the published ports of the node are reachable from the server
+        self.probe_host = probe_host or (urlparse(base_url).hostname if base_url and not base_url.startswith('unix') else None)
+        self.failure_threshold = failure_threshold
+
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.last_error: Optional[str] = None
+        self.last_check_at: Optional[float] = None
+        self.ping_seconds: Optional[float] = None
+        self.memory_total: Optional[int] = None
+        self.running_containers = 0
+        self.active_builds = 0
+
+    @property
+    def is_local(self) -> bool:
+        return self.base_url is None
+
+    def check(self):
+        """Pings the daemon and refreshes its load. A node is unhealthy after failure_threshold failed checks in a row."""
+        start = time.monotonic()
+        try:
+            self.client.ping()
+            self.ping_seconds = round(time.monotonic() - start, 4)
+            info = self.client.info()
+            self.memory_total = info.get('MemTotal')
+            self.running_containers = info.get('ContainersRunning', 0)
+            if not self.healthy:
+                log.success(f"Docker node '{self.name}' is healthy again.")
+            self.healthy = True
+            self.consecutive_failures = 0
+            self.last_error = None
+        except Exception as e:
+            self.consecutive_failures += 1
+            self.last_error = str(e)
+            if self.healthy and self.consecutive_failures >= self.failure_threshold:
+                log.error(f"Docker node '{self.name}' marked unhealthy after {self.consecutive_failures} failed checks: {e}")
+                self.healthy = False
+            else:
+                log.warning(f"Health check of docker node '{self.name}' failed: {e}")
+        finally:
+            self.last_check_at = time.time()
+
+    def build_client(self) -> Tuple[Any, bool]:
+        """
+        Client for a build that may be cancelled: a new one when the node can create it, so dropping
+        the connection of the build and closing its session leaves the other calls to the daemon alone.
+        :return: The client, and whether it is a new one (closed by the caller after the build).
+        """
+        if self.client_factory is None:
+            return self.client, False
+        return self.client_factory(), True
+
+    def has_image(self, image_ref: str) -> bool:
+        try:
+            self.client.images.get(image_ref)
+            return True
+        except Exception:
+            return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "url": self.base_url or 'local',
+            "roles": sorted(self.roles),
+            "healthy": self.healthy,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "last_check_at": self.last_check_at,
+            "ping_seconds": self.ping_seconds,
+            "memory_total": self.memory_total,
+            "running_containers": self.running_containers,
+            "active_builds": self.active_builds,
+        }
+
+
+def client_from_config(node_config: Dict[str, Any]):
+    """docker-py client for a node entry of config.yml (tcp://, ssh:// or unix:// url, optional TLS)."""
+    url = node_config['url']
+    tls = None
+    tls_config = node_config.get('tls')
+    if isinstance(tls_config, dict):
+        tls = TLSConfig(
+            client_cert=(tls_config['client_cert'], tls_config['client_key']) if tls_config.get('client_cert') else None,
+            ca_cert=tls_config.get('ca_cert'),
+            verify=tls_config.get('verify', True),
+        )
+    return docker.DockerClient(base_url=url, tls=tls, use_ssh_client=url.startswith('ssh://'), timeout=node_config.get('timeout', 60))
+
+
+class NodePool:
+    """
+    The docker daemons DockerFly builds and runs apps on. Build nodes build the images and
+    push them to the registry; run nodes pull them and run the containers. Without nodes
+    configured, the pool is the local daemon doing both.
+    """
+
+    def __init__(self, nodes: List[DockerNode], registry: Optional[str] = None):
+        if not nodes:
+            raise ValueError('The node pool needs at least one node.')
+        self.nodes: Dict[str, DockerNode] = {node.name: node for node in nodes}
+        self.registry = registry.rstrip('/') if registry else None
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=min(16, len(nodes)), thread_name_prefix='dockerfly-nodes')
+
+    @classmethod
+    def from_config(cls, nodes_config: Optional[List[Dict[str, Any]]], local_client, registry: Optional[str] = None,
+                    client_factory: Callable[[Dict[str, Any]], Any] = client_from_config,
+                    local_client_factory: Optional[Callable[[], Any]] = None) -> 'NodePool':
+        """
+        :param nodes_config: 'docker.nodes' entries of config.yml (name, url, roles, probe_host, tls).
+        :param local_client: Client of the local daemon, used when no nodes are configured.
+        :param client_factory: Creates the client of a node entry. Builds get clients of their own only
+            with the default one: other factories may return shared clients.
+        :param local_client_factory: Creates new clients of the local daemon.
+        """
+        if not nodes_config:
+            return cls([DockerNode(LOCAL_NODE, local_client, client_factory=local_client_factory)], registry)
+
+        nodes = []
+        for node_config in nodes_config:
+            roles = node_config.get('roles', list(NODE_ROLES))
+            if not node_config.get('name') or not node_config.get('url') or not set(roles) <= set(NODE_ROLES):
+                raise ValueError(f"Invalid docker node {node_config}: 'name', 'url' and 'roles' ({', '.join(NODE_ROLES)}) are required.")
+            build_clients = partial(client_from_config, node_config) if client_factory is client_from_config else None
+            nodes.append(DockerNode(node_config['name'], client_factory(node_config), node_config['url'], roles,
+                                    node_config.get('probe_host'), node_config.get('failure_threshold', 2), node_config.get('tls'),
+                                    build_clients))
+        if not any('build' in node.roles for node in nodes) or not any('run' in node.roles for node in nodes):
+            raise ValueError("The docker nodes need at least one 'build' and one 'run' node.")
+        if not registry and not any(node.roles >= set(NODE_ROLES) for node in nodes):
+            raise ValueError("Separate build and run nodes need a registry ('docker.registry') to move images.")
+        described = ', '.join(f"{node.name} ({'/'.join(sorted(node.roles))})" for node in nodes)
+        log.info(f"Docker node pool: {described}" + (f", registry {registry}" if registry else ''))
+        return cls(nodes, registry)
+
+    def get(self, name: Optional[str]) -> Optional[DockerNode]:
+        return self.nodes.get(name) if name else None
+
+    @property
+    def default(self) -> DockerNode:
+        """Node used for what is not placed (e.g. the shared dependency images): the local daemon, or the first node."""
+        return self.nodes.get(LOCAL_NODE) or next(iter(self.nodes.values()))
+
+    def check_health(self):
+        """Checks every node in parallel. Blocking: run it off the event loop."""
+        list(self._executor.map(DockerNode.check, self.nodes.values()))
+
+    def pick_build_node(self, prefer: Optional[str] = None, needs_run_role: bool = False,
+                        required: Optional[str] = None) -> DockerNode:
+        """
+        The healthy build node with the fewest builds in progress (then the fewest containers).
+        :param prefer: Node to use if it can build, e.g. where the app runs when there is no registry.
+        :param needs_run_role: Only nodes that can also run the image (no registry to move it).
+        :param required: The only node the image can be built on (e.g. the one with its base image).
+        """
+        candidates = [
+            node for node in self.nodes.values()
+            if node.healthy and 'build' in node.roles and (not needs_run_role or 'run' in node.roles)
+            and (not required or node.name == required)
+        ]
+        if not candidates:
+            raise NodeError(f"Build node '{required}' is not available." if required else "No healthy build node available.")
+        preferred = self.nodes.get(prefer) if prefer else None
+        if preferred in candidates:
+            return preferred
+        return min(candidates, key=lambda node: (node.active_builds, node.running_containers))
+
+    def pick_run_node(self, image_id: str, build_node: DockerNode, memory_needed: int,
+                      reserved_memory: Dict[str, int], current: Optional[str] = None) -> DockerNode:
+        """
+        Places an app. Its current node is kept while it is healthy and has room, so redeploys
+        do not move apps around. Otherwise the node with the lowest score wins: running
+        containers, plus the share of memory already reserved, plus a penalty if the image has
+        to be pulled.
+        :param reserved_memory: Memory reserved by the apps already placed, by node name.
+        """
+        if not self.registry:
+            # The image cannot leave the node it was built on
+            if 'run' not in build_node.roles:
+                raise NodeError(f"Build node '{build_node.name}' cannot run apps and there is no registry to move the image.")
+            return build_node
+
+        def free_memory(node: DockerNode) -> Optional[int]:
+            if not node.memory_total:
+                return None
+            return node.memory_total - reserved_memory.get(node.name, 0)
+
+        candidates = []
+        for node in self.nodes.values():
+            if not node.healthy or 'run' not in node.roles:
+                continue
+            free = free_memory(node)
+            if free is not None and free < memory_needed:
+                log.debug(f"Node '{node.name}' has {free} bytes free, {memory_needed} needed. Skipped.")
+                continue
+            candidates.append(node)
+        if not candidates:
+            raise NodeError(f"No healthy run node with {memory_needed // 1024 ** 2} MiB free.")
+
+        current_node = self.nodes.get(current) if current else None
+        if current_node in candidates:
+            return current_node
+
+        def score(node: DockerNode) -> float:
+            reserved_ratio = reserved_memory.get(node.name, 0) / node.memory_total if node.memory_total else 0.0
+            missing = 0.0 if node is build_node or node.has_image(image_id) else IMAGE_MISSING_PENALTY
+            return node.running_containers + 10 * reserved_ratio + missing
+
+        return min(candidates, key=score)
+
+    @contextmanager
+    def building(self, node: DockerNode):
+        """Counts a build in progress on a node while the block runs."""
+        with self._lock:
+            node.active_builds += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                node.active_builds -= 1
+
+    def transfer_image(self, image_tag: str, source: DockerNode, target: DockerNode):
+        """
+        Makes an image built on source available on target under the same tag, through the registry.
+        Raises NodeError on failure.
+        """
+        if source is target:
+            return
+        if not self.registry:
+            raise NodeError(f"Cannot move '{image_tag}' from '{source.name}' to '{target.name}': no registry configured.")
+        repository, _, tag = image_tag.rpartition(':')
+        registry_repository = f"{self.registry}/{repository}"
+        try:
+            start = time.monotonic()
+            source.client.images.get(image_tag).tag(registry_repository, tag)
+            for line in source.client.images.push(registry_repository, tag=tag, stream=True, decode=True):
+                if 'error' in line:
+                    raise NodeError(f"Push of {registry_repository}:{tag} from '{source.name}' failed: {line['error']}")
+            target.client.images.pull(registry_repository, tag=tag).tag(repository, tag)
+            log.info(f"Image '{image_tag}' moved from '{source.name}' to '{target.name}' in {time.monotonic() - start:.1f}s.")
+        except NodeError:
+            raise
+        except Exception as e:
+            raise NodeError(f"Could not move '{image_tag}' from '{source.name}' to '{target.name}': {e}") from e
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "registry": self.registry,
+            "nodes": [node.to_dict() for node in self.nodes.values()],
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
@@ -0,0 +1,56 @@
+import http.client
+import socket
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from loguru import logger as log
+
+PROBE_TYPES = ('tcp', 'http')
+
+
+def probe_once(host: str, port: int, probe_type: str = 'tcp', path: str = '/', timeout: float = 2.0) -> bool:
+    """
+    Single readiness check against host:port.
+    TCP probes succeed when the port accepts connections, HTTP probes when the
+    path answers with a status below 500.
+    """
+    try:
+        if probe_type == 'http':
+            connection = http.client.HTTPConnection(host, port, timeout=timeout)
+            try:
+                connection.request('GET', path)
+                return connection.getresponse().status < 500
+            finally:
+                connection.close()
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except (OSError, http.client.HTTPException):
+        return False
+
+
+def wait_until_ready(addresses: List[Tuple[str, int]], readiness: Dict[str, Any],
+                     is_alive: Optional[Callable[[], bool]] = None) -> Optional[float]:
+    """
+    Probes the addresses of a container until one of them answers.
+    :param addresses: (host, port) pairs where the container may be reachable.
+    :param readiness: 'readiness' section of dockerfly.yaml (type, path, timeout, interval).
+    :param is_alive: Checked between attempts; the wait is aborted if it returns False.
+    :return: Seconds until the container was ready, or None if it never was.
+    """
+    probe_type = readiness.get('type', 'http' if readiness.get('path') else 'tcp')
+    path = readiness.get('path', '/')
+    timeout = float(readiness.get('timeout', 60))
+    interval = float(readiness.get('interval', 1))
+
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        for host, port in addresses:
+            if probe_once(host, port, probe_type, path, timeout=min(interval * 2, 5)):
+                elapsed = time.monotonic() - start
+                log.debug(f"Readiness probe ({probe_type}) succeeded on {host}:{port} after {elapsed:.2f}s.")
+                return elapsed
+        if is_alive is not None and not is_alive():
+            log.warning("Container stopped while waiting for it to become ready.")
+            return None
+        time.sleep(interval)
+    log.warning(f"Readiness probe ({probe_type}) timed out after {timeout}s on {addresses}.")
+    return None
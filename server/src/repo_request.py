@@ -1,4 +1,6 @@
 from pydantic import BaseModel
+from typing import Literal, Optional
 
 class RepoRequest(BaseModel):
-    url: str
\ No newline at end of file
+    url: str
+    clone_strategy: Optional[Literal['full', 'shallow', 'partial', 'reference']] = None
@@ -0,0 +1,4 @@
+from pydantic import BaseModel, Field
+
+class ScaleRequest(BaseModel):
+    replicas: int = Field(ge=1)
@@ -1,18 +1,79 @@
-from git import Repo, GitCommandError
+from git import Git, Repo, GitCommandError
 import os
+import time
+import asyncio
+import threading
+import queue
 import yaml
 from loguru import logger as log
 import io
 import shutil
-from typing import Optional, Tuple, Dict, Any
+from typing import Optional, Tuple, Dict, Any, List, Set, Iterator
+from concurrent.futures import ThreadPoolExecutor
 import docker
 from docker.errors import BuildError, APIError, NotFound
 from git.remote import FetchInfo
+from git.util import RemoteProgress
+from .jobs import JobQueue, DeploymentJob, DeploymentError, current_job, job_log, track_phase
+from .webhooks import normalize_repo_url
+from .dockerfile import BUILD_MODES, DEFAULT_PYTHON_VERSION, GENERATED_DOCKERFILE, base_image, pip_install_options, render_deps_image_dockerfile, render_optimized_dockerfile, requirements_hash
+from .deps_cache import DependencyImageCache
+from .wheelhouse import Wheelhouse
+from .telemetry import TelemetryCollector, autoscale_errors
+from .bulk import BulkDeployer, apply_overrides
+from .state_store import StateStore
+from .readiness import PROBE_TYPES, wait_until_ready
+from .clone_strategies import CLONE_STRATEGIES, MirrorCache, clone_options, directory_size, parse_transfer_size, repo_name
+from .fingerprint import CHANGE_BUILD, CHANGE_NONE, CHANGE_RUNTIME, classify_change, config_hash, context_ignore_patterns, text_hash
+from .metrics import REMOTE_CHECK_DURATION, TIME_TO_FIRST_RESPONSE, UPDATE_CHECK_DURATION, observe_job
+from .nodes import DEFAULT_CONTAINER_MEMORY, DockerNode, NodeError, NodePool, parse_memory
+from .admission import BuildAdmission, BuildTimeout, build_limits, lane_for
+from .garbage_collection import GarbageCollector
+from .base_images import BaseImagePuller
+from .buildkit import BuildKitError, build_with_buildkit, buildkit_available
+from .build_context import BuildContextCache, BuildContextError
+
+# Label identifying the containers managed by DockerFly (value: container name of the app)
+APP_LABEL = 'dockerfly.app'
+
+# Replica index of a container within its app
+REPLICA_LABEL = 'dockerfly.replica'
+# Set on the containers started by a blue/green deployment (value: the name they were created with).
+# Labels cannot change, so a candidate stops being one when it is renamed to its replica name.
+CANDIDATE_LABEL = 'dockerfly.candidate'
+# Separates the app name from the replica number and the candidate marker. Container names of
+# apps cannot contain it (see container_name), so they never collide with another app's replicas.
+NAME_SEPARATOR = '_'
+
+DEPLOY_STRATEGIES = ('recreate', 'blue_green')
+EXPOSE_MODES = ('host', 'ephemeral', 'network')
+
+def _cancel_build(response):
+    """
+    Shuts down the connection of a streamed build: the daemon cancels the build and a read blocked
+    on it returns. Without HTTPResponse.shutdown (urllib3 < 2.3) the response is only closed.
+    """
+    shutdown = getattr(response.raw, 'shutdown', None)
+    if shutdown is not None:
+        shutdown()
+    response.close()
+
+
+_GIT_STAGES = {
+    RemoteProgress.COUNTING: 'Counting objects',
+    RemoteProgress.COMPRESSING: 'Compressing objects',
+    RemoteProgress.WRITING: 'Writing objects',
+    RemoteProgress.RECEIVING: 'Receiving objects',
+    RemoteProgress.RESOLVING: 'Resolving deltas',
+    RemoteProgress.FINDING_SOURCES: 'Finding sources',
+    RemoteProgress.CHECKING_OUT: 'Checking out files',
+}
 
 class Server:
 
     # Constructor for the Server class
-    def __init__(self, path: str = '/repositories/', main_config: Dict[str, Any] = None):
+    def __init__(self, path: str = '/repositories/', main_config: Dict[str, Any] = None, max_workers: Optional[int] = None, docker_client=None,
+                 node_clients: Optional[Dict[str, Any]] = None):
         # Path
         try:
             os.makedirs(path, exist_ok=True)
@@ -23,26 +84,220 @@ class Server:
             log.critical(f'Cannot create or access repository base path {path}: {e}')
             raise
 
-        # Docker client
+        # Docker client, and the nodes apps are built and run on (only the local daemon unless config.yml lists nodes)
         try:
-            self.docker_client = docker.from_env()
+            if self.main_config.get('nodes'):
+                factory = {'client_factory': lambda node_config: node_clients[node_config['name']]} if node_clients else {}
+                self.nodes = NodePool.from_config(self.main_config['nodes'], None, self.main_config.get('registry'), **factory)
+                self.docker_client = docker_client or self.nodes.default.client
+            else:
+                self.docker_client = docker_client or docker.from_env()
+                self.nodes = NodePool.from_config(None, self.docker_client, self.main_config.get('registry'),
+                                                  local_client_factory=None if docker_client else docker.from_env)
             self.docker_client.ping()
             log.info('Docker client initialized successfully.')
         except Exception as e:
             log.critical(f'Error initializing Docker client: {e}')
             raise
+        self.nodes.check_health()
+        # Node each app runs on (also kept as 'node' in its state)
+        self._app_nodes: Dict[str, str] = {}
 
         self.deployed_apps: Dict[str, Dict[str, Any]] = {}
+        self.repo_index: Dict[str, Set[str]] = {}
+
+        # Durable state: deployed apps survive restarts of the server container
+        self.state_store = StateStore(self.main_config.get('state_db_path') or os.path.join(path, '.dockerfly', 'state.db'))
+
+        # Build admission: parallel builds, their resource limits and timeout
+        self.build_admission = BuildAdmission(self.main_config.get('max_parallel_builds', 2))
+        self.build_timeout = self.main_config.get('build_timeout_seconds', 1800)
+        self.build_limits = build_limits(self.main_config.get('build_memory'), self.main_config.get('build_cpu_shares'),
+                                         self.main_config.get('build_cpuset_cpus'))
+
+        # Base images (python:<version>-slim) kept pulled on the build nodes
+        self.base_images = BaseImagePuller(self.nodes, self.main_config.get('base_images', []))
+        self.base_image_refresh_interval = self.main_config.get('base_image_refresh_seconds', 6 * 3600)
+
+        # Shared images with pre-installed dependencies, reused as base of the app images
+        self.deps_cache_enabled = self.main_config.get('deps_cache_enabled', False)
+        self.deps_cache = DependencyImageCache(self.docker_client, self.main_config.get('deps_cache_budget_bytes', 10 * 1024 ** 3),
+                                               admission=self.build_admission, build_limits=self.build_limits,
+                                               build_timeout=self.build_timeout)
+
+        # Wheels of the app requirements, served to the builds so they do not download them again
+        self.wheelhouse = Wheelhouse(
+            os.path.join(path, '.dockerfly', 'wheelhouse'), self.main_config.get('wheelhouse_url'), self.docker_client,
+            disk_budget_bytes=self.main_config.get('wheelhouse_budget_bytes', 5 * 1024 ** 3),
+            index_url=self.main_config.get('wheelhouse_index_url'), network=self.main_config.get('build_network'),
+            admission=self.build_admission, build_limits=self.build_limits, build_timeout=self.build_timeout,
+        )
+        # Network of the standard builds, so they reach the wheelhouse of the server
+        self.build_network = self.main_config.get('build_network')
+        # Build contexts read from the git tree of the deployed commit, kept in memory for rebuilds
+        self.build_contexts = BuildContextCache(self.main_config.get('build_context_cache_bytes', 512 * 1024 ** 2))
+
+        # Updates whose build inputs did not change skip the build (and the restart if the config is the same too)
+        self.skip_unchanged_builds = self.main_config.get('skip_unchanged_builds', True)
+
+        # Clone strategy used when the request does not choose one, and shared mirrors for 'reference'
+        self.clone_strategy = self.main_config.get('clone_strategy', 'full')
+        if self.clone_strategy not in CLONE_STRATEGIES:
+            log.warning(f"Unknown clone strategy '{self.clone_strategy}', using 'full'.")
+            self.clone_strategy = 'full'
+        self.mirrors = MirrorCache(os.path.join(path, '.dockerfly', 'mirrors'))
+
+        # Garbage collection of old images, dangling layers and clones of apps that are gone
+        self.gc = GarbageCollector(
+            self,
+            keep_images=self.main_config.get('gc_keep_images', 3),
+            image_budget_bytes=self.main_config.get('gc_image_budget_bytes'),
+            repo_budget_bytes=self.main_config.get('gc_repo_budget_bytes'),
+            build_cache_budget_bytes=self.main_config.get('gc_build_cache_budget_bytes'),
+        )
+        self.gc_interval = self.main_config.get('gc_interval_seconds', 3600)
+
+        # Manifests of many apps, cloned ahead of their deployment jobs
+        self.bulk = BulkDeployer(self, clone_concurrency=self.main_config.get('bulk_clone_concurrency', 8))
+
+        # Resource samples of the app containers, and the autoscaling rules they drive
+        self.telemetry = TelemetryCollector(self, APP_LABEL, CANDIDATE_LABEL, samples=self.main_config.get('telemetry_samples', 240))
+        self.telemetry_interval = self.main_config.get('telemetry_interval_seconds', 15)
 
+        # Worker pool running clone/build/run off the event loop
+        self.job_queue = JobQueue(max_workers=max_workers or min(4, os.cpu_count() or 1), on_finished=observe_job)
+
+        # Host used to reach published container ports from the server (readiness probes)
+        self.probe_host = self.main_config.get('probe_host', 'localhost')
+
+        # Update polling: remote checks run on their own pool, redeploys go to the job queue
+        self.update_interval = self.main_config.get('update_interval_seconds', 60)
+        self.poll_concurrency = self.main_config.get('poll_concurrency', 16)
+        self.poll_timeout = self.main_config.get('poll_timeout_seconds', 20)
+        self._poll_executor = ThreadPoolExecutor(max_workers=self.poll_concurrency, thread_name_prefix='dockerfly-poll')
+
+        # Webhooks: apps are indexed by normalized repository URL (see repo_index)
+        self.webhook_secret = self.main_config.get('webhook_secret')
+        self.webhook_recent_seconds = self.main_config.get('webhook_recent_seconds', 24 * 3600)
+        self.max_poll_backoff = self.main_config.get('max_poll_backoff_seconds', 3600)
+        self._poll_backoff: Dict[str, Tuple[float, float]] = {}
+        self.poll_stats: Dict[str, Any] = {
+            "ticks": 0,
+            "skipped_ticks": 0,
+            "overrun_ticks": 0,
+            "apps_checked": 0,
+            "updates_dispatched": 0,
+            "timeouts": 0,
+            "errors": 0,
+            "backed_off": 0,
+            "last_tick_at": None,
+            "last_tick_seconds": None,
+            "max_tick_seconds": 0.0,
+        }
+
+        try:
+            self.reconcile_state()
+        except Exception as e:
+            log.error(f'Failed to reconcile deployment state at startup: {e}')
 
     def _log_git_progress(self, op_code, cur_count, max_count=None, message=''):
         log.debug(f"Cloning progress: Op={op_code}, Count={cur_count}, Max={max_count or 'N/A'}, Msg='{message.strip() or '...'}'")
+        # Only stage boundaries go to the job log, git reports progress many times per second
+        if op_code & (RemoteProgress.BEGIN | RemoteProgress.END):
+            stage = _GIT_STAGES.get(op_code & RemoteProgress.OP_MASK, 'Progress')
+            state = 'done' if op_code & RemoteProgress.END else 'started'
+            job_log(f"{stage}: {state} ({int(cur_count)}/{int(max_count) if max_count else '?'}) {message.strip()}")
+
+    def _stream_build(self, context: Iterator[bytes], dockerfile: str, image_tag: str, node: Optional[DockerNode] = None,
+                      timeout: Optional[float] = None):
+        """
+        Builds an image with the low-level API, forwarding each output line to the job log
+        as soon as the daemon sends it.
+        The output is read on a worker thread, with a client of its own when the node can create one:
+        when the timeout expires the job stops waiting at once, and the connection of the build is
+        shut down, like the BuildKit path kills its CLI, so the daemon cancels it.
+        :param context: Chunks of the tar of the build context, sent while the daemon reads them (see BuildContextCache).
+        :param node: Build node (default: the default node).
+        :param timeout: Seconds the build may run.
+        :return: The built image. Raises BuildError if the build fails, BuildTimeout if it takes too long.
+        """
+        node = node or self.nodes.default
+        client, own_client = node.build_client()
+        responses = []
+
+        def keep_response(response, *args, **kwargs):
+            responses.append(response)
+
+        if own_client:
+            # The low-level API only returns the output of the build: its response comes from the session of the client
+            client.api.hooks['response'].append(keep_response)
+        chunks: queue.Queue = queue.Queue()
+        end_of_output = object()
+
+        def read_output():
+            try:
+                for chunk in client.api.build(fileobj=context, custom_context=True, dockerfile=dockerfile, tag=image_tag, rm=True,
+                                              forcerm=True, decode=True, container_limits=self.build_limits,
+                                              network_mode=self.build_network, timeout=timeout):
+                    chunks.put(chunk)
+                chunks.put(end_of_output)
+            except Exception as e:
+                chunks.put(e)
+
+        reader = threading.Thread(target=read_output, name=f'dockerfly-build-{image_tag}', daemon=True)
+        deadline = time.monotonic() + timeout if timeout else None
+        build_log = []
+        reader.start()
+        try:
+            while True:
+                try:
+                    chunk = chunks.get(timeout=max(0.0, deadline - time.monotonic()) if deadline else None)
+                except queue.Empty:
+                    raise BuildTimeout(f"Build of '{image_tag}' exceeded {timeout}s") from None
+                if chunk is end_of_output:
+                    break
+                if isinstance(chunk, Exception):
+                    raise chunk
+                build_log.append(chunk)
+                if 'error' in chunk:
+                    job_log(chunk['error'])
+                    raise BuildError(chunk['error'], build_log)
+                if 'stream' in chunk:
+                    line = chunk['stream'].rstrip()
+                    log.debug(line)
+                    job_log(line)
+                elif 'status' in chunk:
+                    job_log(f"{chunk['status']} {chunk.get('progress', '')}".strip())
+        finally:
+            if reader.is_alive():
+                # Dropping the connection makes the daemon cancel a build that is still running; forcerm removes its containers
+                for response in responses:
+                    _cancel_build(response)
+            if own_client:
+                client.api.hooks['response'].remove(keep_response)
+                client.close()
+        return node.client.images.get(image_tag)
 
     # Receives the URL of the repository to clone
-    def clone_git(self, repo_url: str) -> tuple[str, str] | None:
+    def _progress_tracker(self, stats: Dict[str, Any]):
+        """Git progress callback that also records the bytes received into stats."""
+        def progress(op_code, cur_count, max_count=None, message=''):
+            self._log_git_progress(op_code, cur_count, max_count, message)
+            if op_code & RemoteProgress.OP_MASK == RemoteProgress.RECEIVING:
+                received = parse_transfer_size(message)
+                if received is not None:
+                    stats['bytes_received'] = received
+        return progress
+
+    def clone_git(self, repo_url: str, strategy: Optional[str] = None, stats: Optional[Dict[str, Any]] = None,
+                  branch: Optional[str] = None) -> tuple[str, str] | None:
         """
         Clones a Git repository from the given URL into the specified path.
         :param repo_url: URL of the Git repository to clone.
+        :param strategy: Clone strategy (full, shallow, partial or reference). Defaults to the server setting.
+        :param stats: If given, filled with the strategy, duration and bytes transferred by the clone.
+        :param branch: Branch to check out (default: the default branch of the remote). An existing clone
+            is switched to it, or None is returned if it cannot be.
         :return: Tuple containing the path to the cloned repository, the name and URL.
         """
         log.info(f'Received URL in clone_git: "{repo_url}"')
@@ -55,22 +310,36 @@ class Server:
         repo_clone_path = None
 
         try:
-            repo_name = repo_url.split('/')[-1].replace('.git', '')
+            name = repo_name(repo_url)
 
-            if not repo_name:
+            if not name:
                 raise ValueError('Repository name could not be extracted from the URL.')
 
-            repo_clone_path = os.path.join(self.path, repo_name)
+            repo_clone_path = os.path.join(self.path, name)
             log.debug(f'Calculated clone path: {repo_clone_path}')
 
             if os.path.exists(repo_clone_path):
-                log.error(f'Repository {repo_name} already exists. Skipping clone.')
-                # TODO: Decidir si ignorar o actualizar el repositorio existente
-                return repo_clone_path, repo_name, repo_url
+                log.info(f'Repository {name} already exists. Skipping clone.')
+                if branch and not self._checkout_branch(repo_clone_path, branch):
+                    return None
+                return repo_clone_path, name, repo_url
 
-            Repo.clone_from(repo_url, repo_clone_path, progress=self._log_git_progress)
-            log.success(f'Repository cloned successfully to {repo_clone_path}')
-            return repo_clone_path, repo_name, repo_url
+            strategy = strategy or self.clone_strategy
+            stats = stats if stats is not None else {}
+            stats.update({'strategy': strategy, 'bytes_received': None})
+            clone_start = time.monotonic()
+
+            mirror_path = self.mirrors.ensure(repo_url) if strategy == 'reference' else None
+            options = clone_options(strategy, mirror_path)
+            if branch:
+                options['branch'] = branch
+            Repo.clone_from(repo_url, repo_clone_path, progress=self._progress_tracker(stats), **options)
+
+            stats['duration_seconds'] = round(time.monotonic() - clone_start, 3)
+            stats['git_dir_bytes'] = directory_size(os.path.join(repo_clone_path, '.git'))
+            log.success(f'Repository cloned successfully to {repo_clone_path} ({strategy} clone, {stats["duration_seconds"]}s, {stats["bytes_received"] or "?"} bytes received)')
+            job_log(f"Clone done: {strategy}, {stats['duration_seconds']}s, {stats['bytes_received'] or '?'} bytes received, .git size {stats['git_dir_bytes']} bytes")
+            return repo_clone_path, name, repo_url
 
         except ValueError as ve:
             log.error(f'Error processing repository URL/name: {ve}')
@@ -97,10 +366,82 @@ class Server:
 
             return None
 
-    def generate_dockerfile_content(self, repo_path: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+    @staticmethod
+    def _checkout_branch(repo_path: str, branch: str) -> bool:
+        """
+        Switches an existing clone to a branch, fetching it first (single-branch and shallow clones do not have it).
+        The clone is left as it was if the branch cannot be fetched or checked out.
+        :return: True if the branch is checked out.
+        """
+        try:
+            repo = Repo(repo_path)
+            if not repo.head.is_detached and repo.active_branch.name == branch:
+                return True
+            shallow = os.path.exists(os.path.join(repo.git_dir, 'shallow'))
+            repo.remote('origin').fetch(f'+refs/heads/{branch}:refs/remotes/origin/{branch}', **({'depth': 1} if shallow else {}))
+            repo.git.checkout('-B', branch, f'origin/{branch}')
+        except Exception as e:
+            log.error(f"Could not check out branch '{branch}' in {repo_path}: {e}")
+            job_log(f"Could not check out branch '{branch}' in the existing clone: {e}")
+            return False
+        log.info(f"Existing clone {repo_path} switched to branch '{branch}'.")
+        job_log(f"Existing clone switched to branch '{branch}'")
+        return True
+
+    def run_deployment(self, repo_url: str, clone_strategy: Optional[str] = None, branch: Optional[str] = None,
+                       overrides: Optional[Dict[str, Any]] = None,
+                       prepared_clone: Optional[Tuple[Tuple[str, str, str], Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """
+        Full deployment pipeline for a repository: clone, generate Dockerfile, build and run.
+        Meant to be executed by a job queue worker; raises DeploymentError on failure.
+        :param repo_url: URL of the Git repository to deploy.
+        :param clone_strategy: Clone strategy, defaults to the server setting.
+        :param branch: Branch to deploy, defaults to the default branch of the remote.
+        :param overrides: Values applied over the dockerfly.yaml of the app, also on its later updates.
+        :param prepared_clone: Result and stats of a clone already made (bulk deployments clone ahead of the jobs).
+        :return: Dictionary with the deployment info.
+        """
+        # 1. Clone repo
+        if prepared_clone is not None:
+            clone_result, clone_stats = prepared_clone[0], dict(prepared_clone[1] or {})
+        else:
+            clone_stats = {}
+            with track_phase('clone'):
+                clone_result = self.clone_git(repo_url, clone_strategy, clone_stats, branch)
+        if clone_result is None:
+            raise DeploymentError("Failed to clone the repository. Check URL or server logs", reason='clone_failed')
+        repo_path, repo_name, repo_url = clone_result
+        log.info(f"Repository '{repo_name}' cloned at: '{repo_path}'")
+
+        # 2. Generate Dockerfile
+        with track_phase('generate'):
+            generation_result = self.generate_dockerfile_content(repo_path, overrides)
+        if generation_result is None:
+            raise DeploymentError(f"Failed to generate Dockerfile for '{repo_name}'. Check 'dockerfly.yaml' or server logs", reason='invalid_config')
+        dockerfile_content, app_config = generation_result
+        log.info(f"Dockerfile content generated for '{repo_name}' based on its 'dockerfly.yaml'")
+
+        # 3. Deploy application
+        with track_phase('deploy'):
+            deployment_result = self.deploy_app(repo_path, repo_name, repo_url, dockerfile_content, app_config)
+        if deployment_result is None:
+            raise DeploymentError(f"Deployment failed for '{repo_name}'. Check server logs", reason='deploy_failed')
+
+        container_name = deployment_result['container_name']
+        if clone_stats and container_name in self.deployed_apps:
+            self._register_app(container_name, {"clone_strategy": clone_stats['strategy'], "clone_stats": clone_stats})
+        if container_name in self.deployed_apps:
+            self._register_app(container_name, {"config_overrides": overrides or None})
+        deployment_result['clone'] = clone_stats or None
+
+        log.success(f"Deployment succesful for '{repo_name}'. Result: {deployment_result}")
+        return deployment_result
+
+    def generate_dockerfile_content(self, repo_path: str, overrides: Optional[Dict[str, Any]] = None) -> Optional[Tuple[str, Dict[str, Any]]]:
         """
         Generates the content of the Dockerfile based on dockerfly.yaml in the repo.
         Returns a tuple [dockerfile_content, parsed_config], or None if it fails.
+        :param overrides: Values applied over dockerfly.yaml (e.g. from a bulk deployment manifest).
         """
         dockerfly_yaml_path = os.path.join(repo_path, 'dockerfly.yaml')
         log.info(f"Looking for configuration file: {dockerfly_yaml_path}")
@@ -116,6 +457,9 @@ class Server:
                  log.error(f"Configuration file '{dockerfly_yaml_path}' is empty or has invalid format.")
                  return None
             log.success(f"Loaded configuration from {dockerfly_yaml_path}")
+            if overrides:
+                config = apply_overrides(config, overrides)
+                log.info(f"Applied overrides to dockerfly.yaml: {', '.join(sorted(overrides))}")
         except yaml.YAMLError as e:
             log.error(f"Error parsing YAML file {dockerfly_yaml_path}: {e}")
             return None
@@ -127,11 +471,12 @@ class Server:
              return None
 
 
-        python_version = config.get('python_version', '3.10')
+        python_version = config.get('python_version', DEFAULT_PYTHON_VERSION)
         requirements_file = config.get('requirements_file', 'requirements.txt')
         port = config.get('port')
         app_name = config.get('app_name')
         start_command_list = config.get('start_command')
+        build_config = config.get('build', {})
         # volumes = config.get('volumes', []) # Volumes are optional.
 
         errors = []
@@ -140,21 +485,69 @@ class Server:
         if not isinstance(port, int) or port <= 0 or port > 65535: errors.append("'port' must be a valid integer (1-65535).")
         if not start_command_list or not isinstance(start_command_list, list) or not all(isinstance(item, str) for item in start_command_list):
             errors.append("'start_command' must be a list of strings (e.g., ['python', 'app.py']).")
+        if not isinstance(build_config, dict):
+            errors.append("'build' must be a mapping (e.g., {mode: optimized}).")
+        elif build_config.get('mode', 'standard') not in BUILD_MODES:
+            errors.append(f"'build.mode' must be one of: {', '.join(BUILD_MODES)}.")
+        elif not isinstance(build_config.get('timeout', 1), int) or build_config.get('timeout', 1) <= 0:
+            errors.append("'build.timeout' must be a positive integer (seconds).")
+        replicas = config.get('replicas', 1)
+        if not isinstance(replicas, int) or replicas < 1: errors.append("'replicas' must be a positive integer.")
+        if config.get('expose', 'host') not in EXPOSE_MODES: errors.append(f"'expose' must be one of: {', '.join(EXPOSE_MODES)}.")
+        elif config.get('expose') == 'host' and isinstance(replicas, int) and replicas > 1:
+            log.warning("'expose: host' with several replicas: only the first replica publishes the app port.")
+        resources = config.get('resources', {})
+        if not isinstance(resources, dict): errors.append("'resources' must be a mapping (e.g., {cpus: 0.5, memory: 256m}).")
+        deploy_config = config.get('deploy', {})
+        if not isinstance(deploy_config, dict):
+            errors.append("'deploy' must be a mapping (e.g., {strategy: blue_green}).")
+        else:
+            if deploy_config.get('strategy', 'recreate') not in DEPLOY_STRATEGIES:
+                errors.append(f"'deploy.strategy' must be one of: {', '.join(DEPLOY_STRATEGIES)}.")
+            readiness = deploy_config.get('readiness', {})
+            if not isinstance(readiness, dict) or readiness.get('type', 'tcp') not in PROBE_TYPES:
+                errors.append(f"'deploy.readiness.type' must be one of: {', '.join(PROBE_TYPES)}.")
+        if 'autoscale' in config: errors.extend(autoscale_errors(config['autoscale']))
 
         if errors:
             for error in errors: log.error(f"Invalid dockerfly.yaml: {error}")
             return None
 
+        # The build needs the base image: start pulling it now if a build node does not have it yet
+        if not self.base_images.prefetch(base_image(python_version)):
+            job_log(f"Pulling base image '{base_image(python_version)}' in the background...")
+
         req_file_path_in_repo = os.path.join(repo_path, requirements_file)
         if not os.path.isfile(req_file_path_in_repo):
             log.error(f"Specified requirements file '{requirements_file}' not found at '{req_file_path_in_repo}'. Cannot proceed.")
             return None
 
+        find_links = None
+        if self.wheelhouse.enabled and build_config.get('wheelhouse', True):
+            try:
+                with open(req_file_path_in_repo, 'r', encoding='utf-8') as f:
+                    find_links = self.wheelhouse.ensure(python_version, f.read())
+            except IOError as e:
+                log.error(f"Error reading requirements file {req_file_path_in_repo}: {e}")
+            if find_links is None:
+                log.warning("Wheelhouse not available for these requirements. Installing them from the package index.")
+
+        if build_config.get('mode') == 'optimized':
+            log.info("Generating optimized (BuildKit) Dockerfile content...")
+            dockerfile_content = render_optimized_dockerfile(
+                python_version, requirements_file, requirements_hash(req_file_path_in_repo),
+                app_name, port, start_command_list, multi_stage=bool(build_config.get('multi_stage', False)),
+                find_links=find_links,
+            )
+            log.debug(f"Generated Dockerfile:\n---\n{dockerfile_content}\n---")
+            log.success("Dockerfile content generated successfully.")
+            return dockerfile_content, config
+
         # Dockerfile content generation
         log.info("Generating Dockerfile content...")
         dockerfile_lines = [
             "# Auto-generated by DockerFly",
-            f"FROM python:{python_version}-slim",
+            f"FROM {base_image(python_version)}",
             "",
             "WORKDIR /app",
             "",
@@ -169,7 +562,7 @@ class Server:
         dockerfile_lines.append(f"COPY {req_copy_path} ./{os.path.basename(req_copy_path)}") # Copiar al directorio de trabajo
         dockerfile_lines.extend(
             (
-                f"RUN pip install --no-cache-dir -r {os.path.basename(req_copy_path)}",
+                f"RUN pip install --no-cache-dir {pip_install_options(find_links)}-r {os.path.basename(req_copy_path)}",
                 "",
                 "# Copy application code",
                 "COPY . .",
@@ -188,139 +581,232 @@ class Server:
 
         return dockerfile_content, config
 
-    def deploy_app(self, repo_path: str, repo_name: str, repo_url: str, dockerfile_content: str, app_config: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    def deploy_app(self, repo_path: str, repo_name: str, repo_url: str, dockerfile_content: str, app_config: Dict[str, Any],
+                   reuse_image: Optional[str] = None) -> Optional[Dict[str, Any]]:
         """
         Construye la imagen Docker y lanza el contenedor para la aplicación.
         Devuelve un diccionario con info del despliegue o None si falla.
+        :param reuse_image: Id of an image with the same build inputs; the containers are recreated from it without building.
         """
         app_name = app_config.get('app_name', repo_name)
         image_tag = f"dockerfly/{app_name}:latest".lower().replace(" ", "-")
-        container_name = f"{app_name}".lower().replace(" ", "-")
-        network_name = app_config.get('network_name', 'bridge')
+        container_name = self.container_name(app_name)
         container_port = app_config.get('port')
 
-        generated_dockerfile_path = os.path.join(repo_path, "Dockerfile.dockerfly") # Usar nombre distinto? O 'Dockerfile'
+        use_buildkit = app_config.get('build', {}).get('mode') == 'optimized'
         try:
-            with open(generated_dockerfile_path, 'w', encoding='utf-8') as f:
-                f.write(dockerfile_content)
-            log.info(f"Generated Dockerfile content written to: {generated_dockerfile_path}")
-        except IOError as e:
-            log.error(f"Failed to write generated Dockerfile to {generated_dockerfile_path}: {e}")
-            return None
+            deploy_commit = Repo(repo_path).head.commit.hexsha
+        except Exception:
+            deploy_commit = ''
 
         log.info(f"Starting deployment for app '{app_name}'...")
 
+        timings: Dict[str, float] = {}
+        current_node = self._app_nodes.get(container_name)
+        image = None
+        build_node = None
+        if reuse_image:
+            build_node = self._node_of(container_name)
+            try:
+                image = build_node.client.images.get(reuse_image)
+                log.info(f"Build inputs unchanged. Reusing image {image.short_id} for '{app_name}'.")
+                job_log(f"Build inputs unchanged, reusing image {image.short_id}")
+            except (NotFound, APIError) as e:
+                log.warning(f"Image {reuse_image[:19]} of '{app_name}' is not available ({e}). Rebuilding.")
+
         # 1. Build the image using the Dockerfile content
-        try:
-            log.info(f"Building image '{image_tag}' from context path '{repo_path}'...")
-            image, build_logs_stream = self.docker_client.images.build(
-                path=repo_path,
-                dockerfile=os.path.basename(generated_dockerfile_path),
-                tag=image_tag,
-                rm=True,
-                forcerm=True
-            )
-            log.success(f"Image built successfully: {image.short_id} ({image.tags[0]})")
+        build_info: Dict[str, Any] = {}
+        if image is None:
+            if not deploy_commit:
+                log.error(f"Cannot build '{image_tag}': {repo_path} has no commit checked out.")
+                return None
+            build_dockerfile = dockerfile_content
+            if app_config.get('build', {}).get('deps_cache', self.deps_cache_enabled):
+                # Built (on a miss) before taking a build slot: the dependency build takes one of its own
+                with track_phase('deps_image'):
+                    build_dockerfile = self._deps_image_dockerfile(repo_path, app_name, app_config) or dockerfile_content
+            # Wait for a build slot; deployments requested by users go before automatic updates
+            with self.build_admission.admit(lane_for(current_job())) as waited:
+                timings['build_queue_seconds'] = round(waited, 3)
+                try:
+                    # The shared dependency images only exist on the default node
+                    build_node = self.nodes.pick_build_node(
+                        prefer=current_node, needs_run_role=not self.nodes.registry,
+                        required=self.nodes.default.name if DependencyImageCache.REPOSITORY in build_dockerfile else None,
+                    )
+                except NodeError as e:
+                    log.error(f"Cannot build '{image_tag}': {e}")
+                    job_log(f"Cannot build: {e}")
+                    return None
+                try:
+                    # Read from the git tree of the commit while the daemon reads it, once the slot is taken,
+                    # with the same ignore rules the update check used
+                    patterns = context_ignore_patterns(Repo(repo_path), deploy_commit, app_config)
+                    context, context_info = self.build_contexts.context(repo_path, deploy_commit, GENERATED_DOCKERFILE, build_dockerfile, patterns)
+                except Exception as e:
+                    log.error(f"Cannot build '{image_tag}': {e}")
+                    job_log(f"Could not read the build context: {e}")
+                    return None
+                build_start = time.monotonic()
+                with track_phase('build'), self.nodes.building(build_node):
+                    if len(self.nodes.nodes) > 1:
+                        job_log(f"Building on node '{build_node.name}'")
+                    image = self._build_image(context, GENERATED_DOCKERFILE, image_tag, use_buildkit, build_node,
+                                              app_config.get('build', {}).get('timeout') or self.build_timeout)
+            if image is None:
+                return None
+            build_info['build_context_bytes'] = context_info['bytes']
+            build_info['build_context_cached'] = context_info['cached']
+            job_log(f"Build context: {context_info['files']} file(s), {context_info['bytes']} bytes"
+                    f"{' (cached)' if context_info['cached'] else ''}")
+            timings['build_seconds'] = round(time.monotonic() - build_start, 3)
+            build_info['build_seconds'] = timings['build_seconds']
+        build_info['image_size_bytes'] = image.attrs.get('Size')
 
-        except BuildError as e:
-            log.error(f"Docker build failed for image '{image_tag}':")
-            log.error("Attempting to log detailed build output:")
-            # Iterar sobre el generador de logs del build
-            for line in e.build_log:
-                if isinstance(line, dict) and 'stream' in line:
-                    log.error(line['stream'].strip())
-                elif isinstance(line, str):
-                    log.error(line.strip())
-            return None
-        except APIError as e:
-            log.error(f"Docker API error during build for '{image_tag}': {e}")
-            return None
-        except Exception as e:
-            log.exception(f"Unexpected error during image build for '{image_tag}': {e}")
-            return None
+        run_options = self._container_run_options(app_config, container_name, app_name, repo_url, repo_path, deploy_commit)
+        deploy_config = app_config.get('deploy', {})
+        # A runtime scale (POST /apps/{name}/scale) takes precedence over dockerfly.yaml
+        replicas = self.deployed_apps.get(container_name, {}).get('scaled_replicas') or app_config.get('replicas', 1)
 
-        # 2. Stop and remove existing container (if any)
+        # Place the app on a run node, and bring the image there if it was built elsewhere
         try:
-            existing_container = self.docker_client.containers.get(container_name)
-            log.warning(f"Found existing container '{container_name}'. Stopping and removing...")
-            existing_container.stop(timeout=10) # Dar tiempo para parar grácilmente
-            existing_container.remove()
-            log.info(f"Existing container '{container_name}' removed.")
-        except NotFound:
-            log.info(f"No existing container named '{container_name}'.")
-        except APIError as e:
-            log.error(f"Docker API error stopping/removing container '{container_name}': {e}")
+            run_node = self.nodes.pick_run_node(image.id, build_node, self._app_memory(app_config, replicas),
+                                                self._reserved_memory(exclude=container_name), current=current_node)
+            if run_node is not build_node:
+                with track_phase('transfer'):
+                    job_log(f"Moving image to node '{run_node.name}'...")
+                    self.nodes.transfer_image(image_tag, build_node, run_node)
+        except NodeError as e:
+            log.error(f"Cannot place '{container_name}': {e}")
+            job_log(f"Cannot place the app: {e}")
             return None
+        # An app moving to another node keeps serving from the old one until its new containers are up
+        moved_from = current_node if current_node and current_node != run_node.name else None
+        self._app_nodes[container_name] = run_node.name
+        if deploy_commit:
+            self._tag_commit(run_node, image.id, image_tag, deploy_commit)
+        legacy_name, legacy_containers = self._legacy_containers(app_name, container_name)
 
-        # 3. Launch the new container with dynamic port mapping
+        started = False
         try:
-            log.info(f"Starting new container '{container_name}' from image '{image_tag}'...")
-
-            volumes_to_mount = {}
-            for volume_mapping in app_config.get('volumes', []):
-                 if isinstance(volume_mapping, str) and ':' in volume_mapping:
-                     host_part, container_part = volume_mapping.split(':', 1)
-                     if host_part.startswith('/'):
-                         log.warning(f"Mounting host path '{host_part}' - Ensure permissions are correct on the host.")
-                         # Crear ruta host si no existe? Podría ser peligroso.
-                         # os.makedirs(host_part, exist_ok=True)
-                     volumes_to_mount[host_part] = {'bind': container_part, 'mode': 'rw'}
-                 else:
-                     log.warning(f"Skipping invalid volume format in dockerfly.yaml: '{volume_mapping}'. Expected 'host_path_or_named_volume:container_path'.")
-
-            # --- Preparar Variables de Entorno ---
-            environment_vars = app_config.get('environment_variables', {})
-            if not isinstance(environment_vars, dict):
-                 log.warning("'environment_variables' in dockerfly.yaml is not a dictionary. Ignoring.")
-                 environment_vars = {}
-
-
-            container = self.docker_client.containers.run(
-                image=image_tag,
-                name=container_name,
-                network=network_name,
-                ports={f'{container_port}/tcp': container_port},
-                volumes=volumes_to_mount,
-                environment=environment_vars,
-                detach=True,
-                restart_policy={"Name": "unless-stopped"}
-            )
+            with track_phase('start'):
+                if deploy_config.get('strategy', 'recreate') == 'blue_green':
+                    # 2-3. Start the new containers next to the old ones and swap once they are ready
+                    try:
+                        containers = self._blue_green_swap(container_name, image, app_config, run_options, replicas, timings,
+                                                           legacy_containers)
+                    except APIError as e:
+                        log.error(f"Docker API error during blue/green deployment of '{container_name}': {e}")
+                        job_log(f"Docker API error during blue/green deployment: {e}")
+                        return None
+                    if containers is None:
+                        return None
+                else:
+                    # 2. Stop and remove existing containers (if any)
+                    try:
+                        # Containers of the old name go too: they hold the port of the app
+                        existing_containers = self._app_containers(container_name) + legacy_containers
+                        if not existing_containers:
+                            log.info(f"No existing container named '{container_name}'.")
+                        for existing_container in existing_containers:
+                            log.warning(f"Found existing container '{existing_container.name}'. Stopping and removing...")
+                            job_log(f"Stopping previous container '{existing_container.name}'...")
+                            existing_container.stop(timeout=10) # Dar tiempo para parar grácilmente
+                            existing_container.remove()
+                            log.info(f"Existing container '{existing_container.name}' removed.")
+                    except APIError as e:
+                        log.error(f"Docker API error stopping/removing container '{container_name}': {e}")
+                        return None
+
+                    # 3. Launch the new containers with dynamic port mapping
+                    containers = []
+                    containers_start = time.monotonic()
+                    try:
+                        for index in range(replicas):
+                            replica_name = self._replica_name(container_name, index)
+                            log.info(f"Starting new container '{replica_name}' from image '{image_tag}'...")
+                            job_log(f"Starting container '{replica_name}'...")
+                            containers.append(self._start_replica(image_tag, container_name, index, app_config, run_options))
+                    except APIError as e:
+                        log.error(f"Docker API error starting container '{container_name}': {e}")
+                        job_log(f"Docker API error starting container: {e}")
+                        return None
+                    except Exception as e:
+                        log.exception(f"Unexpected error running container '{container_name}': {e}")
+                        return None
+
+                    # Recreate does not wait for the new version: its first response is measured in the background
+                    threading.Thread(
+                        target=self._measure_first_response, name=f'dockerfly-probe-{container_name}', daemon=True,
+                        args=(container_name, containers[0], run_options['network'], container_port,
+                              deploy_config.get('readiness', {}), containers_start, current_job()),
+                    ).start()
+            started = True
+        finally:
+            if moved_from and started:
+                self._remove_from_node(container_name, moved_from)
+            elif moved_from:
+                # The app stays where it was: drop what was started on the new node
+                self._remove_from_node(container_name, run_node.name)
+                self._app_nodes[container_name] = moved_from
+        if legacy_name:
+            self._forget_legacy_name(legacy_name)
 
+        if 'first_response_seconds' in timings:
+            # Blue/green: the candidates were probed before the swap
+            self._observe_first_response(current_job(), timings)
+            build_info['first_response_seconds'] = timings['first_response_seconds']
+            build_info['time_to_first_response_seconds'] = timings.get('time_to_first_response_seconds')
+
+        container = containers[0]
+        try:
             container.reload()
 
             assigned_host_port = None
-            try:
-                port_data = container.ports.get(f'{container_port}/tcp')
-                if port_data and isinstance(port_data, list) and len(port_data) > 0:
-                    assigned_host_port = port_data[0].get('HostPort')
-                if not assigned_host_port: raise ValueError("HostPort not found") # Forzar error si no se encuentra
-            except Exception as port_e:
-                 log.error(f"Could not determine assigned host port for container '{container_name}': {port_e}")
-                 raise
+            if self._expose_mode(app_config) != 'network':
+                try:
+                    port_data = container.ports.get(f'{container_port}/tcp')
+                    if port_data and isinstance(port_data, list) and len(port_data) > 0:
+                        assigned_host_port = port_data[0].get('HostPort')
+                    if not assigned_host_port: raise ValueError("HostPort not found") # Forzar error si no se encuentra
+                except Exception as port_e:
+                     log.error(f"Could not determine assigned host port for container '{container_name}': {port_e}")
+                     raise
 
             # Build access URL (assuming localhost, could be configurable)
             # TODO: Get the host IP/hostname more reliably if not localhost
             host_access_point = "localhost"
             access_url = f"http://{app_name}"
 
-            log.success(f"Container '{container_name}' started successfully (ID: {container.short_id}).")
+            log.success(f"Container '{container_name}' started successfully (ID: {container.short_id}, {len(containers)} replica(s)).")
+            job_log(f"Container '{container_name}' started (ID: {container.short_id}, host port: {assigned_host_port}, replicas: {len(containers)}).")
             log.info(f"App '{app_name}' running internally on port {container_port}. Access via: {access_url}")
 
             try:
                 cloned_repo_git = Repo(repo_path)
                 current_commit_hash = cloned_repo_git.head.commit.hexsha
+                branch = None if cloned_repo_git.head.is_detached else cloned_repo_git.active_branch.name
                 log.debug(f"Stored state for '{container_name}': {current_commit_hash[:7]}")
 
-                self.deployed_apps[container_name] = {
+                self._register_app(container_name, {
                     "repo_url": repo_url,
                     "repo_path": repo_path,
                     "repo_name": repo_name,
                     "app_name": app_name,
+                    "branch": branch,
                     "last_commit": current_commit_hash,
                     "container_id": container.id,
                     "image_tag": image_tag,
+                    "image_id": image.id,
                     "app_config": app_config,
-                }
+                    "replicas": [c.id for c in containers],
+                    "container_status": "running",
+                    "node": run_node.name,
+                    "dockerfile_sha256": text_hash(dockerfile_content),
+                    "config_sha256": config_hash(app_config),
+                    **build_info,
+                })
+                self.state_store.record_deployment(container_name, current_commit_hash, image_tag, container.id, app_config)
 
                 deployment_info = {
                     "message": "Deployment successful",
@@ -331,7 +817,10 @@ class Server:
                     "internal_port": container_port,
                     "assigned_host_port": assigned_host_port,
                     "access_url": access_url,
-                    "current_commit": current_commit_hash
+                    "current_commit": current_commit_hash,
+                    "replicas": len(containers),
+                    "node": run_node.name,
+                    "timings": timings,
                 }
 
                 return deployment_info
@@ -346,108 +835,968 @@ class Server:
                     "internal_port": container_port,
                     "assigned_host_port": assigned_host_port,
                     "access_url": access_url,
-                    "current_commit": None
+                    "current_commit": None,
+                    "timings": timings,
                 }
+                return deployment_info
         except APIError as e:
             log.error(f"Docker API error starting container '{container_name}': {e}")
+            job_log(f"Docker API error starting container: {e}")
             return None
         except Exception as e:
             log.exception(f"Unexpected error running container '{container_name}': {e}")
             return None
-    
+
+    def _deps_image_dockerfile(self, repo_path: str, app_name: str, app_config: Dict[str, Any]) -> Optional[str]:
+        """
+        Dockerfile based on the shared dependency image of the app requirements, built on a cache miss.
+        :return: The Dockerfile, or None if there is no dependency image for them (regular build).
+        """
+        requirements_path = os.path.join(repo_path, app_config.get('requirements_file', 'requirements.txt'))
+        try:
+            with open(requirements_path, 'r', encoding='utf-8') as f:
+                requirements_text = f.read()
+        except IOError as e:
+            log.error(f"Error reading requirements file {requirements_path}: {e}")
+            return None
+        deps_image = self.deps_cache.ensure(str(app_config.get('python_version', DEFAULT_PYTHON_VERSION)), requirements_text)
+        if deps_image is None:
+            log.warning("Dependency image not available. Falling back to a regular build.")
+            job_log("Dependency image not available, regular build")
+            return None
+        dockerfile_content = render_deps_image_dockerfile(deps_image, app_name, app_config.get('port'), app_config.get('start_command'))
+        log.debug(f"Dockerfile based on '{deps_image}':\n---\n{dockerfile_content}\n---")
+        job_log(f"Building on dependency image '{deps_image}'")
+        return dockerfile_content
+
+    def _build_image(self, context: Iterator[bytes], dockerfile: str, image_tag: str, use_buildkit: bool, node: DockerNode,
+                     timeout: Optional[float] = None):
+        """
+        Builds the image of an app on a build node, with BuildKit (optimized mode) or the legacy builder.
+        :param context: Chunks of the tar of the build context, with the Dockerfile in it (see BuildContextCache).
+        :param timeout: Seconds after which the build is cancelled. Raises DeploymentError when it happens.
+        :return: The built image, or None if the build failed.
+        """
+        try:
+            log.info(f"Building image '{image_tag}'...")
+            job_log(f"Building image '{image_tag}'...")
+            if use_buildkit:
+                if not buildkit_available():
+                    log.error("Optimized build requested but the docker CLI (BuildKit) is not available on the server.")
+                    return None
+                try:
+                    build_with_buildkit(None, dockerfile, image_tag, on_line=job_log, docker_host=node.base_url, timeout=timeout,
+                                        context=context, tls=node.tls)
+                except BuildKitError as e:
+                    if e.timed_out:
+                        raise BuildTimeout(f"Build of '{image_tag}' exceeded {timeout}s") from e
+                    raise
+                image = node.client.images.get(image_tag)
+            else:
+                image = self._stream_build(context, dockerfile, image_tag, node, timeout)
+            log.success(f"Image built successfully: {image.short_id} ({image.tags[0]})")
+            job_log(f"Image built: {image.short_id} ({image_tag})")
+            return image
+
+        except BuildTimeout as e:
+            log.error(f"{e}. Build cancelled.")
+            job_log(f"Build cancelled: it exceeded the build timeout ({timeout}s)")
+            self.build_admission.record_timeout(lane_for(current_job()))
+            raise DeploymentError(f"Build of '{image_tag}' timed out after {timeout}s", reason='build_timeout') from e
+        except BuildKitError as e:
+            log.error(f"Docker build failed for image '{image_tag}': {e}")
+            for line in e.build_log:
+                log.error(line)
+            return None
+        except BuildError as e:
+            log.error(f"Docker build failed for image '{image_tag}':")
+            log.error("Attempting to log detailed build output:")
+            # Iterar sobre el generador de logs del build
+            for line in e.build_log:
+                if isinstance(line, dict) and 'stream' in line:
+                    log.error(line['stream'].strip())
+                elif isinstance(line, str):
+                    log.error(line.strip())
+            return None
+        except APIError as e:
+            log.error(f"Docker API error during build for '{image_tag}': {e}")
+            job_log(f"Docker API error during build: {e}")
+            return None
+        except BuildContextError as e:
+            log.error(f"Cannot build '{image_tag}': {e}")
+            job_log(f"Could not read the build context: {e}")
+            return None
+        except Exception as e:
+            log.exception(f"Unexpected error during image build for '{image_tag}': {e}")
+            return None
+
+    def _container_run_options(self, app_config: Dict[str, Any], container_name: str, app_name: str,
+                               repo_url: str, repo_path: str, commit: str) -> Dict[str, Any]:
+        """Keyword arguments for containers.run shared by every container of an app (except name and ports)."""
+        volumes_to_mount = {}
+        for volume_mapping in app_config.get('volumes', []):
+             if isinstance(volume_mapping, str) and ':' in volume_mapping:
+                 host_part, container_part = volume_mapping.split(':', 1)
+                 if host_part.startswith('/'):
+                     log.warning(f"Mounting host path '{host_part}' - Ensure permissions are correct on the host.")
+                     # Crear ruta host si no existe? Podría ser peligroso.
+                     # os.makedirs(host_part, exist_ok=True)
+                 volumes_to_mount[host_part] = {'bind': container_part, 'mode': 'rw'}
+             else:
+                 log.warning(f"Skipping invalid volume format in dockerfly.yaml: '{volume_mapping}'. Expected 'host_path_or_named_volume:container_path'.")
+
+        # --- Preparar Variables de Entorno ---
+        environment_vars = app_config.get('environment_variables', {})
+        if not isinstance(environment_vars, dict):
+             log.warning("'environment_variables' in dockerfly.yaml is not a dictionary. Ignoring.")
+             environment_vars = {}
+
+        resource_limits = {}
+        resources = app_config.get('resources', {})
+        if resources.get('cpus'):
+            resource_limits['nano_cpus'] = int(float(resources['cpus']) * 1e9)
+        if resources.get('memory'):
+            resource_limits['mem_limit'] = resources['memory']
+
+        return {
+            **resource_limits,
+            "network": app_config.get('network_name', 'bridge'),
+            "volumes": volumes_to_mount,
+            "environment": environment_vars,
+            "labels": {
+                APP_LABEL: container_name,
+                'dockerfly.app_name': app_name,
+                'dockerfly.repo_url': repo_url,
+                'dockerfly.repo_path': repo_path,
+                'dockerfly.commit': commit,
+            },
+            "detach": True,
+            "restart_policy": {"Name": "unless-stopped"},
+        }
+
+    @staticmethod
+    def container_name(app_name: str) -> str:
+        """Container name of an app, without the separator of the replica and candidate names."""
+        return str(app_name).lower().replace(" ", "-").replace(NAME_SEPARATOR, "-")
+
+    @staticmethod
+    def _replica_name(container_name: str, index: int) -> str:
+        """The first replica keeps the name of the app, the others are numbered."""
+        return container_name if index == 0 else f"{container_name}{NAME_SEPARATOR}{index}"
+
+    @staticmethod
+    def _candidate_name(container_name: str, index: int) -> str:
+        return f"{Server._replica_name(container_name, index)}{NAME_SEPARATOR}next"
+
+    @staticmethod
+    def is_candidate(names: List[str], labels: Dict[str, str]) -> bool:
+        """Whether a container is a blue/green candidate not swapped in yet (names as listed by docker, with or without '/')."""
+        candidate_name = labels.get(CANDIDATE_LABEL)
+        return bool(candidate_name) and any(name.lstrip('/') == candidate_name for name in names)
+
+    @staticmethod
+    def _expose_mode(app_config: Dict[str, Any]) -> str:
+        return app_config.get('expose', 'host' if app_config.get('replicas', 1) == 1 else 'ephemeral')
+
+    def _replica_ports(self, app_config: Dict[str, Any], index: int, candidate: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Port publishing of a replica: 'host' publishes the app port on the first replica and
+        ephemeral ports on the rest, 'ephemeral' lets docker pick every host port, and
+        'network' publishes nothing (the reverse proxy reaches replicas over the docker network).
+        """
+        container_port = app_config.get('port')
+        expose = self._expose_mode(app_config)
+        if expose == 'network':
+            return None
+        if expose == 'host' and index == 0 and not candidate:
+            return {f'{container_port}/tcp': container_port}
+        return {f'{container_port}/tcp': None}
+
+    def _start_replica(self, image_ref: str, container_name: str, index: int, app_config: Dict[str, Any],
+                       run_options: Dict[str, Any], candidate: bool = False, routed: bool = True):
+        """
+        :param candidate: Blue/green candidate: named after the replica with a suffix, on an ephemeral port.
+        :param routed: False hides the container from nginx-proxy, which routes by the VIRTUAL_HOST of the
+            image, until it is known to be ready.
+        """
+        name = self._candidate_name(container_name, index) if candidate else self._replica_name(container_name, index)
+        labels = {**run_options['labels'], REPLICA_LABEL: str(index), **({CANDIDATE_LABEL: name} if candidate else {})}
+        environment = run_options['environment'] if routed else {**run_options['environment'], 'VIRTUAL_HOST': '', 'VIRTUAL_PORT': ''}
+        return self._node_of(container_name).client.containers.run(
+            image=image_ref,
+            name=name,
+            ports=self._replica_ports(app_config, index, candidate),
+            **{**run_options, 'labels': labels, 'environment': environment}
+        )
+
+    @staticmethod
+    def _tag_commit(node: DockerNode, image_id: str, image_tag: str, commit: str):
+        """Tags an app image with its commit, so the images of previous deployments stay tagged (and available for rollbacks)."""
+        repository = image_tag.rpartition(':')[0]
+        try:
+            node.client.images.get(image_id).tag(repository, commit[:12])
+        except (NotFound, APIError) as e:
+            log.warning(f"Could not tag image {image_id[:19]} as {repository}:{commit[:12]}: {e}")
+
+    def _node_of(self, container_name: str) -> DockerNode:
+        """Node an app runs on (the default node for apps not placed yet)."""
+        return self.nodes.get(self._app_nodes.get(container_name)) or self.nodes.default
+
+    @staticmethod
+    def _app_memory(app_config: Dict[str, Any], replicas: int) -> int:
+        """Memory an app takes on its node: its memory limit (or a default) per replica."""
+        memory = parse_memory(app_config.get('resources', {}).get('memory')) or DEFAULT_CONTAINER_MEMORY
+        return memory * replicas
+
+    def _reserved_memory(self, exclude: Optional[str] = None) -> Dict[str, int]:
+        """Memory reserved on each node by the apps placed on it."""
+        reserved: Dict[str, int] = {}
+        for container_name, app_state in list(self.deployed_apps.items()):
+            node_name = self._app_nodes.get(container_name)
+            if container_name == exclude or not node_name:
+                continue
+            replicas = len(app_state.get('replicas') or [None])
+            reserved[node_name] = reserved.get(node_name, 0) + self._app_memory(app_state.get('app_config') or {}, replicas)
+        return reserved
+
+    def _remove_from_node(self, container_name: str, node_name: str):
+        """Removes the containers of an app from the node it moved away from (best effort, the node may be down)."""
+        node = self.nodes.get(node_name)
+        if node is None:
+            return
+        try:
+            for container in node.client.containers.list(all=True, filters={'label': f'{APP_LABEL}={container_name}'}):
+                container.remove(force=True)
+            log.info(f"Containers of '{container_name}' removed from node '{node_name}'.")
+        except Exception as e:
+            log.warning(f"Could not remove the containers of '{container_name}' from node '{node_name}': {e}")
+
+    def _legacy_containers(self, app_name: str, container_name: str) -> Tuple[Optional[str], List[Any]]:
+        """
+        Apps deployed when underscores were kept in container names are redeployed under the new
+        name. The containers of the old name are retired with the old replicas, so they keep serving
+        until the new ones run and no longer hold the port afterwards (see _forget_legacy_name).
+        :return: The old name of the app (None if it has none) and its containers.
+        """
+        legacy_name = str(app_name).lower().replace(" ", "-")
+        if legacy_name == container_name or legacy_name not in self.deployed_apps:
+            return None, []
+        log.warning(f"App '{app_name}' was deployed as '{legacy_name}'. Replacing it with '{container_name}'.")
+        job_log(f"Replacing the containers of '{legacy_name}' (previous name of the app)...")
+        try:
+            return legacy_name, self._app_containers(legacy_name)
+        except APIError as e:
+            log.warning(f"Could not list the containers of '{legacy_name}': {e}")
+            return legacy_name, []
+
+    def _forget_legacy_name(self, legacy_name: str):
+        """Drops the state of the old name of an app, once the app runs under its new name."""
+        legacy_state = self.deployed_apps.pop(legacy_name, None)
+        if legacy_state is None:
+            return
+        self._app_nodes.pop(legacy_name, None)
+        self.repo_index.get(normalize_repo_url(legacy_state['repo_url']), set()).discard(legacy_name)
+        try:
+            self.state_store.delete_app(legacy_name)
+        except Exception as e:
+            log.error(f"Failed to delete the state of '{legacy_name}': {e}")
+
+    def _app_containers(self, container_name: str, candidates: bool = False) -> List[Any]:
+        """
+        Containers of an app (every replica), found by label.
+        :param candidates: Return the blue/green candidates instead of the live containers.
+        """
+        client = self._node_of(container_name).client
+        containers = client.containers.list(all=True, filters={'label': f'{APP_LABEL}={container_name}'})
+        containers = [c for c in containers if self.is_candidate([c.name], c.labels) == candidates]
+        if not candidates and not any(c.name == container_name for c in containers):
+            # Containers deployed before DockerFly labelled them
+            try:
+                containers.append(client.containers.get(container_name))
+            except NotFound:
+                pass
+        return sorted(containers, key=lambda c: int(c.labels.get(REPLICA_LABEL, 0)))
+
+    def scale_app(self, container_name: str, replicas: int) -> Dict[str, Any]:
+        """
+        Changes the number of replicas of a deployed app without rebuilding its image.
+        Runs on a job queue worker; raises DeploymentError if the app cannot be scaled.
+        """
+        app_state = self.deployed_apps.get(container_name)
+        if app_state is None:
+            raise DeploymentError(f"App '{container_name}' is not deployed", reason='unknown_app')
+        app_config = app_state.get('app_config') or {}
+        if not app_config.get('port'):
+            # Apps adopted from containers that expose no port: new replicas would not know what to publish
+            raise DeploymentError(f"The port of '{container_name}' is unknown. Redeploy it before scaling", reason='invalid_config')
+        image_ref = app_state.get('image_id') or app_state.get('image_tag')
+
+        current = self._app_containers(container_name)
+        log.info(f"Scaling '{container_name}' from {len(current)} to {replicas} replica(s)...")
+        job_log(f"Scaling '{container_name}' from {len(current)} to {replicas} replica(s)...")
+        try:
+            running_indexes = {int(c.labels.get(REPLICA_LABEL, 0)): c for c in current}
+            run_options = self._container_run_options(
+                app_config, container_name, app_state.get('app_name', container_name),
+                app_state['repo_url'], app_state['repo_path'], app_state.get('last_commit') or '',
+            )
+            for index in range(replicas):
+                if index not in running_indexes:
+                    job_log(f"Starting replica '{self._replica_name(container_name, index)}'...")
+                    running_indexes[index] = self._start_replica(image_ref, container_name, index, app_config, run_options)
+            for index in sorted((i for i in running_indexes if i >= replicas), reverse=True):
+                job_log(f"Removing replica '{running_indexes[index].name}'...")
+                running_indexes[index].stop(timeout=10)
+                running_indexes[index].remove()
+                del running_indexes[index]
+        except APIError as e:
+            log.error(f"Docker API error scaling '{container_name}': {e}")
+            raise DeploymentError(f"Docker API error scaling '{container_name}': {e}", reason='docker_api') from e
+
+        self._register_app(container_name, {
+            "scaled_replicas": replicas,
+            "replicas": [running_indexes[i].id for i in sorted(running_indexes)],
+        })
+        log.success(f"App '{container_name}' scaled to {replicas} replica(s).")
+        return {"app": container_name, "replicas": replicas}
+
+    @staticmethod
+    def _is_alive(container) -> bool:
+        container.reload()
+        return container.status in ('created', 'running')
+
+    @staticmethod
+    def _record_first_response(timings: Dict[str, float], containers_start: float, job: Optional[DeploymentJob] = None):
+        """Records when a new version answered: since its containers started, and since the deployment was requested."""
+        timings['first_response_seconds'] = round(time.monotonic() - containers_start, 3)
+        job = job or current_job()
+        if job is not None:
+            timings['time_to_first_response_seconds'] = round(time.time() - job.created_at, 3)
+
+    @staticmethod
+    def _observe_first_response(job: Optional[DeploymentJob], timings: Dict[str, float]):
+        message = (f"First response {timings['first_response_seconds']}s after the container start, "
+                   f"{timings.get('time_to_first_response_seconds', '?')}s after the request.")
+        log.info(message)
+        if job is not None and 'time_to_first_response_seconds' in timings:
+            job.add_log(message)
+            TIME_TO_FIRST_RESPONSE.labels(job.kind).observe(timings['time_to_first_response_seconds'])
+
+    def _measure_first_response(self, container_name: str, container, network_name: str, container_port: int,
+                                readiness: Dict[str, Any], containers_start: float, job: Optional[DeploymentJob]):
+        """Waits for the first response of a container started by a recreate deployment and stores it in the app state."""
+        try:
+            addresses = self._probe_addresses(container, network_name, container_port)
+            if wait_until_ready(addresses, readiness, is_alive=lambda: self._is_alive(container)) is None:
+                log.warning(f"'{container.name}' did not answer within its readiness timeout. Time to first response not recorded.")
+                return
+        except Exception as e:
+            log.warning(f"Could not measure the first response of '{container.name}': {e}")
+            return
+        timings: Dict[str, float] = {}
+        self._record_first_response(timings, containers_start, job)
+        self._observe_first_response(job, timings)
+        # A newer deployment may have replaced the container in the meantime
+        if self.deployed_apps.get(container_name, {}).get('container_id') == container.id:
+            self._register_app(container_name, {
+                "first_response_seconds": timings['first_response_seconds'],
+                "time_to_first_response_seconds": timings.get('time_to_first_response_seconds'),
+            })
+
+    def _probe_addresses(self, container, network_name: str, container_port: int) -> List[Tuple[str, int]]:
+        """Addresses where the server can reach a container: its IP on the app network, then the host port."""
+        container.reload()
+        addresses = []
+        networks = container.attrs.get('NetworkSettings', {}).get('Networks', {})
+        for name, settings in networks.items():
+            ip_address = settings.get('IPAddress')
+            if ip_address:
+                addresses.insert(0 if name == network_name else len(addresses), (ip_address, container_port))
+        port_data = container.ports.get(f'{container_port}/tcp') or []
+        if port_data and port_data[0].get('HostPort'):
+            probe_host = self._node_of(container.labels.get(APP_LABEL, '')).probe_host or self.probe_host
+            addresses.append((probe_host, int(port_data[0]['HostPort'])))
+        return addresses
+
+    def _blue_green_swap(self, container_name: str, image, app_config: Dict[str, Any],
+                         run_options: Dict[str, Any], replicas: int, timings: Dict[str, float],
+                         legacy_containers: Optional[List[Any]] = None):
+        """
+        Starts the new version of an app next to the running one and only removes the old
+        containers once every new replica passes its readiness probe. On failure the old containers
+        keep serving; if there are none, the previous image is restarted.
+
+        The candidates first start hidden from nginx-proxy, so a version that never becomes ready
+        gets no traffic. Routing comes from the environment, which cannot change once a container
+        runs: each ready candidate is replaced by a routed one of the same image, which is probed
+        too while the old containers keep serving (nginx-proxy retries refused connections on them).
+        The candidates run on ephemeral host ports; with 'expose: host' the first replica is started
+        again on the fixed port once the old containers are gone (see _pin_host_port).
+        :param legacy_containers: Containers of the old name of the app, drained with the old containers.
+        :return: The new containers (renamed to their replica names), or None if the deployment failed.
+        """
+        container_port = app_config.get('port')
+        readiness = app_config.get('deploy', {}).get('readiness', {})
+        drain_timeout = app_config.get('deploy', {}).get('drain_timeout', 10)
+
+        old_containers = self._app_containers(container_name)
+        primary = next((c for c in old_containers if c.name == container_name), None)
+        previous_image_id = primary.image.id if primary else self.deployed_apps.get(container_name, {}).get('image_id')
+
+        # Leftover candidates of an interrupted deployment
+        for leftover in self._app_containers(container_name, candidates=True):
+            leftover.remove(force=True)
+
+        def start_candidates(routed: bool):
+            for index in range(replicas):
+                candidate_name = self._candidate_name(container_name, index)
+                log.info(f"Starting {'' if routed else 'unrouted '}candidate container '{candidate_name}' from image '{image.short_id}'...")
+                job_log(f"Starting {'' if routed else 'unrouted '}candidate container '{candidate_name}'...")
+                # Fixed host ports are still held by the old containers
+                candidates.append(self._start_replica(image.id, container_name, index, app_config, run_options, candidate=True, routed=routed))
+
+        def probe_candidates() -> Optional[float]:
+            probe_seconds = 0.0
+            for candidate in candidates:
+                addresses = self._probe_addresses(candidate, run_options['network'], container_port)
+                job_log(f"Waiting for '{candidate.name}' to become ready ({addresses})...")
+                ready_after = wait_until_ready(addresses, readiness, is_alive=lambda candidate=candidate: self._is_alive(candidate))
+                if ready_after is None:
+                    log.error(f"Candidate container '{candidate.name}' did not become ready. Rolling back.")
+                    job_log(f"Candidate '{candidate.name}' did not become ready. Last output:")
+                    job_log(candidate.logs(tail=20).decode(errors='replace'))
+                    for c in candidates:
+                        c.remove(force=True)
+                    self._rollback(container_name, primary, previous_image_id, app_config, run_options)
+                    return None
+                probe_seconds += ready_after
+                if 'first_response_seconds' not in timings:
+                    self._record_first_response(timings, candidates_start)
+            return probe_seconds
+
+        candidates = []
+        candidates_start = time.monotonic()
+        start_candidates(routed=False)
+        probe_seconds = probe_candidates()
+        if probe_seconds is None:
+            return None
+        # Ready: replace them with routed containers, probed before the old containers go
+        for candidate in candidates:
+            candidate.remove(force=True)
+        candidates = []
+        start_candidates(routed=True)
+        routed_probe_seconds = probe_candidates()
+        if routed_probe_seconds is None:
+            return None
+        timings['probe_seconds'] = round(probe_seconds + routed_probe_seconds, 3)
+
+        swap_start = time.monotonic()
+        for old_container in old_containers + (legacy_containers or []):
+            job_log(f"Draining previous container '{old_container.name}'...")
+            old_container.stop(timeout=drain_timeout)
+            old_container.remove()
+        if self._expose_mode(app_config) == 'host':
+            candidates[0] = self._pin_host_port(container_name, candidates[0], image, app_config, run_options, readiness)
+        for index, candidate in enumerate(candidates):
+            if candidate.name != self._replica_name(container_name, index):
+                candidate.rename(self._replica_name(container_name, index))
+        timings['swap_seconds'] = round(time.monotonic() - swap_start, 3)
+        log.success(f"Blue/green swap of '{container_name}' done (probe {timings['probe_seconds']}s, swap {timings['swap_seconds']}s).")
+        job_log(f"Swap done: probe {timings['probe_seconds']}s, swap {timings['swap_seconds']}s.")
+        return candidates
+
+    def _pin_host_port(self, container_name: str, candidate, image, app_config: Dict[str, Any],
+                       run_options: Dict[str, Any], readiness: Dict[str, Any]):
+        """
+        Port bindings cannot change once a container is created: the first replica is started
+        again from the new image on the fixed host port, freed by the old containers, and the
+        candidate is removed once it is ready. The other candidates keep serving meanwhile.
+        If the fixed port cannot be bound, the candidate stays on its ephemeral port.
+        A port cannot move between containers, so the fixed port is closed until the replica starts:
+        only the traffic through nginx-proxy is served without interruption.
+        :return: The container of the first replica.
+        """
+        job_log(f"Moving '{container_name}' to its host port {app_config.get('port')}...")
+        try:
+            replica = self._start_replica(image.id, container_name, 0, app_config, run_options)
+        except APIError as e:
+            log.warning(f"Could not publish '{container_name}' on its host port, keeping an ephemeral one: {e}")
+            job_log(f"Host port not available, '{container_name}' keeps an ephemeral port: {e}")
+            return candidate
+        addresses = self._probe_addresses(replica, run_options['network'], app_config.get('port'))
+        if wait_until_ready(addresses, readiness, is_alive=lambda: self._is_alive(replica)) is None:
+            log.warning(f"'{replica.name}' did not become ready on its host port. Keeping the candidate on an ephemeral port.")
+            job_log(f"'{replica.name}' did not become ready on its host port, keeping the candidate")
+            replica.remove(force=True)
+            return candidate
+        candidate.stop(timeout=app_config.get('deploy', {}).get('drain_timeout', 10))
+        candidate.remove()
+        return replica
+
+    def _rollback(self, container_name: str, old_container, previous_image_id: Optional[str],
+                  app_config: Dict[str, Any], run_options: Dict[str, Any]):
+        """Makes sure the previous version of an app keeps running after a failed deployment."""
+        if old_container is not None:
+            old_container.reload()
+            if old_container.status == 'running':
+                log.info(f"Previous container '{container_name}' is still serving. Rollback complete.")
+                job_log("Previous version is still serving.")
+                return
+            old_container.remove(force=True)
+        if not previous_image_id:
+            log.error(f"No previous image to roll back '{container_name}' to.")
+            return
+
+        log.warning(f"Restarting '{container_name}' from previous image {previous_image_id[:19]}...")
+        job_log("Restarting the previous version...")
+        try:
+            self._start_replica(previous_image_id, container_name, 0, app_config, run_options)
+            log.success(f"Rolled back '{container_name}' to image {previous_image_id[:19]}.")
+        except APIError as e:
+            log.error(f"Rollback of '{container_name}' failed: {e}")
+
+    def _register_app(self, container_name: str, state: Dict[str, Any], persist: bool = True):
+        """Stores the state of a deployed app and indexes it by repository URL."""
+        app_state = self.deployed_apps.setdefault(container_name, {})
+        app_state.update(state)
+        if app_state.get('node'):
+            self._app_nodes[container_name] = app_state['node']
+        self.repo_index.setdefault(normalize_repo_url(app_state['repo_url']), set()).add(container_name)
+        if persist:
+            try:
+                self.state_store.save_app(container_name, app_state)
+            except Exception as e:
+                log.error(f"Failed to persist state of '{container_name}': {e}")
+
+    def reconcile_state(self):
+        """
+        Rebuilds the in-memory state from the state store and the DockerFly containers
+        running on the nodes. Containers are listed with a single API call per node, filtered by label.
+        Containers deployed before the store existed are adopted from their labels.
+        """
+        start = time.monotonic()
+        stored_apps = self.state_store.load_apps()
+        containers_by_app = {}
+        unreachable = set()
+        for node in self.nodes.nodes.values():
+            if not node.healthy:
+                unreachable.add(node.name)
+                continue
+            for c in node.client.api.containers(all=True, filters={'label': APP_LABEL}):
+                if c.get('Labels', {}).get(APP_LABEL) and c['Labels'].get(REPLICA_LABEL, '0') == '0' \
+                        and not self.is_candidate(c.get('Names', []), c['Labels']):
+                    containers_by_app[c['Labels'][APP_LABEL]] = {**c, 'Node': node.name}
+
+        for container_name, app_state in stored_apps.items():
+            container = containers_by_app.get(container_name)
+            if container is None and app_state.get('node') in unreachable:
+                log.warning(f"Node '{app_state['node']}' of tracked app '{container_name}' is unreachable.")
+                app_state['container_status'] = 'unreachable'
+            elif container is None:
+                log.warning(f"No container found for tracked app '{container_name}'.")
+                app_state['container_status'] = 'missing'
+            else:
+                app_state['container_id'] = container['Id']
+                app_state['container_status'] = container.get('State')
+                app_state['node'] = container['Node']
+            self._register_app(container_name, app_state, persist=False)
+
+        adopted = 0
+        for container_name, container in containers_by_app.items():
+            if container_name in stored_apps:
+                continue
+            labels = container['Labels']
+            repo_path = labels.get('dockerfly.repo_path')
+            if not labels.get('dockerfly.repo_url') or not repo_path or not os.path.isdir(repo_path):
+                log.warning(f"Container '{container_name}' has no usable DockerFly labels. Not adopted.")
+                continue
+            self._register_app(container_name, {
+                "repo_url": labels['dockerfly.repo_url'],
+                "repo_path": repo_path,
+                "repo_name": os.path.basename(repo_path),
+                "app_name": labels.get('dockerfly.app_name', container_name),
+                "branch": None,
+                "last_commit": labels.get('dockerfly.commit'),
+                "container_id": container['Id'],
+                "container_status": container.get('State'),
+                "image_tag": container.get('Image'),
+                "node": container['Node'],
+                "app_config": self._adopted_config(container),
+            })
+            adopted += 1
+
+        log.info(f"State reconciled: {len(self.deployed_apps)} app(s) tracked ({adopted} adopted from containers) in {time.monotonic() - start:.3f}s.")
+
+    @staticmethod
+    def _adopted_config(container: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        What an adopted app needs to be scaled, from its container as listed by docker: the app port
+        (exposed or published) and how it is published. Empty if the container exposes no port.
+        """
+        ports = [port for port in container.get('Ports') or [] if port.get('PrivatePort') and port.get('Type', 'tcp') == 'tcp']
+        if not ports:
+            return {}
+        container_port = ports[0]['PrivatePort']
+        published = [port['PublicPort'] for port in ports if port['PrivatePort'] == container_port and port.get('PublicPort')]
+        if not published:
+            expose = 'network'
+        else:
+            expose = 'host' if container_port in published else 'ephemeral'
+        return {"port": container_port, "expose": expose}
+
+    def dispatch_deployment(self, repo_url: str, clone_strategy: Optional[str] = None, **options) -> DeploymentJob:
+        """
+        Enqueues the deployment of a repository. A request for a repository that is already
+        being deployed returns the job in progress instead of starting another build.
+        :param options: branch, overrides and prepared_clone of run_deployment.
+        """
+        return self.job_queue.submit('deploy', repo_url, self.run_deployment, repo_url, clone_strategy, **options,
+                                     key=normalize_repo_url(repo_url), dedupe='attach')
+
+    def dispatch_update(self, container_name: str) -> Optional[DeploymentJob]:
+        """
+        Enqueues the redeploy of an app. If an update is already running, a single follow-up
+        update is queued behind it, so commits pushed during a build end up in one more build
+        of the latest commit, however many there were.
+        :return: The update job, or None if the app is unknown.
+        """
+        app_state = self.deployed_apps.get(container_name)
+        if app_state is None:
+            return None
+        return self.job_queue.submit('update', container_name, self.trigger_update, container_name, app_state,
+                                     key=normalize_repo_url(app_state['repo_url']), dedupe='follow_up')
+
+    def dispatch_scale(self, container_name: str, replicas: int) -> DeploymentJob:
+        """Enqueues a scale of an app; it waits for any deployment of the app in progress."""
+        app_state = self.deployed_apps[container_name]
+        return self.job_queue.submit('scale', container_name, self.scale_app, container_name, replicas,
+                                     key=normalize_repo_url(app_state['repo_url']))
+
+    def handle_push_event(self, repo_urls: Set[str], branch: str, after: Optional[str]) -> List[DeploymentJob]:
+        """
+        Redeploys the apps tracking the pushed repository and branch.
+        :param repo_urls: Normalized URLs of the pushed repository.
+        :param branch: Pushed branch.
+        :param after: New head commit, if known.
+        :return: List of update jobs enqueued (or already in progress).
+        """
+        container_names = set()
+        for repo_url in repo_urls:
+            container_names.update(self.repo_index.get(repo_url, ()))
+
+        jobs = []
+        for container_name in sorted(container_names):
+            app_state = self.deployed_apps.get(container_name)
+            if app_state is None:
+                continue
+            tracked_branch = self._tracked_branch(app_state)
+            if tracked_branch != branch:
+                log.debug(f"Ignoring push to '{branch}' for '{container_name}' (tracks '{tracked_branch or 'no branch'}').")
+                continue
+
+            # Apps receiving webhooks only need occasional polling
+            app_state['last_webhook_at'] = time.time()
+            self._poll_backoff[container_name] = (time.time() + self.update_interval, self.update_interval)
+
+            if after and after == app_state.get('last_commit'):
+                log.info(f"Push for '{container_name}' points to the deployed commit {after[:7]}. Nothing to do.")
+                continue
+            log.info(f"Push to '{branch}' received for '{container_name}'. Queuing redeploy.")
+            job = self.dispatch_update(container_name)
+            if job is not None:
+                jobs.append(job)
+        return jobs
+
+    @staticmethod
+    def _tracked_branch(app_state: Dict[str, Any]) -> Optional[str]:
+        """
+        Branch an app follows: the one stored when it was deployed or, for apps stored without one
+        (adopted, or deployed from a detached head), the branch of its clone or the default branch of its remote.
+        """
+        if app_state.get('branch'):
+            return app_state['branch']
+        try:
+            repo = Repo(app_state['repo_path'])
+            if not repo.head.is_detached:
+                branch = repo.active_branch.name
+            else:
+                # refs/remotes/origin/HEAD -> refs/remotes/origin/<default branch>
+                branch = repo.remote('origin').refs.HEAD.reference.remote_head
+        except Exception as e:
+            log.debug(f"Could not tell the branch of {app_state.get('repo_path')}: {e}")
+            return None
+        app_state['branch'] = branch
+        return branch
+
+    def _should_poll(self, container_name: str, app_state: Dict[str, Any]) -> bool:
+        """Polling backs off for apps that received a webhook recently."""
+        last_webhook_at = app_state.get('last_webhook_at')
+        if not last_webhook_at or time.time() - last_webhook_at > self.webhook_recent_seconds:
+            self._poll_backoff.pop(container_name, None)
+            return True
+        next_poll_at, _ = self._poll_backoff.get(container_name, (0, self.update_interval))
+        return time.time() >= next_poll_at
+
+    def _record_poll(self, container_name: str, app_state: Dict[str, Any], changed: bool):
+        if not app_state.get('last_webhook_at'):
+            return
+        _, interval = self._poll_backoff.get(container_name, (0, self.update_interval))
+        interval = self.update_interval if changed else min(interval * 2, self.max_poll_backoff)
+        self._poll_backoff[container_name] = (time.time() + interval, interval)
+
     async def check_all_updates(self):
-        log.info(f"Checking updates for {len(self.deployed_apps)} deployed app(s).")
-        apps_to_update = []
-        for container_name, app_state in self.deployed_apps.items():
+        """
+        Polls every deployed app for new commits. Remote heads are resolved with a cheap
+        'git ls-remote' fanned out over a thread pool (bounded concurrency, per-remote timeout);
+        apps with a new head are handed to the job queue, so a tick never waits on a build.
+        """
+        tick_start = time.monotonic()
+        apps = list(self.deployed_apps.items())
+        log.info(f"Checking updates for {len(apps)} deployed app(s).")
+
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.poll_concurrency)
+        dispatched = 0
+
+        async def check_app(container_name: str, app_state: Dict[str, Any]):
+            nonlocal dispatched
             repo_path = app_state.get('repo_path')
             last_known_commit = app_state.get('last_commit')
-            log.debug(f"Checking app '{container_name}' at {repo_path} for updates...")
             if not repo_path or not last_known_commit:
                 log.error(f"Skipping app '{container_name}': missing state information.")
-                continue
+                return
 
-            try:
-                cloned_repo = Repo(repo_path)
-                # Fetch updates from the remote repository
+            pending_job = self.job_queue.active_job(normalize_repo_url(app_state['repo_url']))
+            if pending_job is not None:
+                log.debug(f"Job {pending_job.id} ({pending_job.kind}) in progress for '{container_name}'. Skipping check.")
+                return
+            if not self._should_poll(container_name, app_state):
+                log.debug(f"App '{container_name}' receives webhooks. Polling backed off.")
+                self.poll_stats['backed_off'] += 1
+                return
+
+            async with semaphore:
+                check_start = time.monotonic()
                 try:
-                    origin = cloned_repo.remotes.origin
-                    log.debug(f"Fetching updates for '{container_name}' from remote '{origin.name}'...")
-                    origin.fetch()
-                except Exception as fetch_e:
-                    log.error(f"Failed to fetch updates for '{container_name}': {fetch_e}")
-                    continue
-
-                # Get current HEAD
-                default_branch = 'main'
-                local_commit = cloned_repo.head.commit
-                remote_commit = None
-                if default_branch in origin.refs:
-                    remote_commit = origin.refs[default_branch].commit
-                else:
-                    default_branch = 'master'
-                    if default_branch in origin.refs:
-                        remote_commit = origin.refs[default_branch].commit
-                
-                if not remote_commit:
-                    log.warning(f"Could not find default branch ({default_branch} or master) in remote for '{container_name}'. Skipping update check.")
-                    continue
-
-                # Compare hashes
-                if local_commit.hexsha != remote_commit.hexsha:
-                    log.info(f"Update detected for '{container_name}'! Local: {local_commit.hexsha[:7]}, Remote: {remote_commit.hexsha[:7]}")
-                    # It would be ideal to launch the update in a separate thread or task
-                    # to avoid blocking the main thread. For now, we will just call the update function directly.
-                    await self.trigger_update(container_name, app_state)
-                else:
-                    log.debug(f"App '{container_name}' is up-to-date.")
-            
-            except Exception as e:
-                log.error(f"Error checking repository at '{repo_path}' for app '{container_name}': {e}")
+                    remote_commit = await asyncio.wait_for(
+                        loop.run_in_executor(self._poll_executor, self._get_remote_head, repo_path,
+                                             app_state['repo_url'], app_state.get('branch')),
+                        timeout=self.poll_timeout + 1,
+                    )
+                    REMOTE_CHECK_DURATION.observe(time.monotonic() - check_start)
+                except asyncio.TimeoutError:
+                    self.poll_stats['timeouts'] += 1
+                    log.error(f"Timed out checking remote of '{container_name}' after {self.poll_timeout}s.")
+                    return
+                except Exception as e:
+                    self.poll_stats['errors'] += 1
+                    log.error(f"Error checking repository at '{repo_path}' for app '{container_name}': {e}")
+                    return
+
+            if remote_commit is None:
+                log.warning(f"Could not resolve the remote branch for '{container_name}'. Skipping update check.")
+                return
+
+            changed = remote_commit != last_known_commit
+            self._record_poll(container_name, app_state, changed)
+            if changed:
+                log.info(f"Update detected for '{container_name}'! Local: {last_known_commit[:7]}, Remote: {remote_commit[:7]}")
+                self.dispatch_update(container_name)
+                dispatched += 1
+            else:
+                log.debug(f"App '{container_name}' is up-to-date.")
+
+        await asyncio.gather(*(check_app(name, state) for name, state in apps))
+
+        tick_duration = time.monotonic() - tick_start
+        UPDATE_CHECK_DURATION.observe(tick_duration)
+        stats = self.poll_stats
+        stats['ticks'] += 1
+        stats['apps_checked'] = len(apps)
+        stats['updates_dispatched'] += dispatched
+        stats['last_tick_at'] = time.time()
+        stats['last_tick_seconds'] = round(tick_duration, 3)
+        stats['max_tick_seconds'] = max(stats['max_tick_seconds'], stats['last_tick_seconds'])
+        if tick_duration > self.update_interval:
+            stats['overrun_ticks'] += 1
+            log.warning(f"Update check took {tick_duration:.1f}s, longer than the {self.update_interval}s interval.")
+        log.info(f"Update check finished in {tick_duration:.2f}s ({dispatched} update(s) dispatched).")
+
+    def record_skipped_tick(self):
+        """Called by the scheduler when a tick is skipped because the previous one is still running."""
+        self.poll_stats['skipped_ticks'] += 1
+        log.warning("Update check skipped: previous check still running.")
+
+    def _get_remote_head(self, repo_path: str, repo_url: Optional[str] = None, branch: Optional[str] = None) -> Optional[str]:
+        """
+        Resolves the remote commit of the checked out branch with 'git ls-remote',
+        without downloading any objects.
+        :param repo_url: Remote to ask when the clone was removed by the garbage collector, with its branch.
+        :return: Hash of the remote head, or None if the branch is not found.
+        """
+        if not os.path.isdir(repo_path) and repo_url:
+            git, remote = Git(), repo_url
+            branches = [branch] if branch else ['main', 'master']
+        else:
+            cloned_repo = Repo(repo_path)
+            git, remote = cloned_repo.git, 'origin'
+            try:
+                branches = [cloned_repo.active_branch.name]
+            except TypeError:
+                # Detached HEAD: fall back to the usual default branches
+                branches = ['main', 'master']
+
+        output = git.ls_remote(remote, *(f'refs/heads/{b}' for b in branches), kill_after_timeout=self.poll_timeout)
+        remote_heads = {}
+        for line in output.splitlines():
+            commit_hash, _, ref = line.partition('\t')
+            remote_heads[ref.strip()] = commit_hash.strip()
+
+        for branch in branches:
+            if f'refs/heads/{branch}' in remote_heads:
+                return remote_heads[f'refs/heads/{branch}']
+        return None
 
-    async def trigger_update(self, container_name: str, app_state: Dict[str, Any]):
-        """Realiza git pull y redespliega la aplicación."""
+    def _restore_clone(self, container_name: str, app_state: Dict[str, Any]):
+        """Clones the repository of a deployed app again, with its strategy and branch. Raises GitCommandError on failure."""
+        strategy = app_state.get('clone_strategy', 'full')
+        log.info(f"Clone of '{container_name}' was removed. Cloning '{app_state['repo_url']}' again ({strategy})...")
+        job_log(f"Clone was removed by the garbage collector, cloning again ({strategy})...")
+        mirror_path = self.mirrors.ensure(app_state['repo_url']) if strategy == 'reference' else None
+        options = clone_options(strategy, mirror_path)
+        if app_state.get('branch'):
+            options['branch'] = app_state['branch']
+        Repo.clone_from(app_state['repo_url'], app_state['repo_path'], progress=self._log_git_progress, **options)
+
+    @staticmethod
+    def _has_commit(repo: Repo, commit: Optional[str]) -> bool:
+        if not commit:
+            return False
+        try:
+            repo.git.cat_file('-e', f'{commit}^{{commit}}')
+            return True
+        except GitCommandError:
+            return False
+
+    def _count_skip(self, container_name: str, kind: str):
+        """
+        Counts an update that did not need a build ('skipped' or 'restarted'), together with
+        the build time it saved (duration of the last build of the app).
+        """
+        app_state = self.deployed_apps[container_name]
+        counts = dict(app_state.get('build_skips') or {'skipped': 0, 'restarted': 0, 'saved_build_seconds': 0.0})
+        counts[kind] += 1
+        counts['saved_build_seconds'] = round(counts['saved_build_seconds'] + (app_state.get('build_seconds') or 0.0), 3)
+        self._register_app(container_name, {"build_skips": counts})
+
+    def _skip_update(self, container_name: str, app_state: Dict[str, Any], new_commit: str, fetch_stats: Dict[str, Any],
+                     count: bool = True) -> Dict[str, Any]:
+        """
+        Records a new commit that changes nothing in the deployed app, without touching its containers.
+        :param count: Count it as a skipped build (False when there was no new commit at all).
+        """
+        log.success(f"Build inputs of '{container_name}' unchanged at {new_commit[:7]}. Skipping build and restart.")
+        job_log(f"Build inputs unchanged at {new_commit[:7]}, nothing to redeploy")
+        self._register_app(container_name, {"last_commit": new_commit, "clone_stats": fetch_stats})
+        if count:
+            self._count_skip(container_name, 'skipped')
+        return {
+            "message": "No relevant changes, deployment kept",
+            "app_name": app_state.get('app_name'),
+            "container_name": container_name,
+            "current_commit": new_commit,
+            "skipped": True,
+            "build_skips": self.deployed_apps[container_name].get("build_skips"),
+            "clone": fetch_stats,
+        }
+
+    def trigger_update(self, container_name: str, app_state: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Realiza git pull y redespliega la aplicación.
+        Runs on a job queue worker; raises DeploymentError if the update fails.
+        """
         repo_path = app_state['repo_path']
         repo_name = app_state['repo_name'] 
         repo_url = app_state['repo_url']
         log.info(f"Triggering update for '{container_name}'...")
 
+        # Taken before the clone can be restored: a new clone is already at the remote head
+        deployed_commit = app_state.get('last_commit')
         try:
+            restored = not os.path.isdir(repo_path)
+            if restored:
+                # Evicted by the garbage collector (clone disk budget): clone it again
+                with track_phase('clone'):
+                    self._restore_clone(container_name, app_state)
             cloned_repo = Repo(repo_path)
             origin = cloned_repo.remotes.origin
+            strategy = app_state.get('clone_strategy', 'full')
+            fetch_stats: Dict[str, Any] = {'strategy': strategy, 'bytes_received': None}
+            fetch_start = time.monotonic()
             log.info(f"Pulling changes for '{container_name}'...")
-            pull_info = origin.pull()
-
-            if pull_info[0].flags & FetchInfo.HEAD_UPTODATE:
-                log.info(f"Pull completed for '{container_name}', but no changes detected.")
-                app_state['last_commit'] = cloned_repo.head.commit.hexsha
+            with track_phase('pull'):
+                if strategy == 'reference':
+                    # Keep the shared mirror up to date for the next clones of the repository
+                    self.mirrors.ensure(repo_url)
+                if strategy == 'shallow':
+                    # Keep the clone shallow: fetch only the new head and move to it
+                    branch = app_state.get('branch') or cloned_repo.active_branch.name
+                    previous_commit = cloned_repo.head.commit.hexsha
+                    origin.fetch(refspec=branch, depth=1, progress=self._progress_tracker(fetch_stats))
+                    cloned_repo.git.reset('--hard', 'FETCH_HEAD')
+                    up_to_date = cloned_repo.head.commit.hexsha == previous_commit
+                else:
+                    pull_info = origin.pull(progress=self._progress_tracker(fetch_stats))
+                    up_to_date = bool(pull_info[0].flags & FetchInfo.HEAD_UPTODATE)
+            fetch_stats['duration_seconds'] = round(time.monotonic() - fetch_start, 3)
+            job_log(f"Fetch done: {strategy}, {fetch_stats['duration_seconds']}s, {fetch_stats['bytes_received'] or '?'} bytes received")
 
             new_commit_hash = cloned_repo.head.commit.hexsha
+            if restored:
+                # The pull of a fresh clone finds nothing new: compare with the deployed commit instead
+                up_to_date = new_commit_hash == deployed_commit
+            elif up_to_date:
+                log.info(f"Pull completed for '{container_name}', but no changes detected.")
+                app_state['last_commit'] = new_commit_hash
             log.success(f"Successfully pulled updates for '{container_name}'. New commit: {new_commit_hash[:7]}")
 
             # Generate a new Dockerfile content (in case the dockerfly.yaml changed)
-            generation_result = self.generate_dockerfile_content(repo_path)
+            with track_phase('generate'):
+                generation_result = self.generate_dockerfile_content(repo_path, app_state.get('config_overrides'))
             if generation_result is None:
                 log.error(f"Update failed for '{container_name}': Could not regenerate Dockerfile after pull.")
-                return
+                raise DeploymentError(f"Could not regenerate Dockerfile for '{container_name}' after pull", reason='invalid_config')
             dockerfile_content, new_app_config = generation_result
 
-            log.info(f"Redeploying application '{container_name}'...")
-            deployment_result = self.deploy_app(repo_path, repo_name, repo_url, dockerfile_content, new_app_config)
+            change = CHANGE_BUILD
+            if restored and not up_to_date and not self._has_commit(cloned_repo, deployed_commit):
+                # Shallow or partial clones may not have the deployed commit to diff against
+                log.info(f"Deployed commit of '{container_name}' is not in the new clone. Rebuilding.")
+            elif self.skip_unchanged_builds:
+                with track_phase('fingerprint'):
+                    change = classify_change(repo_path, app_state, new_commit_hash, dockerfile_content, new_app_config)
+            if change == CHANGE_NONE:
+                return self._skip_update(container_name, app_state, new_commit_hash, fetch_stats, count=not up_to_date)
 
+            log.info(f"Redeploying application '{container_name}'{' (restart only)' if change == CHANGE_RUNTIME else ''}...")
+            with track_phase('deploy'):
+                deployment_result = self.deploy_app(repo_path, repo_name, repo_url, dockerfile_content, new_app_config,
+                                                    reuse_image=app_state.get('image_id') if change == CHANGE_RUNTIME else None)
             if deployment_result:
+                # deploy_app already stored the new commit, image and config of the app (under its new name, if it changed)
+                container_name = deployment_result['container_name']
+                if change == CHANGE_RUNTIME:
+                    self._count_skip(container_name, 'restarted')
                 log.success(f"Update deployment successful for '{container_name}'.")
-                self.deployed_apps[container_name].update({
-                    "last_commit": new_commit_hash,
-                    "container_id": deployment_result.get("container_id"),
-                    "image_tag": deployment_result.get("image_tag"),
-                    "app_config": new_app_config
-                })
+                self._register_app(container_name, {"clone_stats": fetch_stats})
+                deployment_result['clone'] = fetch_stats
+                return deployment_result
             else:
                 # Only log for now, could implement rollback logic later.
                 log.error(f"Update failed for '{container_name}' during redeployment step.")
+                raise DeploymentError(f"Redeployment failed for '{container_name}'. Check server logs", reason='deploy_failed')
 
         except GitCommandError as git_err:
             log.error(f"Update failed for '{container_name}': Git pull failed. Command: '{git_err.command}'. Stderr: '{git_err.stderr.strip()}'")
-        except Exception as e:
-            log.exception(f"Unexpected error during update trigger for '{container_name}': {e}")
+            raise DeploymentError(f"Git pull failed for '{container_name}'", reason='git_error') from git_err
 
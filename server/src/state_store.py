@@ -0,0 +1,91 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from loguru import logger as log
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS apps (
+    container_name TEXT PRIMARY KEY,
+    repo_url TEXT NOT NULL,
+    last_commit TEXT,
+    image_tag TEXT,
+    state TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS deployments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    container_name TEXT NOT NULL,
+    commit_hash TEXT,
+    image_tag TEXT,
+    container_id TEXT,
+    app_config TEXT,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deployments_by_app ON deployments (container_name, id);
+"""
+
+
+class StateStore:
+    """
+    Durable store of the deployed apps and their deployment history, backed by SQLite
+    in WAL mode so reads at startup never wait on writes from the workers.
+    """
+
+    def __init__(self, db_path: str):
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(_SCHEMA)
+        log.info(f'State store opened at {db_path}')
+
+    def save_app(self, container_name: str, state: Dict[str, Any]):
+        """Inserts or replaces the state of an app."""
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO apps (container_name, repo_url, last_commit, image_tag, state, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (container_name, state.get('repo_url', ''), state.get('last_commit'), state.get('image_tag'),
+                 json.dumps(state, default=str), time.time()),
+            )
+
+    def delete_app(self, container_name: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM apps WHERE container_name = ?", (container_name,))
+
+    def load_apps(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            rows = self._conn.execute("SELECT container_name, state FROM apps").fetchall()
+        return {container_name: json.loads(state) for container_name, state in rows}
+
+    def record_deployment(self, container_name: str, commit_hash: Optional[str], image_tag: str,
+                          container_id: Optional[str], app_config: Dict[str, Any]):
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO deployments (container_name, commit_hash, image_tag, container_id, app_config, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (container_name, commit_hash, image_tag, container_id, json.dumps(app_config, default=str), time.time()),
+            )
+
+    def deployments(self, container_name: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """Returns the most recent deployments of an app, newest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT commit_hash, image_tag, container_id, app_config, created_at FROM deployments "
+                "WHERE container_name = ? ORDER BY id DESC LIMIT ?",
+                (container_name, limit),
+            ).fetchall()
+        return [
+            {"commit": commit_hash, "image_tag": image_tag, "container_id": container_id,
+             "app_config": json.loads(app_config) if app_config else None, "deployed_at": created_at}
+            for commit_hash, image_tag, container_id, app_config, created_at in rows
+        ]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,280 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Deque, Dict, List, Optional, Set, Tuple
+from docker.errors import APIError, InvalidVersion, NotFound
+from loguru import logger as log
+from requests.exceptions import RequestException
+from .metrics import AUTOSCALE_ACTIONS
+from .webhooks import normalize_repo_url
+
+if TYPE_CHECKING:
+    from .nodes import DockerNode
+    from .server import Server
+
+# Fields of the samples of an app, summed over its replicas (kept as tuples: a ring holds hours of them)
+SAMPLE_FIELDS = ('time', 'replicas', 'cpu_percent', 'memory_bytes', 'memory_limit_bytes',
+                 'rx_bytes_per_second', 'tx_bytes_per_second', 'restarts')
+
+AUTOSCALE_DEFAULTS = {'min_replicas': 1, 'max_replicas': 1, 'cpu_up': 75, 'cpu_down': 20, 'window': 60, 'cooldown': 300}
+
+
+def autoscale_errors(autoscale: Any) -> List[str]:
+    """Validation errors of the 'autoscale' section of dockerfly.yaml."""
+    if not isinstance(autoscale, dict):
+        return ["'autoscale' must be a mapping (e.g., {min_replicas: 1, max_replicas: 4, cpu_up: 75})."]
+    errors = []
+    rules = {**AUTOSCALE_DEFAULTS, **autoscale}
+    for name in AUTOSCALE_DEFAULTS:
+        if not isinstance(rules[name], (int, float)) or isinstance(rules[name], bool) or rules[name] < 0:
+            errors.append(f"'autoscale.{name}' must be a non-negative number.")
+    if errors:
+        return errors
+    if not 1 <= rules['min_replicas'] <= rules['max_replicas']:
+        errors.append("'autoscale' needs 1 <= min_replicas <= max_replicas.")
+    if rules['cpu_down'] >= rules['cpu_up']:
+        errors.append("'autoscale.cpu_down' must be lower than 'autoscale.cpu_up'.")
+    return errors
+
+
+def _cpu_total(stats: Dict[str, Any]) -> Tuple[Optional[int], Optional[int], int]:
+    cpu_stats = stats.get('cpu_stats') or {}
+    online_cpus = cpu_stats.get('online_cpus') or len((cpu_stats.get('cpu_usage') or {}).get('percpu_usage') or []) or 1
+    return (cpu_stats.get('cpu_usage') or {}).get('total_usage'), cpu_stats.get('system_cpu_usage'), online_cpus
+
+
+def _memory_used(stats: Dict[str, Any]) -> Tuple[int, int]:
+    """Memory in use as 'docker stats' shows it (without the page cache), and the limit."""
+    memory_stats = stats.get('memory_stats') or {}
+    details = memory_stats.get('stats') or {}
+    # cgroup v2 reports inactive_file, v1 total_inactive_file
+    cache = details.get('inactive_file', details.get('total_inactive_file', 0))
+    return max(0, memory_stats.get('usage', 0) - cache), memory_stats.get('limit', 0)
+
+
+class TelemetryCollector:
+    """
+    Samples CPU, memory, network and restarts of the DockerFly containers on every node and
+    keeps a ring of samples per app. Each tick reads one-shot stats of every container in
+    parallel, and computes CPU and network rates against the previous tick, so a tick takes
+    one round trip per container instead of the second a regular stats call waits for.
+    Restart counts are kept per container and only read again for the containers that were
+    started since the previous tick (one events call per node).
+
+    Apps with an 'autoscale' section in their dockerfly.yaml are scaled after each tick
+    when the average CPU of their replicas stays over or under its thresholds for the window.
+    """
+
+    def __init__(self, server: 'Server', app_label: str, candidate_label: str, samples: int = 360, concurrency: int = 16):
+        """
+        :param app_label: Label of the DockerFly containers (value: app name).
+        :param candidate_label: Label of the blue/green candidates, which are not sampled until they are swapped in.
+        :param samples: Samples kept per app.
+        """
+        self.server = server
+        self.app_label = app_label
+        self.candidate_label = candidate_label
+        self.samples = samples
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='dockerfly-stats')
+        self._lock = threading.Lock()
+        self._series: Dict[str, Deque[Tuple]] = {}
+        # Container id -> (time, cpu total, system cpu total, rx bytes, tx bytes) of the previous tick
+        self._previous: Dict[str, Tuple[float, Optional[int], Optional[int], int, int]] = {}
+        # Container id -> restart count, and node name -> end of the events read at the previous tick
+        self._restarts: Dict[str, int] = {}
+        self._events_until: Dict[str, int] = {}
+        self._one_shot = True
+        self._last_scaled: Dict[str, float] = {}
+        self.decisions: Deque[Dict[str, Any]] = deque(maxlen=100)
+        self.ticks = 0
+        self.last_tick_seconds: Optional[float] = None
+
+    def sample(self):
+        """Samples every DockerFly container and applies the autoscaling rules. Blocking: run it off the event loop."""
+        start = time.monotonic()
+        now = time.time()
+        containers: List[Tuple['DockerNode', Dict[str, Any], Optional[Set[str]]]] = []
+        for node in list(self.server.nodes.nodes.values()):
+            if not node.healthy:
+                continue
+            try:
+                summaries = node.client.api.containers(filters={'label': self.app_label, 'status': 'running'})
+            except (APIError, RequestException) as e:
+                log.warning(f"Could not list the containers of node '{node.name}': {e}")
+                continue
+            started = self._started_containers(node, now)
+            containers.extend((node, summary, started) for summary in summaries if not self._is_candidate(summary))
+
+        readings = list(self._executor.map(lambda item: self._read(*item, now), containers))
+        by_app: Dict[str, List[Dict[str, Any]]] = {}
+        for (_, summary, _), reading in zip(containers, readings):
+            if reading is not None:
+                by_app.setdefault(summary['Labels'][self.app_label], []).append(reading)
+
+        with self._lock:
+            for app, app_readings in by_app.items():
+                series = self._series.setdefault(app, deque(maxlen=self.samples))
+                series.append(self._aggregate(now, app_readings))
+            # Apps that are gone, and containers that are gone, are forgotten
+            for app in [app for app in self._series if app not in self.server.deployed_apps]:
+                del self._series[app]
+            sampled = {summary['Id'] for _, summary, _ in containers}
+            for container_id in [container_id for container_id in self._previous if container_id not in sampled]:
+                del self._previous[container_id]
+            for container_id in [container_id for container_id in self._restarts if container_id not in sampled]:
+                del self._restarts[container_id]
+            self.ticks += 1
+            self.last_tick_seconds = round(time.monotonic() - start, 3)
+
+        for app in by_app:
+            try:
+                self._autoscale(app, now)
+            except Exception as e:
+                log.error(f"Autoscaling of '{app}' failed: {e}")
+
+    def _is_candidate(self, summary: Dict[str, Any]) -> bool:
+        # A candidate keeps its label after the swap, but not the name it was created with
+        candidate_name = (summary.get('Labels') or {}).get(self.candidate_label)
+        return bool(candidate_name) and any(name.lstrip('/') == candidate_name for name in summary.get('Names') or [])
+
+    def _started_containers(self, node: 'DockerNode', now: float) -> Optional[Set[str]]:
+        """
+        DockerFly containers of a node started since the previous tick, from the events of the daemon.
+        :return: Their ids, or None if the events cannot be read (every restart count is read again).
+        """
+        until = int(now)
+        since, self._events_until[node.name] = self._events_until.get(node.name), until
+        if since is None:
+            # First tick: the restart counts of every container are read anyway
+            return set()
+        try:
+            events = node.client.api.events(since=since, until=until, decode=True,
+                                            filters={'type': 'container', 'event': 'start', 'label': self.app_label})
+            return {event.get('id') or (event.get('Actor') or {}).get('ID') for event in events}
+        except (APIError, RequestException) as e:
+            log.debug(f"Could not read the container events of node '{node.name}': {e}")
+            return None
+
+    def _read(self, node: 'DockerNode', summary: Dict[str, Any], started: Optional[Set[str]], now: float) -> Optional[Dict[str, Any]]:
+        """:param started: Containers started since the previous tick (None: unknown), whose restart count is read again."""
+        container_id = summary['Id']
+        try:
+            if self._one_shot:
+                try:
+                    stats = node.client.api.stats(container_id, stream=False, one_shot=True)
+                except InvalidVersion:
+                    # Daemons older than API 1.41: regular stats, which wait for a second sample
+                    log.info("The docker daemon does not support one-shot stats. Using regular stats.")
+                    self._one_shot = False
+                    stats = node.client.api.stats(container_id, stream=False)
+            else:
+                stats = node.client.api.stats(container_id, stream=False)
+            with self._lock:
+                restarts = self._restarts.get(container_id)
+            if restarts is None or started is None or container_id in started:
+                restarts = node.client.api.inspect_container(container_id).get('RestartCount', 0)
+                with self._lock:
+                    self._restarts[container_id] = restarts
+        except NotFound:
+            return None
+        except (APIError, RequestException) as e:
+            log.debug(f"Could not read the stats of container {container_id[:12]} on node '{node.name}': {e}")
+            return None
+
+        cpu_total, system_total, online_cpus = _cpu_total(stats)
+        networks = (stats.get('networks') or {}).values()
+        rx_bytes = sum(network.get('rx_bytes', 0) for network in networks)
+        tx_bytes = sum(network.get('tx_bytes', 0) for network in networks)
+        memory, memory_limit = _memory_used(stats)
+
+        with self._lock:
+            previous = self._previous.get(container_id)
+            self._previous[container_id] = (now, cpu_total, system_total, rx_bytes, tx_bytes)
+        cpu_percent = rx_rate = tx_rate = None
+        if previous is not None:
+            previous_time, previous_cpu, previous_system, previous_rx, previous_tx = previous
+            if None not in (cpu_total, system_total, previous_cpu, previous_system) and system_total > previous_system:
+                cpu_percent = max(0.0, (cpu_total - previous_cpu) / (system_total - previous_system) * online_cpus * 100)
+            elapsed = now - previous_time
+            if elapsed > 0:
+                rx_rate = max(0.0, (rx_bytes - previous_rx) / elapsed)
+                tx_rate = max(0.0, (tx_bytes - previous_tx) / elapsed)
+        return {"cpu_percent": cpu_percent, "memory_bytes": memory, "memory_limit_bytes": memory_limit,
+                "rx_bytes_per_second": rx_rate, "tx_bytes_per_second": tx_rate, "restarts": restarts}
+
+    @staticmethod
+    def _aggregate(now: float, readings: List[Dict[str, Any]]) -> Tuple:
+        def total(field: str) -> Optional[float]:
+            values = [reading[field] for reading in readings if reading[field] is not None]
+            return round(sum(values), 3) if values else None
+
+        return (round(now, 3), len(readings), total('cpu_percent'), total('memory_bytes'), total('memory_limit_bytes'),
+                total('rx_bytes_per_second'), total('tx_bytes_per_second'), total('restarts'))
+
+    def series(self, app: str, since: Optional[float] = None) -> List[Dict[str, Any]]:
+        """Samples of an app, oldest first, optionally only the ones taken after since."""
+        with self._lock:
+            samples = list(self._series.get(app, ()))
+        return [dict(zip(SAMPLE_FIELDS, sample)) for sample in samples if since is None or sample[0] > since]
+
+    def _autoscale(self, app: str, now: float):
+        app_state = self.server.deployed_apps.get(app)
+        autoscale = ((app_state or {}).get('app_config') or {}).get('autoscale')
+        if not autoscale:
+            return
+        rules = {**AUTOSCALE_DEFAULTS, **autoscale}
+        current = len(app_state.get('replicas') or []) or 1
+        # Nothing is decided while a deployment or a scale of the app is queued or running, or during the cooldown
+        if self.server.job_queue.active_job(normalize_repo_url(app_state['repo_url'])) is not None:
+            return
+        if now - self._last_scaled.get(app, 0) < rules['cooldown']:
+            return
+
+        target, reason = current, None
+        if current < rules['min_replicas'] or current > rules['max_replicas']:
+            target = min(max(current, rules['min_replicas']), rules['max_replicas'])
+            reason = f"{current} replica(s) outside of {rules['min_replicas']}-{rules['max_replicas']}"
+        else:
+            with self._lock:
+                series = list(self._series.get(app, ()))
+            # The samples have to cover the whole window: a single spike does not scale an app
+            if not series or series[0][0] > now - rules['window']:
+                return
+            window = [sample for sample in series if sample[0] >= now - rules['window']]
+            cpu = [sample[2] / sample[1] for sample in window if sample[2] is not None and sample[1]]
+            if not cpu:
+                return
+            average = sum(cpu) / len(cpu)
+            if average > rules['cpu_up'] and current < rules['max_replicas']:
+                target, reason = current + 1, f"average CPU {average:.1f}% per replica over {rules['cpu_up']}%"
+            elif average < rules['cpu_down'] and current > rules['min_replicas']:
+                target, reason = current - 1, f"average CPU {average:.1f}% per replica under {rules['cpu_down']}%"
+        if target == current:
+            return
+
+        log.info(f"Autoscaling '{app}' from {current} to {target} replica(s): {reason}.")
+        job = self.server.dispatch_scale(app, target)
+        self._last_scaled[app] = now
+        AUTOSCALE_ACTIONS.labels('up' if target > current else 'down').inc()
+        self.decisions.append({"app": app, "time": now, "from": current, "to": target, "reason": reason, "job_id": job.id})
+
+    def app_stats(self, app: str, since: Optional[float] = None) -> Dict[str, Any]:
+        autoscale = ((self.server.deployed_apps.get(app) or {}).get('app_config') or {}).get('autoscale')
+        return {
+            "app": app,
+            "samples": self.series(app, since),
+            "autoscale": {
+                "rules": {**AUTOSCALE_DEFAULTS, **autoscale} if autoscale else None,
+                "last_scaled_at": self._last_scaled.get(app),
+                "decisions": [decision for decision in list(self.decisions) if decision['app'] == app],
+            },
+        }
+
+    def latest(self) -> Dict[str, Dict[str, Any]]:
+        """Last sample of each app."""
+        with self._lock:
+            return {app: dict(zip(SAMPLE_FIELDS, series[-1])) for app, series in self._series.items() if series}
+
+    def close(self):
+        self._executor.shutdown(wait=False)
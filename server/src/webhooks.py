@@ -0,0 +1,94 @@
+import hashlib
+import hmac
+import re
+from typing import Any, Dict, Mapping, Optional, Set, Tuple
+from urllib.parse import urlsplit
+
+# scp-like syntax used by ssh remotes: git@host:owner/repo.git
+_SCP_URL = re.compile(r'^(?:[^@/]+@)?(?P<host>[^:/]+):(?P<path>(?!//).+)$')
+
+# Payload keys holding the repository URL in GitHub, GitLab and Gitea push events
+_URL_KEYS = ('clone_url', 'ssh_url', 'git_url', 'html_url', 'url', 'git_http_url', 'git_ssh_url', 'http_url', 'web_url', 'homepage')
+
+_NULL_COMMIT = '0' * 40
+
+
+def normalize_repo_url(url: str) -> str:
+    """
+    Reduces the different spellings of a repository URL (https, ssh, scp-like, with or
+    without '.git') to a single key, e.g. 'github.com/owner/repo'. Local paths are kept as paths.
+    """
+    url = url.strip()
+    parsed = urlsplit(url)
+    if parsed.scheme and parsed.scheme != 'file' and parsed.hostname:
+        host, path = parsed.hostname, parsed.path
+    else:
+        scp_match = _SCP_URL.match(url) if not parsed.scheme else None
+        if scp_match and not url.startswith('/'):
+            host, path = scp_match.group('host'), scp_match.group('path')
+        else:
+            host, path = '', parsed.path if parsed.scheme == 'file' else url
+
+    path = path.rstrip('/')
+    if path.endswith('.git'):
+        path = path[:-len('.git')]
+    if not host:
+        return path
+    return f"{host.lower()}/{path.strip('/').lower()}"
+
+
+def verify_signature(headers: Mapping[str, str], body: bytes, secret: str) -> bool:
+    """
+    Checks the authenticity of a webhook request.
+    GitHub and Gitea send an HMAC-SHA256 of the body, GitLab sends the shared token as is.
+    :param headers: Request headers.
+    :param body: Raw request body.
+    :param secret: Secret configured in the git provider.
+    :return: True if the request is signed with the secret.
+    """
+    headers = {key.lower(): value for key, value in headers.items()}
+    expected = hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+    github_signature = headers.get('x-hub-signature-256')
+    if github_signature:
+        return hmac.compare_digest(github_signature, f'sha256={expected}')
+
+    gitea_signature = headers.get('x-gitea-signature') or headers.get('x-gogs-signature')
+    if gitea_signature:
+        return hmac.compare_digest(gitea_signature, expected)
+
+    gitlab_token = headers.get('x-gitlab-token')
+    if gitlab_token:
+        return hmac.compare_digest(gitlab_token, secret)
+
+    return False
+
+
+def parse_push_event(payload: Dict[str, Any]) -> Optional[Tuple[Set[str], str, Optional[str]]]:
+    """
+    Extracts the repository, branch and new head commit from a push payload.
+    :return: Tuple [normalized repository URLs, branch, new commit], or None if the
+             payload is not a push to a branch (tags, branch deletions, other events).
+    """
+    ref = payload.get('ref')
+    if not isinstance(ref, str) or not ref.startswith('refs/heads/'):
+        return None
+    branch = ref[len('refs/heads/'):]
+
+    after = payload.get('after') or payload.get('checkout_sha')
+    if after == _NULL_COMMIT:
+        return None
+
+    repo_urls = set()
+    for section in ('repository', 'project'):
+        data = payload.get(section)
+        if not isinstance(data, dict):
+            continue
+        for key in _URL_KEYS:
+            value = data.get(key)
+            if isinstance(value, str) and value:
+                repo_urls.add(normalize_repo_url(value))
+
+    if not repo_urls:
+        return None
+    return repo_urls, branch, after
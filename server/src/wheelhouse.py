@@ -0,0 +1,394 @@
+import html
+import io
+import json
+import os
+import re
+import tarfile
+import tempfile
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Dict, List, Optional, Tuple
+from loguru import logger as log
+from docker.errors import APIError, ImageNotFound
+from requests.exceptions import RequestException
+from .admission import BuildAdmission, lane_for
+from .deps_cache import DependencyImageCache
+from .dockerfile import base_image
+from .jobs import current_job, job_log
+
+# Names accepted in the wheelhouse URLs (platform tags, set keys and wheel file names)
+_SAFE_NAME = re.compile(r'^[A-Za-z0-9][A-Za-z0-9._+-]*$')
+# Limits of the helper container, by their name in the build container_limits
+_CONTAINER_LIMITS = {'memory': 'mem_limit', 'memswap': 'memswap_limit', 'cpushares': 'cpu_shares', 'cpusetcpus': 'cpuset_cpus'}
+
+
+class Wheelhouse:
+    """
+    Local cache of the wheels installed by the app builds, served over HTTP so builds
+    install with --no-index instead of downloading from the package index every time.
+
+    Wheels live in one directory per platform tag (Python version and architecture, e.g.
+    'py3.10-x86_64'), one file per package and version, so every app using the same version
+    of a package shares it. The wheels of a requirements file are made by 'pip wheel' in a
+    helper container of the app's base image, which reuses the wheels already cached and
+    builds the missing sdists once. The set of wheels of each requirements file is kept as a
+    manifest: a build gets the find-links URL of its set, so it installs exactly what 'pip
+    wheel' resolved. Wheels are evicted LRU when the wheelhouse exceeds its disk budget.
+    """
+    SETS_DIRECTORY = 'sets'
+    REQUIREMENTS_DIRECTORY = '/tmp/dockerfly-wheelhouse'
+
+    def __init__(self, path: str, url: Optional[str], docker_client, disk_budget_bytes: int = 5 * 1024 ** 3,
+                 index_url: Optional[str] = None, network: Optional[str] = None, admission: Optional[BuildAdmission] = None,
+                 build_limits: Optional[Dict[str, Any]] = None, build_timeout: Optional[float] = None,
+                 min_age_seconds: float = 3600):
+        """
+        :param path: Directory of the wheels and the sets.
+        :param url: Base URL of the server as seen from the build containers. The wheelhouse is disabled without it.
+        :param index_url: Package index of 'pip wheel' (default: PyPI). May be a local directory index.
+        :param network: Docker network of the helper containers.
+        :param admission: Build slots shared with the app builds.
+        :param build_timeout: Seconds a 'pip wheel' run may take.
+        :param min_age_seconds: Wheels used more recently than this are not evicted, so builds in progress still find them.
+        """
+        self.path = path
+        self.url = url.rstrip('/') if url else None
+        self.docker_client = docker_client
+        self.disk_budget_bytes = disk_budget_bytes
+        self.index_url = index_url
+        self.network = network
+        self.admission = admission
+        self.build_limits = build_limits or {}
+        self.build_timeout = build_timeout
+        self.min_age_seconds = min_age_seconds
+        self._platform: Optional[str] = None
+        # (platform tag, file name) -> size and last use
+        self._wheels: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        # Set key -> platform tag and wheel file names
+        self._sets: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        # Set key -> [lock, number of deploys holding or waiting for it]; dropped when nobody does
+        self._key_locks: Dict[str, List[Any]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+        self.wheels_reused = 0
+        self.wheels_added = 0
+        self.served_files = 0
+        self.served_bytes = 0
+        if self.enabled:
+            self._load_existing()
+
+    @property
+    def enabled(self) -> bool:
+        return self.url is not None
+
+    def ensure(self, python_version: str, requirements_text: str) -> Optional[str]:
+        """
+        Makes sure the wheelhouse has every wheel the requirements need, running 'pip wheel' on a miss.
+        :return: find-links URL of the wheels of the requirements, or None if they cannot be served from the wheelhouse.
+        """
+        normalized = DependencyImageCache.normalize_requirements(requirements_text)
+        if normalized is None:
+            log.info("Requirements reference other files or local paths. Wheelhouse not used.")
+            return None
+
+        platform_tag = f"py{python_version}-{self.platform()}"
+        key = DependencyImageCache.cache_key(platform_tag, normalized)[:16]
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            key_lock[1] += 1
+        try:
+            built = self._ensure_locked(key_lock[0], key, platform_tag, python_version, normalized)
+        finally:
+            with self._lock:
+                key_lock[1] -= 1
+                if key_lock[1] == 0:
+                    del self._key_locks[key]
+        if built is None:
+            return None
+        if built:
+            self._evict(keep=key)
+        return self.set_url(platform_tag, key)
+
+    def _ensure_locked(self, key_lock: threading.Lock, key: str, platform_tag: str, python_version: str,
+                       normalized: str) -> Optional[bool]:
+        """:return: Whether the wheels were built (False if the set was complete), or None if they could not be."""
+        # Concurrent deploys of apps with the same requirements wait for a single 'pip wheel'
+        with key_lock:
+            with self._lock:
+                complete = self._is_complete(key)
+                if complete:
+                    self.hits += 1
+                    self._touch_set(key)
+            if complete:
+                self._touch_set_file(key)
+                log.info(f"Wheelhouse hit: {platform_tag}/{key}")
+                return False
+
+            with self._lock:
+                self.misses += 1
+            log.info(f"Wheelhouse miss. Building the wheels of {platform_tag}/{key}...")
+            job_log(f"Building the wheels of the requirements ({platform_tag})...")
+            wheels = self._build_wheels(platform_tag, python_version, normalized)
+            if wheels is None:
+                with self._lock:
+                    self.failures += 1
+                return None
+            self._save_set(key, platform_tag, wheels)
+        return True
+
+    def platform(self) -> str:
+        """Architecture of the daemon the wheels are built on (e.g. 'x86_64')."""
+        if self._platform is None:
+            try:
+                self._platform = self.docker_client.info().get('Architecture') or 'x86_64'
+            except (APIError, RequestException) as e:
+                log.warning(f"Could not read the architecture of the docker daemon, assuming x86_64: {e}")
+                return 'x86_64'
+        return self._platform
+
+    def set_url(self, platform_tag: str, key: str) -> str:
+        return f"{self.url}/wheelhouse/{platform_tag}/{key}/"
+
+    def index_page(self, platform_tag: str, key: Optional[str] = None) -> Optional[str]:
+        """
+        find-links page listing the wheels of a set, or every wheel of a platform tag (empty if it has none yet).
+        :return: HTML page, or None if the set is unknown.
+        """
+        with self._lock:
+            if key is not None:
+                wheel_set = self._sets.get(key)
+                if wheel_set is None or wheel_set['platform'] != platform_tag:
+                    return None
+                names, prefix = wheel_set['wheels'], '../files/'
+            else:
+                names = [name for (tag, name) in self._wheels if tag == platform_tag]
+                prefix = 'files/'
+        links = "\n".join(f'<a href="{prefix}{html.escape(name)}">{html.escape(name)}</a><br>' for name in sorted(names))
+        return f"<!DOCTYPE html>\n<html><body>\n{links}\n</body></html>\n"
+
+    def wheel_path(self, platform_tag: str, name: str) -> Optional[str]:
+        """Path of a cached wheel, counted as served. None if it is not in the wheelhouse."""
+        if not _SAFE_NAME.match(platform_tag) or not _SAFE_NAME.match(name):
+            return None
+        with self._lock:
+            wheel = self._wheels.get((platform_tag, name))
+            if wheel is None:
+                return None
+            wheel['last_used'] = time.time()
+            self.served_files += 1
+            self.served_bytes += wheel['size']
+        return os.path.join(self.path, platform_tag, name)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            platforms: Dict[str, Dict[str, int]] = {}
+            for (platform_tag, _), wheel in self._wheels.items():
+                entry = platforms.setdefault(platform_tag, {"wheels": 0, "size_bytes": 0})
+                entry['wheels'] += 1
+                entry['size_bytes'] += wheel['size']
+            return {
+                "enabled": self.enabled,
+                "url": self.url,
+                "index_url": self.index_url,
+                "sets": len(self._sets),
+                "wheels": len(self._wheels),
+                "size_bytes": sum(wheel['size'] for wheel in self._wheels.values()),
+                "disk_budget_bytes": self.disk_budget_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "failures": self.failures,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else None,
+                "wheels_reused": self.wheels_reused,
+                "wheels_added": self.wheels_added,
+                "served_files": self.served_files,
+                "served_bytes": self.served_bytes,
+                "platforms": platforms,
+            }
+
+    def _is_complete(self, key: str) -> bool:
+        wheel_set = self._sets.get(key)
+        return wheel_set is not None and all((wheel_set['platform'], name) in self._wheels for name in wheel_set['wheels'])
+
+    def _touch_set(self, key: str):
+        wheel_set = self._sets[key]
+        now = time.time()
+        for name in wheel_set['wheels']:
+            self._wheels[(wheel_set['platform'], name)]['last_used'] = now
+        wheel_set['last_used'] = now
+
+    def _touch_set_file(self, key: str):
+        # The time of the set file is its last use, and the one of its wheels, after a restart
+        try:
+            os.utime(os.path.join(self.path, self.SETS_DIRECTORY, f"{key}.json"))
+        except OSError:
+            pass
+
+    def _build_wheels(self, platform_tag: str, python_version: str, normalized_requirements: str) -> Optional[List[str]]:
+        """Runs 'pip wheel' in a helper container and stores the wheels it made. :return: Their file names, or None."""
+        command = [
+            'pip', 'wheel', '--disable-pip-version-check', '--wheel-dir', '/wheels',
+            # Wheels already in the wheelhouse are reused instead of downloaded or built again
+            '--find-links', f"{self.url}/wheelhouse/{platform_tag}/",
+            '-r', f"{self.REQUIREMENTS_DIRECTORY}/requirements.txt",
+        ]
+        if self.index_url:
+            command.extend(('--index-url', self.index_url))
+        limits = {_CONTAINER_LIMITS[name]: value for name, value in self.build_limits.items() if name in _CONTAINER_LIMITS}
+        image = base_image(python_version)
+        start = time.monotonic()
+        container = None
+        try:
+            with self.admission.admit(lane_for(current_job())) if self.admission else nullcontext():
+                try:
+                    container = self.docker_client.containers.create(image, command, network=self.network, **limits)
+                except ImageNotFound:
+                    self.docker_client.images.pull(*image.split(':', 1))
+                    container = self.docker_client.containers.create(image, command, network=self.network, **limits)
+                container.put_archive('/tmp', self._requirements_archive(normalized_requirements))
+                container.start()
+                result = container.wait(timeout=self.build_timeout)
+                if result.get('StatusCode') != 0:
+                    log.error(f"'pip wheel' failed for {platform_tag} (exit code {result.get('StatusCode')}):")
+                    for line in container.logs(tail=30).decode(errors='replace').splitlines():
+                        log.error(line)
+                    return None
+                wheels = self._extract_wheels(container, platform_tag)
+        except (APIError, ImageNotFound) as e:
+            log.error(f"Docker API error building the wheels of {platform_tag}: {e}")
+            return None
+        except RequestException as e:
+            log.error(f"'pip wheel' for {platform_tag} aborted: {e}")
+            return None
+        finally:
+            if container is not None:
+                try:
+                    container.remove(force=True)
+                except APIError as e:
+                    log.warning(f"Could not remove wheelhouse helper container {container.short_id}: {e}")
+        log.success(f"Wheels of {platform_tag} ready in {time.monotonic() - start:.1f}s ({len(wheels)} wheel(s)).")
+        return wheels
+
+    def _requirements_archive(self, normalized_requirements: str) -> bytes:
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            data = (normalized_requirements + "\n").encode()
+            info = tarfile.TarInfo(f"{os.path.basename(self.REQUIREMENTS_DIRECTORY)}/requirements.txt")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        return archive.getvalue()
+
+    def _extract_wheels(self, container, platform_tag: str) -> List[str]:
+        """Copies the wheels made by 'pip wheel' out of the helper container into the wheelhouse."""
+        directory = os.path.join(self.path, platform_tag)
+        os.makedirs(directory, exist_ok=True)
+        stream, _ = container.get_archive('/wheels')
+        names = []
+        # Spooled to disk: the wheels of a requirements file can take hundreds of MB
+        with tempfile.TemporaryFile() as spool:
+            for chunk in stream:
+                spool.write(chunk)
+            spool.seek(0)
+            with tarfile.open(fileobj=spool, mode='r|') as tar:
+                for member in tar:
+                    name = os.path.basename(member.name)
+                    if not member.isfile() or not name.endswith('.whl') or not _SAFE_NAME.match(name):
+                        continue
+                    names.append(name)
+                    with self._lock:
+                        cached = (platform_tag, name) in self._wheels
+                    if cached:
+                        with self._lock:
+                            self.wheels_reused += 1
+                        continue
+                    target = os.path.join(directory, name)
+                    with open(target + '.part', 'wb') as f:
+                        f.write(tar.extractfile(member).read())
+                    os.replace(target + '.part', target)
+                    with self._lock:
+                        self._wheels[(platform_tag, name)] = {"size": member.size, "last_used": time.time()}
+                        self.wheels_added += 1
+        return names
+
+    def _save_set(self, key: str, platform_tag: str, wheels: List[str]):
+        wheel_set = {"platform": platform_tag, "wheels": sorted(wheels), "last_used": time.time()}
+        sets_directory = os.path.join(self.path, self.SETS_DIRECTORY)
+        try:
+            os.makedirs(sets_directory, exist_ok=True)
+            with open(os.path.join(sets_directory, f"{key}.json"), 'w', encoding='utf-8') as f:
+                json.dump({"platform": platform_tag, "wheels": wheel_set['wheels']}, f)
+        except OSError as e:
+            log.warning(f"Could not save wheel set {key}: {e}")
+        with self._lock:
+            self._sets[key] = wheel_set
+
+    def _load_existing(self):
+        # Wheels and sets made before a restart are still on disk; file times stand for their last use
+        if not os.path.isdir(self.path):
+            return
+        for entry in os.scandir(self.path):
+            if not entry.is_dir(follow_symlinks=False) or entry.name == self.SETS_DIRECTORY:
+                continue
+            for wheel in os.scandir(entry.path):
+                if wheel.name.endswith('.whl') and wheel.is_file(follow_symlinks=False):
+                    stat = wheel.stat()
+                    self._wheels[(entry.name, wheel.name)] = {"size": stat.st_size, "last_used": stat.st_mtime}
+        sets_directory = os.path.join(self.path, self.SETS_DIRECTORY)
+        if os.path.isdir(sets_directory):
+            for entry in os.scandir(sets_directory):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    with open(entry.path, 'r', encoding='utf-8') as f:
+                        wheel_set = json.load(f)
+                    self._sets[entry.name[:-len('.json')]] = {**wheel_set, "last_used": entry.stat().st_mtime}
+                except (OSError, ValueError) as e:
+                    log.warning(f"Ignoring unreadable wheel set {entry.path}: {e}")
+        for wheel_set in self._sets.values():
+            for name in wheel_set['wheels']:
+                wheel = self._wheels.get((wheel_set['platform'], name))
+                if wheel is not None:
+                    wheel['last_used'] = max(wheel['last_used'], wheel_set['last_used'])
+        log.info(f"Wheelhouse loaded with {len(self._wheels)} wheel(s) in {len(self._sets)} set(s).")
+
+    def _evict(self, keep: Optional[str] = None):
+        """
+        Removes the least recently used wheels until the wheelhouse fits in its disk budget.
+        :param keep: Set whose wheels are kept (the one a build is about to install).
+        """
+        with self._lock:
+            kept = {(self._sets[keep]['platform'], name) for name in self._sets[keep]['wheels']} if keep in self._sets else set()
+            total_size = sum(wheel['size'] for wheel in self._wheels.values())
+            if total_size <= self.disk_budget_bytes:
+                return
+            recent = time.time() - self.min_age_seconds
+            victims = []
+            for wheel_key, wheel in sorted(self._wheels.items(), key=lambda item: item[1]['last_used']):
+                if total_size <= self.disk_budget_bytes or wheel['last_used'] > recent:
+                    break
+                if wheel_key in kept:
+                    continue
+                victims.append(wheel_key)
+                total_size -= wheel['size']
+            for wheel_key in victims:
+                del self._wheels[wheel_key]
+            # Sets missing a wheel are built again on their next use
+            broken_sets = [key for key in self._sets if not self._is_complete(key)]
+            for key in broken_sets:
+                del self._sets[key]
+
+        for platform_tag, name in victims:
+            try:
+                os.remove(os.path.join(self.path, platform_tag, name))
+            except OSError as e:
+                log.warning(f"Could not evict wheel {platform_tag}/{name}: {e}")
+        for key in broken_sets:
+            try:
+                os.remove(os.path.join(self.path, self.SETS_DIRECTORY, f"{key}.json"))
+            except OSError:
+                pass
+        if victims:
+            log.info(f"Evicted {len(victims)} wheel(s) from the wheelhouse; {len(broken_sets)} set(s) will be built again.")
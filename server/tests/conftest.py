@@ -0,0 +1,87 @@
+"""
+Fixtures of the tests: a Server on the fake Docker client of the benchmarks, local bare
+remotes as git repositories, and the FastAPI app with that server, so the whole push path
+runs without Docker or network access.
+"""
+import importlib
+import os
+import tempfile
+import threading
+from unittest import mock
+import docker
+import pytest
+from benchmarks.common import quiet_logs
+from benchmarks.fakes import FakeDockerClient
+from benchmarks.fixtures import create_remote
+from src import Server
+
+WEBHOOK_SECRET = 'webhook-secret'
+
+
+def wait_for(job, timeout: float = 30):
+    """Waits for a deployment job to finish and returns it."""
+    done = threading.Event()
+    job.add_done_callback(lambda _: done.set())
+    assert done.wait(timeout), f"Job {job.id} ({job.kind} {job.target}) did not finish in {timeout}s"
+    return job
+
+
+@pytest.fixture
+def docker_client():
+    return FakeDockerClient({})
+
+
+@pytest.fixture
+def make_server(tmp_path, docker_client):
+    """Creates servers on the fake Docker client; main_config entries can be overridden."""
+    servers = []
+
+    def make(**config):
+        server = Server(str(tmp_path / 'clones'), {
+            'state_db_path': str(tmp_path / 'state.db'),
+            'webhook_secret': WEBHOOK_SECRET,
+            'update_interval_seconds': 60,
+            'max_poll_backoff_seconds': 600,
+            **config,
+        }, max_workers=2, docker_client=docker_client)
+        servers.append(server)
+        quiet_logs()
+        return server
+
+    yield make
+    for server in servers:
+        server.job_queue.shutdown()
+
+
+@pytest.fixture
+def server(make_server):
+    return make_server()
+
+
+@pytest.fixture
+def remote(tmp_path):
+    """Bare repository of an app named 'svc', on branch 'main'."""
+    return create_remote(str(tmp_path / 'git'), 'svc', 8000)
+
+
+@pytest.fixture(scope='session')
+def main_module():
+    """The API module, imported once with the fake Docker client (tests swap its server)."""
+    base_path = tempfile.mkdtemp(prefix='dockerfly-tests-')
+    os.environ.update({
+        'REPO_PATH': os.path.join(base_path, 'clones'),
+        'STATE_DB_PATH': os.path.join(base_path, 'state.db'),
+        'POLL_ENABLED': 'false',
+    })
+    with mock.patch.object(docker, 'from_env', return_value=FakeDockerClient({})):
+        main = importlib.import_module('main')
+    quiet_logs()
+    return main
+
+
+@pytest.fixture
+def api(main_module, server, monkeypatch):
+    """Client of the API, served by the server fixture (the scheduler of the app is not started)."""
+    from fastapi.testclient import TestClient
+    monkeypatch.setattr(main_module, 'server', server)
+    return TestClient(main_module.app)
@@ -0,0 +1,124 @@
+"""
+Build admission: parallel build limit, priority of the user lane over automatic updates, and
+builds cancelled when they exceed the build timeout.
+
+Usage (from the server directory):
+    python -m pytest tests
+"""
+import threading
+import time
+from types import SimpleNamespace
+import pytest
+from src.admission import BuildAdmission, lane_for
+from src.jobs import DeploymentError, DeploymentJob
+
+
+def hold(admission: BuildAdmission, lane: str, order: list, release: threading.Event) -> threading.Thread:
+    """Starts a build of a lane that keeps its slot until release is set."""
+    def build():
+        with admission.admit(lane):
+            order.append(lane)
+            release.wait(5)
+
+    thread = threading.Thread(target=build, daemon=True)
+    thread.start()
+    return thread
+
+
+def wait_until(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "Condition not met in time"
+        time.sleep(0.01)
+
+
+def test_lane_of_a_job():
+    assert lane_for(None) == 'user'
+    assert lane_for(DeploymentJob('deploy', 'svc')) == 'user'
+    assert lane_for(DeploymentJob('update', 'svc')) == 'scheduler'
+
+
+def test_builds_over_the_limit_wait_for_a_slot():
+    admission = BuildAdmission(max_parallel=2)
+    order, release = [], threading.Event()
+    threads = [hold(admission, 'scheduler', order, release) for _ in range(3)]
+
+    wait_until(lambda: admission.stats()['lanes']['scheduler']['waiting'] == 1)
+    assert admission.stats()['running'] == 2 and len(order) == 2
+
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    stats = admission.stats()
+    assert stats['running'] == 0 and stats['lanes']['scheduler']['admitted'] == 3
+
+
+def test_user_builds_go_before_automatic_updates():
+    admission = BuildAdmission(max_parallel=1)
+    order, release_first, release = [], threading.Event(), threading.Event()
+    threads = [hold(admission, 'scheduler', order, release_first)]
+    wait_until(lambda: order == ['scheduler'])
+    threads.append(hold(admission, 'scheduler', order, release))
+    wait_until(lambda: admission.stats()['lanes']['scheduler']['waiting'] == 1)
+    threads.append(hold(admission, 'user', order, release))
+    wait_until(lambda: admission.stats()['lanes']['user']['waiting'] == 1)
+
+    release_first.set()
+    wait_until(lambda: len(order) == 2)
+    # The user build queued last takes the freed slot
+    assert order == ['scheduler', 'user']
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert order == ['scheduler', 'user', 'scheduler']
+
+
+def test_build_exceeding_its_timeout_is_cancelled(make_server, remote, docker_client, monkeypatch):
+    server = make_server(build_timeout_seconds=0.2)
+    cancelled = threading.Event()
+
+    def stuck_build(tag, fileobj=None, **kwargs):
+        for _ in fileobj:
+            pass
+        yield {'stream': 'Step 1/2 : FROM python\n'}
+        # A silent step: no output until the connection is dropped
+        cancelled.wait(5)
+
+    monkeypatch.setattr(docker_client.api, 'build', stuck_build)
+    start = time.monotonic()
+    with pytest.raises(DeploymentError) as error:
+        server.run_deployment(remote)
+    cancelled.set()
+
+    assert error.value.reason == 'build_timeout'
+    assert time.monotonic() - start < 5
+    stats = server.build_admission.stats()
+    assert stats['lanes']['user']['timeouts'] == 1
+    # The slot of the build was freed
+    assert stats['running'] == 0
+    assert 'svc' not in server.deployed_apps
+
+
+def test_timed_out_build_drops_its_connection(make_server, remote, docker_client):
+    server = make_server(build_timeout_seconds=0.2)
+    dropped, closed = threading.Event(), threading.Event()
+    response = SimpleNamespace(raw=SimpleNamespace(shutdown=dropped.set), close=lambda: None)
+    hooks = {'response': []}
+
+    def stuck_build(tag, fileobj=None, **kwargs):
+        for _ in fileobj:
+            pass
+        for hook in hooks['response']:
+            hook(response)
+        yield {'stream': 'Step 1/2 : FROM python\n'}
+        dropped.wait(5)
+
+    # The build gets a client of its own, the node's client is not touched
+    build_client = SimpleNamespace(api=SimpleNamespace(hooks=hooks, build=stuck_build), close=closed.set)
+    server.nodes.default.client_factory = lambda: build_client
+
+    with pytest.raises(DeploymentError):
+        server.run_deployment(remote)
+
+    assert dropped.is_set() and closed.is_set()
+    assert docker_client.api.hooks == {'response': []} and hooks == {'response': []}
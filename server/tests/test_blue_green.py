@@ -0,0 +1,68 @@
+"""
+Blue/green deployments: candidates stay hidden from nginx-proxy until they pass their
+readiness probe, and the previous version keeps serving when they do not.
+
+Usage (from the server directory):
+    python -m pytest tests
+"""
+import pytest
+from benchmarks.fixtures import push_commit
+from src.jobs import DeploymentError
+from src.server import CANDIDATE_LABEL
+
+BLUE_GREEN = {'deploy': {'strategy': 'blue_green'}}
+
+
+@pytest.fixture
+def started(docker_client, monkeypatch):
+    """Name, labels and environment of every container started."""
+    started = []
+    run = docker_client.containers.run
+
+    def record(image, name, ports=None, labels=None, **kwargs):
+        started.append((name, labels or {}, kwargs.get('environment') or {}))
+        return run(image, name, ports, labels, **kwargs)
+
+    monkeypatch.setattr(docker_client.containers, 'run', record)
+    return started
+
+
+def probe(results):
+    """Readiness probe answering with the given results, in order."""
+    results = iter(results)
+    return lambda addresses, readiness, is_alive=None: next(results)
+
+
+def test_candidate_failing_the_probe_never_gets_traffic(server, remote, tmp_path, docker_client, started, monkeypatch):
+    server.run_deployment(remote, overrides=BLUE_GREEN)
+    previous = docker_client.containers.get('svc')
+    started.clear()
+    push_commit(str(tmp_path / 'git'), 'svc')
+    monkeypatch.setattr('src.server.wait_until_ready', probe([None]))
+
+    with pytest.raises(DeploymentError):
+        server.trigger_update('svc', server.deployed_apps['svc'])
+
+    # Only the unrouted candidate was started, and it is gone
+    assert [(name, labels.get(CANDIDATE_LABEL)) for name, labels, _ in started] == [('svc_next', 'svc_next')]
+    assert started[0][2]['VIRTUAL_HOST'] == '' and started[0][2]['VIRTUAL_PORT'] == ''
+    assert [c.name for c in docker_client.containers.list(all=True)] == ['svc']
+    previous.reload()
+    assert previous.status == 'running'
+
+
+def test_ready_candidates_are_routed_before_the_swap(server, remote, tmp_path, docker_client, started, monkeypatch):
+    server.run_deployment(remote, overrides=BLUE_GREEN)
+    previous = docker_client.containers.get('svc')
+    started.clear()
+    commit = push_commit(str(tmp_path / 'git'), 'svc')
+    monkeypatch.setattr('src.server.wait_until_ready', probe([0.1, 0.2, 0.3]))
+
+    server.trigger_update('svc', server.deployed_apps['svc'])
+
+    # Hidden candidate, then the routed one, then the first replica again on its host port
+    assert [(name, env.get('VIRTUAL_HOST')) for name, _, env in started] == [('svc_next', ''), ('svc_next', None), ('svc', None)]
+    current = docker_client.containers.get('svc')
+    assert current.id != previous.id and current.labels.get(CANDIDATE_LABEL) is None
+    assert [c.name for c in docker_client.containers.list(all=True)] == ['svc']
+    assert server.deployed_apps['svc']['last_commit'] == commit
@@ -0,0 +1,52 @@
+"""
+Reference clones: made from the shared mirror of the remote, they must keep working when
+the mirror drops objects (force-pushes, prune, gc).
+
+Usage (from the server directory):
+    python -m pytest tests
+"""
+import os
+from git import Actor, Repo
+from src.clone_strategies import clone_options
+
+
+def force_push(base_path: str, name: str) -> str:
+    """Rewrites the last commit of the app and force-pushes it. Returns the new commit."""
+    work_repo = Repo(os.path.join(base_path, 'work', name))
+    with open(os.path.join(work_repo.working_tree_dir, 'main.py'), 'w', encoding='utf-8') as f:
+        f.write("print('rewritten')\n")
+    work_repo.index.add(['main.py'])
+    author = Actor('DockerFly Tests', 'tests@dockerfly.local')
+    commit = work_repo.index.commit('Rewritten', parent_commits=work_repo.head.commit.parents, author=author, committer=author)
+    work_repo.git.push('--force', 'origin', 'main')
+    return commit.hexsha
+
+
+def test_reference_clones_are_dissociated():
+    assert clone_options('reference', '/mirrors/a.git') == {'reference': '/mirrors/a.git', 'dissociate': True}
+    assert clone_options('reference') == {}
+
+
+def test_reference_clone_survives_a_force_push_pruned_from_the_mirror(server, remote, tmp_path):
+    # file:// like a network remote: a plain path would make git copy the objects of the remote itself
+    remote = f'file://{remote}'
+    server.run_deployment(remote, clone_strategy='reference')
+    app_state = server.deployed_apps['svc']
+    clone = Repo(app_state['repo_path'])
+    deployed_commit = clone.head.commit.hexsha
+    assert not os.path.exists(os.path.join(clone.git_dir, 'objects', 'info', 'alternates'))
+
+    rewritten = force_push(str(tmp_path / 'git'), 'svc')
+    mirror = Repo(server.mirrors.ensure(remote))
+    mirror.git.reflog('expire', '--expire=now', '--all')
+    mirror.git.gc('--prune=now')
+    assert not mirror.git.rev_list('--all').count(deployed_commit)
+
+    # The deployed commit is still complete in the clone
+    clone.git.fsck('--full')
+    clone.git.checkout('--force', deployed_commit)
+    # And the clone can move to the rewritten history
+    clone.git.fetch('origin')
+    clone.git.checkout('--force', rewritten)
+    with open(os.path.join(clone.working_tree_dir, 'main.py'), encoding='utf-8') as f:
+        assert f.read() == "print('rewritten')\n"
@@ -0,0 +1,88 @@
+"""
+Normalization of the requirements files keying the dependency images (and the wheelhouse).
+
+Usage (from the server directory):
+    python -m pytest tests
+"""
+import tarfile
+import pytest
+from packaging.requirements import Requirement
+from src.deps_cache import DependencyImageCache
+
+normalize = DependencyImageCache.normalize_requirements
+
+
+def test_formatting_does_not_change_the_key():
+    assert normalize("Flask >= 2.0 , < 3\nrequests\n") == normalize("requests\n\nflask>=2.0,<3")
+    assert normalize("Typing_Extensions==4.8\n") == normalize("typing-extensions==4.8")
+
+
+def test_comments():
+    text = "# web framework\nflask==3.0.0  # pinned\n   # indented comment\nrequests#egg\n"
+    assert normalize(text) == "flask==3.0.0\nrequests#egg"
+
+
+def test_extras():
+    assert normalize("Uvicorn [standard, http2] >= 0.20") == "uvicorn[standard,http2]>=0.20"
+
+
+def test_markers_are_kept():
+    normalized = normalize('pywin32 ; sys_platform == "win32" and python_version >= "3.8"\n'
+                           'tomli>=1.1;python_version<"3.11"')
+    assert normalized.splitlines() == [
+        'pywin32 ; sys_platform == "win32" and python_version >= "3.8"',
+        'tomli>=1.1 ; python_version<"3.11"',
+    ]
+    for line in normalized.splitlines():
+        Requirement(line)
+
+
+def test_direct_references():
+    normalized = normalize('My_Pkg @ https://example.com/pkg-1.0.whl ; python_version < "3.11"\nother@https://example.com/a;b.whl')
+    assert normalized.splitlines() == [
+        'my-pkg @ https://example.com/pkg-1.0.whl ; python_version < "3.11"',
+        'other @ https://example.com/a;b.whl',
+    ]
+
+
+def test_hashes_and_continuations():
+    text = ("requests==2.31.0 \\\n"
+            "    --hash=sha256:58cd2187c01e70e6e26505bca751777aa9f2ee0b7f4300988b709f44e013003f \\\n"
+            "    --hash=sha256:942c5a758f98d790eaed1a29cb6eefc7ffb0d1cf7af05c3d2791656dbd6ad1e1\n"
+            "flask\\\n"
+            "==3.0.0\n")
+    assert normalize(text).splitlines() == [
+        "flask==3.0.0",
+        "requests==2.31.0"
+        " --hash=sha256:58cd2187c01e70e6e26505bca751777aa9f2ee0b7f4300988b709f44e013003f"
+        " --hash=sha256:942c5a758f98d790eaed1a29cb6eefc7ffb0d1cf7af05c3d2791656dbd6ad1e1",
+    ]
+
+
+def test_global_options_are_kept():
+    assert normalize("--extra-index-url https://pypi.example/simple\nflask") == "--extra-index-url https://pypi.example/simple\nflask"
+
+
+@pytest.mark.parametrize('line', ['-r base.txt', '--requirement=base.txt', '-c constraints.txt', '-e .', './libs/pkg', 'file:///wheels/a.whl'])
+def test_references_to_other_files_are_not_cacheable(line):
+    assert normalize(f"flask\n{line}\n") is None
+
+
+def test_dependency_image_installs_the_requirements_as_written(docker_client, monkeypatch):
+    contexts = []
+    build = docker_client.images.build
+
+    def capture(tag, labels=None, **kwargs):
+        with tarfile.open(fileobj=kwargs['fileobj']) as tar:
+            contexts.append(tar.extractfile('requirements.txt').read().decode())
+        kwargs['fileobj'].seek(0)
+        return build(tag, labels, **kwargs)
+
+    monkeypatch.setattr(docker_client.images, 'build', capture)
+    cache = DependencyImageCache(docker_client)
+    text = 'pywin32 ; sys_platform == "win32"\nrequests==2.31.0 \\\n    --hash=sha256:abc\n'
+
+    assert cache.ensure('3.10', text).startswith(f'{DependencyImageCache.REPOSITORY}:')
+    assert contexts == ['pywin32 ; sys_platform == "win32"\nrequests==2.31.0 --hash=sha256:abc\n']
+    # A second deploy of the same requirements reuses the image
+    assert cache.ensure('3.10', text) and len(contexts) == 1
@@ -0,0 +1,60 @@
+"""
+Apps deployed under their legacy container name (underscores kept) are moved to the new name
+only once the new containers run.
+
+Usage (from the server directory):
+    python -m pytest tests
+"""
+import pytest
+from benchmarks.fixtures import create_remote
+from src.jobs import DeploymentError
+from src.server import APP_LABEL
+
+BLUE_GREEN = {'deploy': {'strategy': 'blue_green'}}
+
+
+@pytest.fixture
+def legacy(server, docker_client, tmp_path):
+    """Remote of an app named 'my_svc', running as 'my_svc' like before underscores were replaced."""
+    remote = create_remote(str(tmp_path / 'git'), 'my_svc', 8000)
+    container = docker_client.containers.run('python:3.10-slim', 'my_svc', ports={'8000/tcp': 8000},
+                                             labels={APP_LABEL: 'my_svc'}, environment={'VIRTUAL_HOST': 'my_svc'})
+    server._register_app('my_svc', {'repo_url': remote, 'repo_path': str(tmp_path / 'old'), 'repo_name': 'my_svc'})
+    return remote, container
+
+
+def names(docker_client):
+    return sorted(c.name for c in docker_client.containers.list(all=True))
+
+
+def test_failed_blue_green_keeps_the_legacy_containers(server, docker_client, legacy, monkeypatch):
+    remote, container = legacy
+    monkeypatch.setattr('src.server.wait_until_ready', lambda addresses, readiness, is_alive=None: None)
+
+    with pytest.raises(DeploymentError):
+        server.run_deployment(remote, overrides=BLUE_GREEN)
+
+    assert names(docker_client) == ['my_svc']
+    container.reload()
+    assert container.status == 'running'
+    assert 'my_svc' in server.deployed_apps and 'my-svc' not in server.deployed_apps
+
+
+def test_blue_green_retires_the_legacy_name_after_the_swap(server, docker_client, legacy, monkeypatch):
+    remote, _ = legacy
+    monkeypatch.setattr('src.server.wait_until_ready', lambda addresses, readiness, is_alive=None: 0.1)
+
+    server.run_deployment(remote, overrides=BLUE_GREEN)
+
+    assert names(docker_client) == ['my-svc']
+    # The new first replica was moved to the host port of the app
+    assert docker_client.containers.get('my-svc').ports['8000/tcp'][0]['HostPort'] == '8000'
+    assert 'my_svc' not in server.deployed_apps and 'my-svc' in server.deployed_apps
+    assert server.state_store.load_apps().keys() == {'my-svc'}
+
+
+def test_recreate_retires_the_legacy_name(server, docker_client, legacy):
+    remote, _ = legacy
+    server.run_deployment(remote)
+    assert names(docker_client) == ['my-svc']
+    assert 'my_svc' not in server.deployed_apps and 'my-svc' in server.deployed_apps
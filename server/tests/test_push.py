@@ -0,0 +1,174 @@
+"""
+Push path: webhook to apps through the repository index, branch filtering, poll backoff
+of apps receiving webhooks, and POST /hooks/git against local bare repositories.
+
+Usage (from the server directory):
+    python -m pytest tests
+"""
+import hashlib
+import hmac
+import json
+import time
+from git import Repo
+from benchmarks.fixtures import push_commit
+from src.webhooks import normalize_repo_url
+from .conftest import WEBHOOK_SECRET, wait_for
+
+
+def deploy(server, remote):
+    server.run_deployment(remote)
+    return server.deployed_apps['svc']
+
+
+def github_push(remote: str, after: str, branch: str = 'main'):
+    return {
+        "ref": f"refs/heads/{branch}",
+        "after": after,
+        "repository": {"clone_url": f"file://{remote}", "html_url": f"file://{remote}"},
+    }
+
+
+def signed(payload):
+    body = json.dumps(payload).encode()
+    signature = hmac.new(WEBHOOK_SECRET.encode(), body, hashlib.sha256).hexdigest()
+    return body, {'Content-Type': 'application/json', 'X-GitHub-Event': 'push', 'X-Hub-Signature-256': f'sha256={signature}'}
+
+
+def test_push_redeploys_the_apps_of_the_repository(server, remote, tmp_path):
+    deploy(server, remote)
+    assert server.repo_index[normalize_repo_url(remote)] == {'svc'}
+    commit = push_commit(str(tmp_path / 'git'), 'svc')
+
+    # Any spelling of the URL reaches the app
+    jobs = server.handle_push_event({normalize_repo_url(f'file://{remote}/')}, 'main', commit)
+
+    assert [job.target for job in jobs] == ['svc']
+    assert wait_for(jobs[0]).status == 'succeeded'
+    assert server.deployed_apps['svc']['last_commit'] == commit
+
+
+def test_push_to_an_unknown_repository(server, remote):
+    deploy(server, remote)
+    assert server.handle_push_event({'github.com/someone/else'}, 'main', 'a' * 40) == []
+
+
+def test_push_to_another_branch_is_ignored(server, remote):
+    app_state = deploy(server, remote)
+    assert app_state['branch'] == 'main'
+    assert server.handle_push_event({normalize_repo_url(remote)}, 'feature', 'a' * 40) == []
+    assert 'last_webhook_at' not in app_state
+
+
+def test_push_for_an_app_without_stored_branch_uses_the_branch_of_its_clone(server, remote, tmp_path):
+    app_state = deploy(server, remote)
+    app_state['branch'] = None  # e.g. adopted from its container labels
+
+    assert server.handle_push_event({normalize_repo_url(remote)}, 'feature', 'a' * 40) == []
+    commit = push_commit(str(tmp_path / 'git'), 'svc')
+    jobs = server.handle_push_event({normalize_repo_url(remote)}, 'main', commit)
+    assert [job.target for job in jobs] == ['svc']
+    wait_for(jobs[0])
+
+
+def test_push_for_an_app_on_a_detached_head_uses_the_default_branch(server, remote):
+    app_state = deploy(server, remote)
+    repo = Repo(app_state['repo_path'])
+    repo.git.checkout(repo.head.commit.hexsha)
+    app_state['branch'] = None
+
+    assert server.handle_push_event({normalize_repo_url(remote)}, 'feature', 'a' * 40) == []
+    assert server._tracked_branch(app_state) == 'main'
+
+
+def test_push_of_the_deployed_commit_only_records_the_webhook(server, remote):
+    app_state = deploy(server, remote)
+    assert server.handle_push_event({normalize_repo_url(remote)}, 'main', app_state['last_commit']) == []
+    assert app_state['last_webhook_at'] <= time.time()
+
+
+def test_polling_backs_off_after_a_webhook(server, remote):
+    app_state = deploy(server, remote)
+    assert server._should_poll('svc', app_state)
+
+    server.handle_push_event({normalize_repo_url(remote)}, 'main', app_state['last_commit'])
+    # The next poll waits one update interval
+    assert not server._should_poll('svc', app_state)
+    next_poll_at, interval = server._poll_backoff['svc']
+    assert interval == server.update_interval
+
+    # Unchanged polls double the interval up to the maximum, a change resets it
+    intervals = []
+    for _ in range(6):
+        server._record_poll('svc', app_state, changed=False)
+        intervals.append(server._poll_backoff['svc'][1])
+    assert intervals == [120, 240, 480, 600, 600, 600]
+    server._record_poll('svc', app_state, changed=True)
+    assert server._poll_backoff['svc'][1] == server.update_interval
+
+    server._poll_backoff['svc'] = (time.time() - 1, server.update_interval)
+    assert server._should_poll('svc', app_state)
+
+
+def test_polling_resumes_when_webhooks_stop(server, remote):
+    app_state = deploy(server, remote)
+    server.handle_push_event({normalize_repo_url(remote)}, 'main', app_state['last_commit'])
+    app_state['last_webhook_at'] = time.time() - server.webhook_recent_seconds - 1
+
+    assert server._should_poll('svc', app_state)
+    assert 'svc' not in server._poll_backoff
+
+
+def test_polls_of_apps_without_webhooks_do_not_back_off(server, remote):
+    app_state = deploy(server, remote)
+    server._record_poll('svc', app_state, changed=False)
+    assert 'svc' not in server._poll_backoff
+
+
+def test_webhook_endpoint_redeploys(api, server, remote, tmp_path):
+    deploy(server, remote)
+    commit = push_commit(str(tmp_path / 'git'), 'svc')
+    body, headers = signed(github_push(remote, commit))
+
+    response = api.post('/hooks/git', content=body, headers=headers)
+
+    assert response.status_code == 202
+    jobs = response.json()['jobs']
+    assert [job['app'] for job in jobs] == ['svc']
+    assert wait_for(server.job_queue.get(jobs[0]['job_id'])).status == 'succeeded'
+    assert server.deployed_apps['svc']['last_commit'] == commit
+
+
+def test_webhook_endpoint_ignores_other_branches(api, server, remote):
+    deploy(server, remote)
+    body, headers = signed(github_push(remote, 'a' * 40, branch='feature'))
+    response = api.post('/hooks/git', content=body, headers=headers)
+    assert response.status_code == 202
+    assert response.json()['jobs'] == []
+
+
+def test_webhook_endpoint_rejects_bad_signatures(api, server, remote):
+    deploy(server, remote)
+    body, headers = signed(github_push(remote, 'a' * 40))
+    headers['X-Hub-Signature-256'] = 'sha256=' + '0' * 64
+    assert api.post('/hooks/git', content=body, headers=headers).status_code == 401
+    assert 'last_webhook_at' not in server.deployed_apps['svc']
+
+
+def test_webhook_endpoint_ignores_other_events(api):
+    body, headers = signed({"zen": "Keep it logically awesome.", "hook_id": 1})
+    response = api.post('/hooks/git', content=body, headers=headers)
+    assert response.status_code == 202
+    assert response.json() == {"message": "Event ignored", "jobs": []}
+
+
+def test_webhook_endpoint_rejects_invalid_json(api):
+    signature = hmac.new(WEBHOOK_SECRET.encode(), b'not json', hashlib.sha256).hexdigest()
+    response = api.post('/hooks/git', content=b'not json', headers={'X-Hub-Signature-256': f'sha256={signature}'})
+    assert response.status_code == 400
+
+
+def test_webhook_endpoint_disabled_without_secret(main_module, make_server, monkeypatch):
+    from fastapi.testclient import TestClient
+    monkeypatch.setattr(main_module, 'server', make_server(webhook_secret=None))
+    body, headers = signed({})
+    assert TestClient(main_module.app).post('/hooks/git', content=body, headers=headers).status_code == 503
@@ -0,0 +1,87 @@
+"""
+Telemetry ticks: calls made to the daemons, and restart counts kept between ticks.
+
+Usage (from the server directory):
+    python -m pytest tests
+"""
+from collections import Counter
+from types import SimpleNamespace
+from docker.errors import APIError
+from src.server import APP_LABEL, CANDIDATE_LABEL
+from src.telemetry import TelemetryCollector
+
+
+class StubAPI:
+    """Low-level API of a daemon running two replicas of 'svc'."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.restart_counts = {'a' * 64: 0, 'b' * 64: 0}
+        self.started = []
+        self.events_error = None
+
+    def containers(self, filters=None):
+        self.calls['containers'] += 1
+        return [{'Id': container_id, 'Names': [f'/svc_{index}'], 'Labels': {APP_LABEL: 'svc'}}
+                for index, container_id in enumerate(self.restart_counts)]
+
+    def stats(self, container_id, stream=False, one_shot=False):
+        self.calls['stats'] += 1
+        return {'cpu_stats': {'cpu_usage': {'total_usage': 100}, 'system_cpu_usage': 1000, 'online_cpus': 1},
+                'memory_stats': {'usage': 1024, 'limit': 4096}}
+
+    def inspect_container(self, container_id):
+        self.calls['inspect_container'] += 1
+        return {'RestartCount': self.restart_counts[container_id]}
+
+    def events(self, since=None, until=None, filters=None, decode=False):
+        self.calls['events'] += 1
+        if self.events_error:
+            raise self.events_error
+        started, self.started = self.started, []
+        return [{'Type': 'container', 'Action': 'start', 'id': container_id} for container_id in started]
+
+
+def collector():
+    api = StubAPI()
+    node = SimpleNamespace(name='local', healthy=True, client=SimpleNamespace(api=api))
+    server = SimpleNamespace(nodes=SimpleNamespace(nodes={'local': node}), deployed_apps={'svc': {}})
+    return TelemetryCollector(server, APP_LABEL, CANDIDATE_LABEL), api
+
+
+def test_restart_counts_are_read_once_per_container():
+    telemetry, api = collector()
+    telemetry.sample()
+    assert api.calls == {'containers': 1, 'stats': 2, 'inspect_container': 2}
+
+    api.calls.clear()
+    telemetry.sample()
+    telemetry.sample()
+    # One listing and one events call per node, one stats call per container
+    assert api.calls == {'containers': 2, 'events': 2, 'stats': 4}
+
+
+def test_restarted_containers_are_read_again():
+    telemetry, api = collector()
+    telemetry.sample()
+    api.calls.clear()
+
+    api.restart_counts['a' * 64] = 3
+    api.started.append('a' * 64)
+    telemetry.sample()
+
+    assert api.calls['inspect_container'] == 1
+    assert telemetry.series('svc')[-1]['restarts'] == 3
+
+
+def test_restart_counts_are_read_when_events_are_not_available():
+    telemetry, api = collector()
+    telemetry.sample()
+    api.calls.clear()
+
+    api.events_error = APIError('events not available')
+    api.restart_counts['b' * 64] = 1
+    telemetry.sample()
+
+    assert api.calls['inspect_container'] == 2
+    assert telemetry.series('svc')[-1]['restarts'] == 1
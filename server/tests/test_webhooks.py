@@ -0,0 +1,142 @@
+"""
+Webhook authentication and push parsing with canned GitHub, Gitea and GitLab requests.
+
+Usage (from the server directory):
+    python -m pytest tests
+"""
+import hashlib
+import hmac
+import json
+import pytest
+from src.webhooks import parse_push_event, verify_signature
+
+SECRET = 'webhook-secret'
+COMMIT = '6dcb09b5b57875f334f61aebed695e2e4193db5e'
+NULL_COMMIT = '0' * 40
+
+# Trimmed push payloads, with the fields the providers send for the repository
+GITHUB_PUSH = {
+    "ref": "refs/heads/main",
+    "before": "9049f1265b7d61be4a8904a9a27120d2064dab3b",
+    "after": COMMIT,
+    "repository": {
+        "full_name": "octocat/Hello-World",
+        "html_url": "https://github.com/octocat/Hello-World",
+        "url": "https://github.com/octocat/Hello-World",
+        "git_url": "git://github.com/octocat/Hello-World.git",
+        "ssh_url": "git@github.com:octocat/Hello-World.git",
+        "clone_url": "https://github.com/octocat/Hello-World.git",
+    },
+    "pusher": {"name": "octocat"},
+}
+GITEA_PUSH = {
+    "ref": "refs/heads/develop",
+    "before": "28e1879d029cb852e4844d9c718537df08844e03",
+    "after": COMMIT,
+    "repository": {
+        "full_name": "team/api",
+        "html_url": "https://git.example.com/team/api",
+        "ssh_url": "git@git.example.com:team/api.git",
+        "clone_url": "https://git.example.com/team/api.git",
+    },
+}
+GITLAB_PUSH = {
+    "object_kind": "push",
+    "ref": "refs/heads/main",
+    "before": "95790bf891e76fee5e1747ab589903a6a1f80f22",
+    "after": COMMIT,
+    "checkout_sha": COMMIT,
+    "project": {
+        "path_with_namespace": "group/service",
+        "web_url": "https://gitlab.com/group/service",
+        "git_ssh_url": "git@gitlab.com:group/service.git",
+        "git_http_url": "https://gitlab.com/group/service.git",
+    },
+    "repository": {
+        "url": "git@gitlab.com:group/service.git",
+        "homepage": "https://gitlab.com/group/service",
+        "git_http_url": "https://gitlab.com/group/service.git",
+        "git_ssh_url": "git@gitlab.com:group/service.git",
+    },
+}
+
+
+def body_of(payload):
+    return json.dumps(payload).encode()
+
+
+def hmac_sha256(body: bytes, secret: str = SECRET) -> str:
+    return hmac.new(secret.encode(), body, hashlib.sha256).hexdigest()
+
+
+def test_github_signature():
+    body = body_of(GITHUB_PUSH)
+    headers = {'X-GitHub-Event': 'push', 'X-Hub-Signature-256': f'sha256={hmac_sha256(body)}'}
+    assert verify_signature(headers, body, SECRET)
+
+
+@pytest.mark.parametrize('signature', [
+    f"sha256={hmac_sha256(body_of(GITHUB_PUSH), 'other-secret')}",
+    hmac_sha256(body_of(GITHUB_PUSH)),  # without the 'sha256=' prefix
+    'sha256=',
+])
+def test_github_bad_signature(signature):
+    assert not verify_signature({'X-Hub-Signature-256': signature}, body_of(GITHUB_PUSH), SECRET)
+
+
+def test_signature_covers_the_raw_body():
+    body = body_of(GITHUB_PUSH)
+    headers = {'X-Hub-Signature-256': f'sha256={hmac_sha256(body)}'}
+    assert not verify_signature(headers, json.dumps(GITHUB_PUSH, indent=2).encode(), SECRET)
+
+
+@pytest.mark.parametrize('header', ['X-Gitea-Signature', 'X-Gogs-Signature', 'x-gitea-signature'])
+def test_gitea_signature(header):
+    body = body_of(GITEA_PUSH)
+    assert verify_signature({header: hmac_sha256(body)}, body, SECRET)
+
+
+def test_gitea_bad_signature():
+    body = body_of(GITEA_PUSH)
+    assert not verify_signature({'X-Gitea-Signature': hmac_sha256(body, 'other-secret')}, body, SECRET)
+
+
+def test_gitlab_token():
+    assert verify_signature({'X-Gitlab-Event': 'Push Hook', 'X-Gitlab-Token': SECRET}, body_of(GITLAB_PUSH), SECRET)
+
+
+def test_gitlab_bad_token():
+    assert not verify_signature({'X-Gitlab-Event': 'Push Hook', 'X-Gitlab-Token': 'wrong'}, body_of(GITLAB_PUSH), SECRET)
+
+
+def test_unsigned_request():
+    assert not verify_signature({'X-GitHub-Event': 'push'}, body_of(GITHUB_PUSH), SECRET)
+
+
+def test_parse_github_push():
+    assert parse_push_event(GITHUB_PUSH) == ({'github.com/octocat/hello-world'}, 'main', COMMIT)
+
+
+def test_parse_gitea_push():
+    assert parse_push_event(GITEA_PUSH) == ({'git.example.com/team/api'}, 'develop', COMMIT)
+
+
+def test_parse_gitlab_push():
+    assert parse_push_event(GITLAB_PUSH) == ({'gitlab.com/group/service'}, 'main', COMMIT)
+
+
+def test_parse_gitlab_push_without_after():
+    payload = {**GITLAB_PUSH}
+    del payload['after']
+    assert parse_push_event(payload) == ({'gitlab.com/group/service'}, 'main', COMMIT)
+
+
+@pytest.mark.parametrize('payload', [
+    {**GITHUB_PUSH, 'ref': 'refs/tags/v1.0.0'},
+    {**GITHUB_PUSH, 'after': NULL_COMMIT},  # branch deleted
+    {key: value for key, value in GITHUB_PUSH.items() if key != 'repository'},
+    {**GITHUB_PUSH, 'ref': None},
+    {'zen': 'Design for failure.', 'hook_id': 1},  # GitHub ping
+])
+def test_parse_ignores_other_events(payload):
+    assert parse_push_event(payload) is None
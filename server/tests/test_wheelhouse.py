@@ -0,0 +1,79 @@
+"""
+Wheelhouse: the requirements given to 'pip wheel' and the locks of the requirements sets.
+
+Usage (from the server directory):
+    python -m pytest tests
+"""
+import io
+import tarfile
+import threading
+from types import SimpleNamespace
+from packaging.requirements import Requirement
+from src.wheelhouse import Wheelhouse
+
+
+class HelperContainer:
+    """Helper container of 'pip wheel': keeps the requirements it gets, returns one wheel."""
+
+    def __init__(self, started: list):
+        self.short_id = 'helper'
+        self.started = started
+
+    def put_archive(self, path, data):
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            self.started.append(tar.extractfile(tar.getmembers()[0]).read().decode())
+
+    def start(self):
+        pass
+
+    def wait(self, timeout=None):
+        return {'StatusCode': 0}
+
+    def get_archive(self, path):
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            data = b'wheel'
+            info = tarfile.TarInfo('wheels/tomli-2.0.1-py3-none-any.whl')
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        return iter([archive.getvalue()]), {}
+
+    def remove(self, force=False):
+        pass
+
+
+def wheelhouse(tmp_path, started):
+    client = SimpleNamespace(
+        info=lambda: {'Architecture': 'x86_64'},
+        containers=SimpleNamespace(create=lambda image, command, **kwargs: HelperContainer(started)),
+    )
+    return Wheelhouse(str(tmp_path / 'wheelhouse'), 'http://dockerfly:8000', client)
+
+
+def test_markers_reach_pip_wheel(tmp_path):
+    started = []
+    wheels = wheelhouse(tmp_path, started)
+    text = 'tomli>=1.1;python_version<"3.11"\npywin32 ; sys_platform == "win32"  # windows only\n'
+
+    url = wheels.ensure('3.10', text)
+
+    assert url.startswith('http://dockerfly:8000/wheelhouse/py3.10-x86_64/')
+    assert started == ['pywin32 ; sys_platform == "win32"\ntomli>=1.1 ; python_version<"3.11"\n']
+    for line in started[0].splitlines():
+        Requirement(line)
+    # Same requirements, formatted differently: the set is reused
+    assert wheels.ensure('3.10', 'Tomli >= 1.1 ;python_version<"3.11"\npywin32;sys_platform == "win32"') == url
+    assert len(started) == 1 and wheels.stats()['hits'] == 1
+
+
+def test_locks_of_the_sets_are_dropped(tmp_path):
+    started = []
+    wheels = wheelhouse(tmp_path, started)
+    threads = [threading.Thread(target=wheels.ensure, args=('3.10', f'package-{index % 3}==1.0')) for index in range(12)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+    assert len(started) == 3
+    assert wheels._key_locks == {}
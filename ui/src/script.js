@@ -7,6 +7,7 @@ const successAppName = document.getElementById('success-app-name');
 const successAccessUrl = document.getElementById('success-access-url');
 const successContainerId = document.getElementById('success-container-id');
 const successCommitHash = document.getElementById('success-commit-hash');
+const deployLog = document.getElementById('deploy-log');
 
 let serverUrl = '';
 
@@ -53,9 +54,72 @@ async function loadJsYaml() {
     });
 }
 
+const JOB_POLL_INTERVAL_MS = 2000;
+
+async function waitForJob(statusUrl) {
+    while (true) {
+        const response = await fetch(statusUrl, { headers: { 'Accept': 'application/json' } });
+        if (!response.ok) {
+            throw new Error(`Error ${response.status} al consultar el estado del despliegue`);
+        }
+        const job = await response.json();
+        if (job.status === 'succeeded' || job.status === 'failed') {
+            return job;
+        }
+        await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    }
+}
+
+function appendLogLine(line) {
+    deployLog.textContent += line + '\n';
+    deployLog.scrollTop = deployLog.scrollHeight;
+}
+
+// Muestra los logs del despliegue en tiempo real (Server-Sent Events) y devuelve el job al terminar
+function followJob(logsUrl, statusUrl) {
+    deployLog.textContent = '';
+    deployLog.classList.remove('hidden');
+
+    return new Promise((resolve, reject) => {
+        const source = new EventSource(logsUrl);
+        source.onmessage = (event) => appendLogLine(event.data);
+        source.addEventListener('end', () => {
+            source.close();
+            waitForJob(statusUrl).then(resolve, reject);
+        });
+        source.onerror = () => {
+            // Si el stream no está disponible, consultamos el estado periódicamente
+            if (source.readyState === EventSource.CLOSED) {
+                waitForJob(statusUrl).then(resolve, reject);
+            }
+        };
+    });
+}
+
+function showDeploymentResult(data) {
+    if (successAppName) successAppName.textContent = data.app_name || 'N/D';
+    if (successAccessUrl) {
+        successAccessUrl.href = data.access_url || '#';
+        successAccessUrl.textContent = data.access_url || 'N/D';
+        if (!data.access_url) {
+            successAccessUrl.removeAttribute('href');
+            successAccessUrl.style.textDecoration = 'none';
+            successAccessUrl.style.cursor = 'default';
+        } else {
+            successAccessUrl.style.textDecoration = '';
+            successAccessUrl.style.cursor = '';
+        }
+    }
+    if (successContainerId) successContainerId.textContent = data.container_id || 'N/D';
+    if (successCommitHash) successCommitHash.textContent = data.current_commit ? data.current_commit.substring(0, 7) : 'N/D';
+
+    successMessageDiv.classList.remove('hidden');
+}
+
 submitButton.addEventListener('click', async function() {
     errorMessageDiv.classList.add('hidden');
     successMessageDiv.classList.add('hidden');
+    deployLog.classList.add('hidden');
     
     const url = urlInput.value.trim();
     
@@ -92,31 +156,23 @@ submitButton.addEventListener('click', async function() {
             const responseText = await response.text();
             throw new Error(`Error ${response.status}: ${response.statusText}. Response: ${responseText || '(empty)'}`);
         }
-        
-        if (response.ok) {
-            if (successAppName) successAppName.textContent = data.app_name || 'N/D';
-            if (successAccessUrl) {
-                successAccessUrl.href = data.access_url || '#';
-                successAccessUrl.textContent = data.access_url || 'N/D';
-                if (!data.access_url) {
-                    successAccessUrl.removeAttribute('href');
-                    successAccessUrl.style.textDecoration = 'none';
-                    successAccessUrl.style.cursor = 'default';
-                } else {
-                    successAccessUrl.style.textDecoration = '';
-                    successAccessUrl.style.cursor = '';
-                }
-            }
-            if (successContainerId) successContainerId.textContent = data.container_id || 'N/D';
-            if (successCommitHash) successCommitHash.textContent = data.current_commit ? data.current_commit.substring(0, 7) : 'N/D';
 
-            successMessageDiv.classList.remove('hidden');
-            urlInput.value = '';
-        } else {
+        if (!response.ok) {
             // Intentar obtener mensaje de error de FastAPI o genérico
             const errorMsg = data?.detail || data?.message || `Error ${response.status}: ${JSON.stringify(data)}`;
             throw new Error(errorMsg);
         }
+
+        // El servidor encola el despliegue: seguimos sus logs hasta que termine el job
+        const statusUrl = new URL(data.status_url, serverUrl).toString();
+        const job = data.logs_url
+            ? await followJob(new URL(data.logs_url, serverUrl).toString(), statusUrl)
+            : await waitForJob(statusUrl);
+        if (job.status !== 'succeeded') {
+            throw new Error(job.error || 'El despliegue ha fallado');
+        }
+        showDeploymentResult(job.result || {});
+        urlInput.value = '';
     } catch (error) {
         // Mostrar mensaje de error
         